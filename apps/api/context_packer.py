@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import logging
+import re
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger("upvs.api")
+
+# Цифры BPE-токенизаторы Qwen режут по одной; кириллица в среднем ~3 символа на токен
+_APPROX_TOKEN_RE = re.compile(r"\d|[^\W\d_]+|[^\w\s]|\n+")
+_QUERY_TERM_RE = re.compile(r"\d+|[^\W\d_]{3,}")
+# Перекрытие короче этого за перекрытие не считается
+MIN_OVERLAP_CHARS = 40
+# Меньше этого остаток бюджета не тратится на обрезанный источник
+MIN_SOURCE_TOKENS = 64
+# Служебные токены chat template на сообщение
+CHAT_TEMPLATE_TOKENS = 8
+
+
+class TokenCounter(ABC):
+    name = ""
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+
+class ApproxTokenCounter(TokenCounter):
+    """Оценка без модели: с запасом, чтобы промпт не выходил за бюджет"""
+
+    name = "approx"
+
+    def count(self, text: str) -> int:
+        total = 0
+        for match in _APPROX_TOKEN_RE.finditer(text):
+            token = match.group()
+            total += (len(token) + 2) // 3 if token[0].isalpha() else 1
+        return total
+
+
+class ModelTokenCounter(TokenCounter):
+    """Токенизатор модели vLLM (tokenizer.json с HuggingFace Hub, пакет tokenizers)"""
+
+    name = "model"
+
+    def __init__(self, model_name: str) -> None:
+        from tokenizers import Tokenizer
+
+        self._tokenizer = Tokenizer.from_pretrained(model_name)
+
+    def count(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def query_terms(query: str) -> Set[str]:
+    """Слова запроса для отбора строк таблиц: числа целиком, слова — по первым 5 буквам (грубый стемминг)"""
+    terms: Set[str] = set()
+    for term in _QUERY_TERM_RE.findall(query.lower()):
+        terms.add(term if term.isdigit() else term[:5])
+    return terms
+
+
+def _row_relevance(row: object, terms: Set[str]) -> int:
+    cells = row if isinstance(row, (list, tuple)) else [row]
+    text = " ".join(str(cell) for cell in cells).lower()
+    words = set(_QUERY_TERM_RE.findall(text))
+    stems = {word if word.isdigit() else word[:5] for word in words}
+    return len(terms & stems)
+
+
+def trim_table(table: Dict[str, object], terms: Set[str], max_rows: int) -> Dict[str, object]:
+    """Оставляет до max_rows строк, подходящих к запросу (в исходном порядке); без совпадений — первые"""
+    rows = list(table.get("rows") or [])
+    if max_rows <= 0 or len(rows) <= max_rows:
+        return table
+    relevance = [_row_relevance(row, terms) for row in rows]
+    ranked = sorted((i for i in range(len(rows)) if relevance[i] > 0), key=lambda i: -relevance[i])
+    keep = sorted(ranked[:max_rows]) if ranked else list(range(max_rows))
+    trimmed = dict(table)
+    trimmed["rows"] = [rows[i] for i in keep]
+    trimmed["rows_total"] = len(rows)
+    return trimmed
+
+
+def _overlap(left: str, right: str) -> int:
+    """Длина самого длинного суффикса left, который является префиксом right"""
+    for size in range(min(len(left), len(right)), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def strip_overlap(text: str, packed: List[str]) -> Optional[str]:
+    """Убирает из text куски, уже попавшие в промпт из чанков той же страницы; None — покрыт целиком"""
+    for other in packed:
+        if text in other:
+            return None
+        head = _overlap(other, text)
+        if head:
+            text = text[head:].lstrip()
+        tail = _overlap(text, other)
+        if tail:
+            text = text[: len(text) - tail].rstrip()
+    return text
+
+
+@dataclass
+class PackResult:
+    # Копии источников в том виде, в каком они попали в промпт
+    sources: List[Dict[str, object]]
+    blocks: List[str]
+    tokens: int
+    dropped: int
+    deduplicated: int
+
+
+class ContextPacker:
+    """Укладывает источники RAG в бюджет токенов в порядке score.
+
+    Чанки той же страницы, уже попавшие в промпт, не повторяются (перекрытия срезаются),
+    таблица выводится один раз, у длинных таблиц остаются строки, подходящие к запросу.
+    Источник, который не помещается, обрезается по тексту; следующие отбрасываются.
+    """
+
+    def __init__(self, tokenizer: str, model_name: str, table_max_rows: int) -> None:
+        self._tokenizer = tokenizer
+        self._model_name = model_name
+        self._table_max_rows = table_max_rows
+        self._counter: Optional[TokenCounter] = None
+        self._lock = threading.Lock()
+
+    @property
+    def counter(self) -> TokenCounter:
+        counter = self._counter
+        if counter is not None:
+            return counter
+        with self._lock:
+            if self._counter is None:
+                self._counter = self._load_counter()
+            return self._counter
+
+    def _load_counter(self) -> TokenCounter:
+        if self._tokenizer == "model":
+            try:
+                return ModelTokenCounter(self._model_name)
+            except Exception as exc:
+                logger.warning(
+                    "Токенизатор %s не загружен, длина промпта оценивается приближенно: %s", self._model_name, exc
+                )
+        return ApproxTokenCounter()
+
+    def count(self, text: str) -> int:
+        return self.counter.count(text)
+
+    def count_messages(self, *messages: str) -> int:
+        return sum(self.count(message) + CHAT_TEMPLATE_TOKENS for message in messages)
+
+    def pack(
+        self,
+        query: str,
+        sources: List[Dict[str, object]],
+        budget: int,
+        render: Callable[[int, Dict[str, object]], str],
+    ) -> PackResult:
+        terms = query_terms(query)
+        packed_texts: Dict[str, List[str]] = {}
+        packed_tables: Set[str] = set()
+        result = PackResult([], [], 0, 0, 0)
+        for position, source in enumerate(sources):
+            page_id = str(source.get("page_id") or "")
+            text = strip_overlap(str(source.get("text") or ""), packed_texts.get(page_id, []))
+            tables = [
+                trim_table(table, terms, self._table_max_rows)
+                for table in source.get("tables") or []
+                if str(table.get("table_id")) not in packed_tables
+            ]
+            if text is None and not tables:
+                result.deduplicated += 1
+                continue
+            candidate = dict(source, text=text or "", tables=tables)
+            block = render(len(result.blocks) + 1, candidate)
+            tokens = self.count(block)
+            remaining = budget - result.tokens
+            shrunk = tokens > remaining
+            if shrunk:
+                block, tokens = self._shrink(candidate, remaining, render, len(result.blocks) + 1)
+                if block is None:
+                    result.dropped = len(sources) - position
+                    break
+            result.sources.append(candidate)
+            result.blocks.append(block)
+            result.tokens += tokens
+            packed_texts.setdefault(page_id, []).append(str(candidate["text"]))
+            packed_tables.update(str(table.get("table_id")) for table in candidate["tables"])
+            if shrunk:
+                # Источник обрезан по бюджету: дальше места нет
+                result.dropped = len(sources) - position - 1
+                break
+        return result
+
+    def _shrink(
+        self,
+        source: Dict[str, object],
+        remaining: int,
+        render: Callable[[int, Dict[str, object]], str],
+        number: int,
+    ) -> Tuple[Optional[str], int]:
+        """Обрезает текст (затем таблицы) источника под остаток бюджета; (None, 0) — не стоит и пытаться"""
+        if remaining < MIN_SOURCE_TOKENS:
+            return None, 0
+        text = str(source.get("text") or "")
+        tables = list(source.get("tables") or [])
+        for _ in range(6):
+            block = render(number, dict(source, text=text, tables=tables))
+            tokens = self.count(block)
+            if tokens <= remaining:
+                source["text"] = text
+                source["tables"] = tables
+                return block, tokens
+            if text:
+                # Длина токенов почти пропорциональна длине текста: режем с запасом 10%
+                keep = int(len(text) * remaining / tokens * 0.9)
+                text = text[:keep].rstrip() + "…" if keep > 0 else ""
+            elif tables:
+                tables = tables[:-1]
+            else:
+                break
+        return None, 0
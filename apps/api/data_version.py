@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import time
+from typing import Callable, Optional
+
+from .db import AsyncDatabase
+
+
+class DataVersion:
+    """Версия данных Postgres (data_version_seq) с опросом не чаще check_interval секунд.
+
+    В связке с версией FAISS индекса используется для сброса кэшей, построенных поверх данных.
+    """
+
+    def __init__(self, adb: AsyncDatabase, index_version: Callable[[], str], check_interval: float) -> None:
+        self._adb = adb
+        self._index_version = index_version
+        self._check_interval = check_interval
+        self._postgres: Optional[int] = None
+        self._checked_at = 0.0
+
+    async def postgres(self) -> int:
+        now = time.monotonic()
+        if self._postgres is None or now - self._checked_at >= self._check_interval:
+            row = await self._adb.fetch_one(
+                "SELECT CASE WHEN is_called THEN last_value ELSE 0 END AS version FROM data_version_seq",
+                (),
+            )
+            self._postgres = int(row["version"]) if row else 0
+            self._checked_at = now
+        return self._postgres
+
+    async def current(self) -> str:
+        return f"pg:{await self.postgres()}|faiss:{self._index_version()}"
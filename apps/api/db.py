@@ -1,8 +1,9 @@
-from contextlib import contextmanager
-from typing import Generator, Iterable, List, Optional, Tuple
-import psycopg2
-import psycopg2.extras
-from psycopg2.pool import SimpleConnectionPool
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Generator, Iterable, List, Optional, Tuple
+
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
 from .config import Settings
 
@@ -51,53 +52,144 @@ CREATE INDEX IF NOT EXISTS idx_chunks_page_id ON text_chunks(page_id);
 CREATE INDEX IF NOT EXISTS idx_tables_page_id ON tables(page_id);
 CREATE INDEX IF NOT EXISTS idx_edges_from_url ON edges(from_url);
 CREATE INDEX IF NOT EXISTS idx_edges_to_url ON edges(to_url);
+
+-- Полнотекстовый поиск (apps/api/hybrid.py): выражения должны совпадать с запросом
+CREATE INDEX IF NOT EXISTS idx_chunks_text_fts
+    ON text_chunks USING GIN (to_tsvector('russian', coalesce(text, '')));
+CREATE INDEX IF NOT EXISTS idx_pages_title_fts
+    ON pages USING GIN (to_tsvector('russian', coalesce(title, '')));
+CREATE INDEX IF NOT EXISTS idx_tables_caption_fts
+    ON tables USING GIN (to_tsvector('russian', coalesce(caption, '')));
+
+-- Версия данных: растет при любом изменении pages/text_chunks/tables.
+-- Sequence не блокирует параллельные загрузки, в отличие от счетчика в строке.
+CREATE SEQUENCE IF NOT EXISTS data_version_seq;
+
+CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+BEGIN
+    PERFORM nextval('data_version_seq');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER pages_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pages
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE OR REPLACE TRIGGER text_chunks_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON text_chunks
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE OR REPLACE TRIGGER tables_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON tables
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
 """
 
 
+def _connection_kwargs(settings: Settings) -> Dict[str, Any]:
+    return {
+        "autocommit": True,
+        "row_factory": dict_row,
+        "prepare_threshold": settings.db_prepare_threshold,
+        "options": f"-c statement_timeout={settings.db_statement_timeout_ms}",
+    }
+
+
 class Database:
+    """Синхронный доступ для обработчиков, которые выполняются в threadpool"""
+
     def __init__(self, settings: Settings) -> None:
-        self._pool = SimpleConnectionPool(1, 5, settings.database_url)
+        self._pool = ConnectionPool(
+            settings.database_url,
+            min_size=settings.db_pool_min_size,
+            max_size=settings.db_pool_max_size,
+            timeout=settings.db_pool_timeout,
+            kwargs=_connection_kwargs(settings),
+            open=True,
+        )
+
+    def close(self) -> None:
+        self._pool.close()
 
     @contextmanager
-    def connection(self) -> Generator[psycopg2.extensions.connection, None, None]:
-        conn = self._pool.getconn()
-        try:
+    def connection(self) -> Generator[psycopg.Connection, None, None]:
+        with self._pool.connection() as conn:
             yield conn
-        finally:
-            self._pool.putconn(conn)
 
     def init_schema(self) -> None:
         with self.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(CREATE_SQL)
-            conn.commit()
+            with conn.transaction():
+                conn.execute(CREATE_SQL)
 
     def fetch_one(self, query: str, params: Tuple[object, ...]) -> Optional[dict]:
         with self.connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query, params)
-                row = cur.fetchone()
-                return dict(row) if row else None
+            return conn.execute(query, params).fetchone()
 
     def fetch_all(self, query: str, params: Tuple[object, ...]) -> List[dict]:
         with self.connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query, params)
-                rows = cur.fetchall()
-                return [dict(row) for row in rows]
+            return conn.execute(query, params).fetchall()
 
     def fetch_all_with_connection(
-        self, conn: psycopg2.extensions.connection, query: str, params: Tuple[object, ...]
+        self, conn: psycopg.Connection, query: str, params: Tuple[object, ...]
     ) -> List[dict]:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(query, params)
-            rows = cur.fetchall()
-            return [dict(row) for row in rows]
+        return conn.execute(query, params).fetchall()
 
     def fetch_all_iter(
-        self, conn: psycopg2.extensions.connection, query: str, params: Tuple[object, ...]
+        self, conn: psycopg.Connection, query: str, params: Tuple[object, ...]
     ) -> Iterable[dict]:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(query, params)
-            for row in cur:
-                yield dict(row)
+        # Именованный (серверный) курсор живет только внутри транзакции
+        with conn.transaction():
+            with conn.cursor(name="fetch_all_iter") as cur:
+                cur.execute(query, params)
+                yield from cur
+
+
+class AsyncDatabase:
+    """Асинхронный доступ к Postgres для async-обработчиков FastAPI"""
+
+    def __init__(self, settings: Settings) -> None:
+        self._pool = AsyncConnectionPool(
+            settings.database_url,
+            min_size=settings.db_pool_min_size,
+            max_size=settings.db_pool_max_size,
+            timeout=settings.db_pool_timeout,
+            kwargs=_connection_kwargs(settings),
+            open=False,
+        )
+
+    async def open(self) -> None:
+        await self._pool.open(wait=True)
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncGenerator[psycopg.AsyncConnection, None]:
+        async with self._pool.connection() as conn:
+            yield conn
+
+    async def fetch_one(self, query: str, params: Tuple[object, ...]) -> Optional[dict]:
+        async with self.connection() as conn:
+            cur = await conn.execute(query, params)
+            return await cur.fetchone()
+
+    async def fetch_all(self, query: str, params: Tuple[object, ...]) -> List[dict]:
+        async with self.connection() as conn:
+            cur = await conn.execute(query, params)
+            return await cur.fetchall()
+
+    async def fetch_all_with_connection(
+        self, conn: psycopg.AsyncConnection, query: str, params: Tuple[object, ...]
+    ) -> List[dict]:
+        cur = await conn.execute(query, params)
+        return await cur.fetchall()
+
+    async def stream(
+        self, query: str, params: Tuple[object, ...], batch_size: int = 1000
+    ) -> AsyncIterator[dict]:
+        """Построчная выдача через серверный курсор, без загрузки всего результата"""
+        async with self.connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor(name="stream") as cur:
+                    cur.itersize = batch_size
+                    await cur.execute(query, params)
+                    async for row in cur:
+                        yield row
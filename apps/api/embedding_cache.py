@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .config import Settings
+from .embeddings import EmbeddingProvider
+from .onnx_embedding import onnx_model_digest
+
+logger = logging.getLogger("upvs.api")
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def embedding_namespace(settings: Settings) -> str:
+    """Что определяет вектор запроса: провайдер, модель и конкретный ONNX-файл (fp32/int8) или URL.
+
+    Одно имя модели у torch, ONNX и HTTP-провайдера дает разные векторы, а общий кэш
+    (sqlite/redis) переживает перезапуски и смену провайдера.
+    """
+    provider = settings.embeddings_provider
+    parts = [provider, settings.embeddings_model]
+    if provider == "onnx":
+        try:
+            parts.append(onnx_model_digest(settings.embeddings_onnx_path))
+        except OSError:
+            # Файла нет — провайдер все равно не загрузится; в ключе остается путь
+            parts.append(settings.embeddings_onnx_path)
+    elif provider == "http":
+        parts.append(settings.vllm_url)
+    return "\0".join(parts)
+
+
+def cache_key(namespace: str, text: str) -> str:
+    return hashlib.sha256(f"{namespace}\0{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+
+class SharedEmbeddingCache(ABC):
+    """Общий для всех воркеров кэш векторов запросов"""
+
+    @abstractmethod
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_many(self, items: Dict[str, np.ndarray]) -> None:
+        raise NotImplementedError
+
+
+class SqliteEmbeddingCache(SharedEmbeddingCache):
+    # Чистка просроченных и лишних строк не чаще, чем раз в столько записей
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str, ttl: float, max_rows: int) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._ttl = ttl
+        self._max_rows = max_rows
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_query_embeddings_created ON query_embeddings (created_at)"
+        )
+        self._conn.commit()
+        with self._lock:
+            self._prune()
+
+    def _prune(self) -> None:
+        """Удаляет строки старше TTL и самые старые сверх max_rows (0 — без предела)"""
+        if self._ttl > 0:
+            self._conn.execute("DELETE FROM query_embeddings WHERE created_at < ?", (time.time() - self._ttl,))
+        if self._max_rows > 0:
+            self._conn.execute(
+                "DELETE FROM query_embeddings WHERE key IN ("
+                "SELECT key FROM query_embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self._max_rows,),
+            )
+        self._conn.commit()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        if not keys:
+            return {}
+        placeholders = ",".join("?" for _ in keys)
+        min_created = time.time() - self._ttl if self._ttl > 0 else 0.0
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM query_embeddings "
+                f"WHERE key IN ({placeholders}) AND created_at >= ?",
+                (*keys, min_created),
+            ).fetchall()
+        return {key: np.frombuffer(blob, dtype="float32") for key, blob in rows}
+
+    def set_many(self, items: Dict[str, np.ndarray]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO query_embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                [(key, vector.astype("float32").tobytes(), now) for key, vector in items.items()],
+            )
+            self._conn.commit()
+            self._writes += len(items)
+            if self._writes >= self.PRUNE_EVERY:
+                self._writes = 0
+                self._prune()
+
+
+class RedisEmbeddingCache(SharedEmbeddingCache):
+    def __init__(self, url: str, ttl: float) -> None:
+        try:
+            import redis
+        except ImportError as exc:
+            raise RuntimeError(
+                "EMBEDDING_CACHE_BACKEND=redis требует пакет redis (pip install redis)"
+            ) from exc
+
+        self._client = redis.Redis.from_url(url)
+        self._ttl = int(ttl) if ttl > 0 else None
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        if not keys:
+            return {}
+        values = self._client.mget([f"qemb:{key}" for key in keys])
+        return {
+            key: np.frombuffer(value, dtype="float32")
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    def set_many(self, items: Dict[str, np.ndarray]) -> None:
+        pipe = self._client.pipeline(transaction=False)
+        for key, vector in items.items():
+            pipe.set(f"qemb:{key}", vector.astype("float32").tobytes(), ex=self._ttl)
+        pipe.execute()
+
+
+class CachedEmbeddingProvider(EmbeddingProvider):
+    """LRU с TTL перед провайдером эмбеддингов; ключ — embedding_namespace + нормализованный текст"""
+
+    def __init__(
+        self,
+        inner: EmbeddingProvider,
+        namespace: str,
+        max_size: int,
+        ttl: float,
+        shared: Optional[SharedEmbeddingCache] = None,
+    ) -> None:
+        self._inner = inner
+        self._namespace = namespace
+        self._max_size = max_size
+        self._ttl = ttl
+        self._shared = shared
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._hits = 0
+        self._shared_hits = 0
+        self._misses = 0
+        self._shared_errors = 0
+
+    def _get_local(self, key: str, now: float) -> Optional[np.ndarray]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created_at, vector = entry
+        if self._ttl > 0 and now - created_at > self._ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return vector
+
+    def _put_local(self, key: str, vector: np.ndarray, now: float) -> None:
+        self._entries[key] = (now, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return self._inner.embed(texts)
+        keys = [cache_key(self._namespace, text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                vector = self._get_local(key, now)
+                if vector is not None:
+                    found[key] = vector
+                    self._hits += 1
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing and self._shared is not None:
+            try:
+                shared = self._shared.get_many(missing)
+            except Exception as exc:
+                # Общий кэш — оптимизация: при его недоступности считаем локально
+                logger.warning("Общий кэш эмбеддингов недоступен: %s", exc)
+                shared = {}
+                with self._lock:
+                    self._shared_errors += 1
+            if shared:
+                found.update(shared)
+                with self._lock:
+                    self._shared_hits += len(shared)
+                    for key, vector in shared.items():
+                        self._put_local(key, vector, now)
+                missing = [key for key in missing if key not in shared]
+
+        if missing:
+            texts_by_key = dict(zip(keys, texts))
+            vectors = self._inner.embed([texts_by_key[key] for key in missing])
+            computed = {key: vectors[i] for i, key in enumerate(missing)}
+            found.update(computed)
+            with self._lock:
+                self._misses += len(missing)
+                for key, vector in computed.items():
+                    self._put_local(key, vector, now)
+            if self._shared is not None:
+                try:
+                    self._shared.set_many(computed)
+                except Exception as exc:
+                    logger.warning("Не удалось записать в общий кэш эмбеддингов: %s", exc)
+                    with self._lock:
+                        self._shared_errors += 1
+
+        return np.vstack([found[key] for key in keys]).astype("float32", copy=False)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            lookups = self._hits + self._shared_hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_size": self._max_size,
+                "ttl": self._ttl,
+                "hits": self._hits,
+                "shared_hits": self._shared_hits,
+                "misses": self._misses,
+                "shared_errors": self._shared_errors,
+                "hit_rate": (self._hits + self._shared_hits) / lookups if lookups else 0.0,
+            }
+
+
+def get_shared_cache(settings: Settings) -> Optional[SharedEmbeddingCache]:
+    if settings.embedding_cache_backend == "sqlite":
+        return SqliteEmbeddingCache(
+            settings.embedding_cache_sqlite_path,
+            settings.embedding_cache_ttl,
+            settings.embedding_cache_sqlite_max_rows,
+        )
+    if settings.embedding_cache_backend == "redis":
+        return RedisEmbeddingCache(settings.embedding_cache_redis_url, settings.embedding_cache_ttl)
+    return None
@@ -1,9 +1,14 @@
+import queue
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List
+from concurrent.futures import Future
+from typing import Callable, Generic, List, Optional, Tuple, TypeVar
 
 import numpy as np
-import requests
-from sentence_transformers import SentenceTransformer
+
+from .http_client import HttpClient
+from .onnx_embedding import OnnxEmbeddingModel
 
 
 class EmbeddingProvider(ABC):
@@ -14,6 +19,9 @@ class EmbeddingProvider(ABC):
 
 class SentenceTransformersEmbeddingProvider(EmbeddingProvider):
     def __init__(self, model_name: str) -> None:
+        # torch импортируется только для этого провайдера: с onnx он не нужен
+        from sentence_transformers import SentenceTransformer
+
         self._model = SentenceTransformer(model_name)
 
     def embed(self, texts: List[str]) -> np.ndarray:
@@ -21,12 +29,19 @@ class SentenceTransformersEmbeddingProvider(EmbeddingProvider):
         return np.asarray(embeddings, dtype="float32")
 
 
+class OnnxEmbeddingProvider(OnnxEmbeddingModel, EmbeddingProvider):
+    """ONNX Runtime на CPU; реализация общая со сборкой индекса (onnx_embedding.py)"""
+
+
 class HttpEmbeddingProvider(EmbeddingProvider):
-    def __init__(self, url: str) -> None:
+    def __init__(self, url: str, client: HttpClient) -> None:
         self._url = url.rstrip("/")
+        self._client = client
 
     def embed(self, texts: List[str]) -> np.ndarray:
-        response = requests.post(
+        response = self._client.request_sync(
+            "embeddings",
+            "POST",
             f"{self._url}/embeddings",
             json={"input": texts},
             timeout=60,
@@ -37,7 +52,113 @@ class HttpEmbeddingProvider(EmbeddingProvider):
         return np.asarray(vectors, dtype="float32")
 
 
-def get_provider(provider: str, model: str, http_url: str) -> EmbeddingProvider:
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """Собирает одиночные вызовы из разных потоков в пакеты.
+
+    Пакет закрывается через window секунд после первого элемента или при max_batch
+    элементах и целиком передается в fn одним вызовом в фоновом потоке.
+    """
+
+    def __init__(self, fn: Callable[[List[T]], List[R]], window: float, max_batch: int, name: str) -> None:
+        self._fn = fn
+        self._window = window
+        self._max_batch = max_batch
+        self._name = name
+        self._queue: "queue.Queue[Optional[Tuple[T, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: T) -> "Future[R]":
+        self._ensure_thread()
+        future: "Future[R]" = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+
+    def _collect(self, first: Tuple[T, Future]) -> List[Tuple[T, Future]]:
+        batch = [first]
+        deadline = time.monotonic() + self._window
+        while len(batch) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if pending is None:
+                self._queue.put(None)
+                break
+            batch.append(pending)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            try:
+                results = self._fn([item for item, _ in batch])
+            except BaseException as exc:
+                for _, future in batch:
+                    future.set_exception(exc)
+                continue
+            if len(results) != len(batch):
+                # Иначе zip молча обрежет пакет, и часть вызывающих будет ждать вечно
+                error = RuntimeError(f"{self._name}: {len(results)} результатов на пакет из {len(batch)}")
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class BatchingEmbeddingProvider(EmbeddingProvider):
+    """Склеивает конкурентные embed() в один encode: модель вызывается из одного потока"""
+
+    def __init__(self, inner: EmbeddingProvider, window: float, max_batch: int) -> None:
+        self._inner = inner
+        self._batcher: MicroBatcher[str, np.ndarray] = MicroBatcher(
+            lambda texts: list(self._inner.embed(texts)), window, max_batch, "embedding-batcher"
+        )
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return self._inner.embed(texts)
+        futures = [self._batcher.submit(text) for text in texts]
+        return np.vstack([future.result() for future in futures]).astype("float32", copy=False)
+
+
+def get_provider(
+    provider: str,
+    model: str,
+    http_url: str,
+    http_client: Optional[HttpClient] = None,
+    onnx_path: str = "",
+    onnx_threads: int = 0,
+) -> EmbeddingProvider:
     if provider == "http":
-        return HttpEmbeddingProvider(http_url)
+        if http_client is None:
+            raise ValueError("HTTP-провайдеру эмбеддингов нужен общий HttpClient")
+        return HttpEmbeddingProvider(http_url, http_client)
+    if provider == "onnx":
+        return OnnxEmbeddingProvider(onnx_path, model, onnx_threads)
     return SentenceTransformersEmbeddingProvider(model)
@@ -1,15 +1,27 @@
 from __future__ import annotations
 
 import json
+import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
 import faiss
 import numpy as np
 
 from .config import Settings
-from .embeddings import EmbeddingProvider, get_provider
+from .embedding_cache import CachedEmbeddingProvider, embedding_namespace, get_shared_cache
+from .embeddings import BatchingEmbeddingProvider, EmbeddingProvider, MicroBatcher, get_provider
+from .http_client import HttpClient
+from .id_map import IdMap, open_id_map
+
+logger = logging.getLogger("upvs.api")
+
+# Пробный запрос прогрева: проходит токенизатор, модель и index.search
+WARMUP_QUERY = "прогрев индекса"
 
 
 @dataclass
@@ -21,54 +33,284 @@ class FaissHit:
     section_path: List[str]
     source_order: int
     text_preview: str
+    generation: str = ""
+
+
+@dataclass
+class _GenerationPaths:
+    name: str
+    index: str
+    map_bin: str
+    map_jsonl: str
+    meta: str
+
+
+@dataclass
+class _Generation:
+    name: str
+    index: faiss.Index
+    id_map: IdMap
+    # Запросы, которые сейчас ищут по этому поколению
+    refs: int = 0
+    retired: bool = False
+    closed: bool = False
 
 
 class FaissStore:
-    def __init__(self, settings: Settings) -> None:
+    def __init__(self, settings: Settings, http_client: HttpClient | None = None) -> None:
         self._settings = settings
-        self._index: faiss.Index | None = None
-        self._id_map: List[Dict[str, object]] | None = None
+        self._http_client = http_client
+        # Поколение индекса (индекс + id_map) подменяется целиком; старое закрывается,
+        # когда на нем закончатся начатые запросы
+        self._current: _Generation | None = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+        self._stop_watcher = threading.Event()
         self._provider: EmbeddingProvider | None = None
-
-    def _load_index(self) -> None:
-        if self._index is not None:
-            return
-        if not os.path.exists(self._settings.faiss_index_path):
-            raise FileNotFoundError(
-                f"FAISS индекс не найден: {self._settings.faiss_index_path}"
+        self._model: EmbeddingProvider | None = None
+        self._provider_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._warmup_error: str | None = None
+        self._warmup_duration: float | None = None
+        # Конкурентные search() склеиваются в один search_many
+        self._search_batcher: MicroBatcher[Tuple[str, int], List[FaissHit]] | None = None
+        if settings.search_batch_window_ms > 0:
+            self._search_batcher = MicroBatcher(
+                self._search_batch,
+                settings.search_batch_window_ms / 1000,
+                settings.search_batch_max_size,
+                "faiss-search-batcher",
             )
-        if not os.path.exists(self._settings.faiss_map_path):
-            raise FileNotFoundError(
-                f"FAISS mapping не найден: {self._settings.faiss_map_path}"
+
+    def _resolve(self) -> _GenerationPaths:
+        """Файлы поколения, на которое указывает current; без него — старая раскладка FAISS_*_PATH"""
+        current = self._settings.faiss_current_path
+        if current and os.path.exists(current):
+            directory = os.path.realpath(current)
+            return _GenerationPaths(
+                os.path.basename(directory),
+                os.path.join(directory, "index.faiss"),
+                os.path.join(directory, "id_map.bin"),
+                os.path.join(directory, "id_map.jsonl"),
+                os.path.join(directory, "meta.json"),
             )
-        self._index = faiss.read_index(self._settings.faiss_index_path)
-        self._id_map = []
-        with open(self._settings.faiss_map_path, "r", encoding="utf-8") as handle:
-            for line in handle:
-                if line.strip():
-                    self._id_map.append(json.loads(line))
+        try:
+            # Сборка без поколений: версия — время и размер meta.json
+            stat = os.stat(self._settings.faiss_meta_path)
+            name = f"legacy-{stat.st_mtime_ns}-{stat.st_size}"
+        except FileNotFoundError:
+            name = "legacy"
+        return _GenerationPaths(
+            name,
+            self._settings.faiss_index_path,
+            self._settings.faiss_map_bin_path,
+            self._settings.faiss_map_path,
+            self._settings.faiss_meta_path,
+        )
+
+    def _read_generation(self, paths: _GenerationPaths) -> _Generation:
+        if not os.path.exists(paths.index):
+            raise FileNotFoundError(f"FAISS индекс не найден: {paths.index}")
+        if not os.path.exists(paths.map_bin) and not os.path.exists(paths.map_jsonl):
+            raise FileNotFoundError(f"FAISS mapping не найден: {paths.map_jsonl}")
+        index = faiss.read_index(paths.index)
+        # id_map.bin читается через mmap, id_map.jsonl — запасной вариант для старых сборок
+        id_map = open_id_map(paths.map_bin, paths.map_jsonl)
+        self._apply_runtime_params(index, paths.meta)
+        return _Generation(paths.name, index, id_map)
+
+    def reload(self) -> Dict[str, object]:
+        """Загружает поколение, на которое указывает current, рядом с текущим и переключает на него"""
+        with self._load_lock:
+            paths = self._resolve()
+            previous = self._current
+            if previous is not None and previous.name == paths.name:
+                return {"generation": paths.name, "reloaded": False}
+            generation = self._read_generation(paths)
+            with self._lock:
+                self._current = generation
+                close_previous = previous is not None and self._retire(previous)
+            if previous is not None:
+                logger.info("FAISS: поколение %s сменило %s", generation.name, previous.name)
+            if close_previous:
+                self._close(previous)
+            return {
+                "generation": generation.name,
+                "reloaded": True,
+                "previous": previous.name if previous is not None else None,
+            }
+
+    def _retire(self, generation: _Generation) -> bool:
+        """Под self._lock: помечает поколение старым; True — запросов на нем нет, можно закрыть"""
+        generation.retired = True
+        if generation.refs == 0 and not generation.closed:
+            generation.closed = True
+            return True
+        return False
+
+    def _close(self, generation: _Generation) -> None:
+        generation.id_map.close()
+        generation.index = None
+        logger.info("FAISS: поколение %s освобождено", generation.name)
+
+    @contextmanager
+    def _lease(self) -> Iterator[_Generation]:
+        """Текущее поколение на время запроса: подмена индекса не освободит его раньше"""
+        with self._lock:
+            generation = self._current
+            if generation is not None:
+                generation.refs += 1
+        if generation is None:
+            self.reload()
+            with self._lock:
+                generation = self._current
+                generation.refs += 1
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                generation.refs -= 1
+                close = generation.retired and generation.refs == 0 and not generation.closed
+                if close:
+                    generation.closed = True
+            if close:
+                self._close(generation)
+
+    def start_watcher(self) -> None:
+        """Фоновая проверка current каждые faiss_reload_interval секунд"""
+        interval = self._settings.faiss_reload_interval
+        if interval <= 0 or self._watcher is not None:
+            return
+        self._stop_watcher.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="faiss-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self) -> None:
+        if self._watcher is not None:
+            self._stop_watcher.set()
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval: float) -> None:
+        while not self._stop_watcher.wait(interval):
+            try:
+                if self._ready.is_set():
+                    self.reload()
+                else:
+                    # Стартовый прогрев не удался (индекса еще не было): /ready станет 200 после первого успеха
+                    self.warm_up()
+            except Exception as exc:
+                # Сборка еще не готова или упала — продолжаем на прежнем поколении
+                logger.warning("Не удалось загрузить новое поколение FAISS: %s", exc)
+
+    def generations(self) -> Dict[str, object]:
+        with self._lock:
+            current = self._current
+            return {
+                "current": current.name if current is not None else None,
+                "in_flight": current.refs if current is not None else 0,
+            }
+
+    def _runtime_params(self, meta_path: str) -> Dict[str, int]:
+        params: Dict[str, int] = {}
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as handle:
+                params.update(json.load(handle).get("runtime") or {})
+        if self._settings.faiss_nprobe is not None:
+            params["nprobe"] = self._settings.faiss_nprobe
+        if self._settings.faiss_ef_search is not None:
+            params["efSearch"] = self._settings.faiss_ef_search
+        return params
+
+    def _apply_runtime_params(self, index: faiss.Index, meta_path: str) -> None:
+        space = faiss.ParameterSpace()
+        for name, value in self._runtime_params(meta_path).items():
+            try:
+                space.set_index_parameter(index, name, value)
+            except RuntimeError as exc:
+                # Например, nprobe из env для плоского индекса
+                logger.warning("FAISS параметр %s=%s не применен: %s", name, value, exc)
 
     def _get_provider(self) -> EmbeddingProvider:
-        if self._provider is None:
-            self._provider = get_provider(
+        provider = self._provider
+        if provider is not None:
+            return provider
+        # Модель грузится секунды: конкурентные первые запросы ждут одну загрузку
+        with self._provider_lock:
+            if self._provider is not None:
+                return self._provider
+            provider = get_provider(
                 self._settings.embeddings_provider,
                 self._settings.embeddings_model,
                 self._settings.vllm_url,
+                self._http_client,
+                self._settings.embeddings_onnx_path,
+                self._settings.embeddings_onnx_threads,
             )
-        return self._provider
+            self._model = provider
+            if self._settings.embedding_batch_window_ms > 0:
+                provider = BatchingEmbeddingProvider(
+                    provider,
+                    self._settings.embedding_batch_window_ms / 1000,
+                    self._settings.embedding_batch_max_size,
+                )
+            if self._settings.embedding_cache_size > 0:
+                provider = CachedEmbeddingProvider(
+                    provider,
+                    embedding_namespace(self._settings),
+                    self._settings.embedding_cache_size,
+                    self._settings.embedding_cache_ttl,
+                    get_shared_cache(self._settings),
+                )
+            self._provider = provider
+            return provider
 
-    def search(self, query: str, top_k: int) -> List[FaissHit]:
-        self._load_index()
-        assert self._index is not None
-        assert self._id_map is not None
-        provider = self._get_provider()
-        embeddings = provider.embed([query])
-        scores, indices = self._index.search(embeddings, top_k)
+    def warm_up(self) -> float:
+        """Загружает индекс, id_map и модель и прогоняет пробный запрос; возвращает длительность"""
+        start = time.perf_counter()
+        try:
+            self._get_provider()
+            # Мимо кэша эмбеддингов: из общего кэша запрос не дошел бы до модели
+            vector = self._model.embed([WARMUP_QUERY])
+            with self._lease() as generation:
+                generation.index.search(vector, 1)
+        except Exception as exc:
+            self._warmup_error = str(exc)
+            raise
+        self._warmup_error = None
+        self._warmup_duration = time.perf_counter() - start
+        self._ready.set()
+        return self._warmup_duration
+
+    def readiness(self) -> Dict[str, object]:
+        current = self._current
+        return {
+            "ready": self._ready.is_set(),
+            "index_generation": current.name if current is not None else None,
+            "warmup_duration": self._warmup_duration,
+            "error": self._warmup_error,
+        }
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self._get_provider().embed(texts)
+
+    def index_version(self) -> str:
+        """Поколение индекса, которое сейчас обслуживает поиск"""
+        current = self._current
+        return current.name if current is not None else "none"
+
+    def cache_stats(self) -> Dict[str, object] | None:
+        if isinstance(self._provider, CachedEmbeddingProvider):
+            return self._provider.stats()
+        return None
+
+    def _hits_from_row(self, generation: _Generation, scores: np.ndarray, labels: np.ndarray) -> List[FaissHit]:
         hits: List[FaissHit] = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < 0 or idx >= len(self._id_map):
+        for score, row in zip(scores, generation.id_map.rows_for_labels(labels)):
+            if row < 0:
                 continue
-            record = self._id_map[idx]
+            record = generation.id_map.record(int(row))
             hits.append(
                 FaissHit(
                     chunk_id=str(record["chunk_id"]),
@@ -78,6 +320,27 @@ class FaissStore:
                     section_path=record.get("section_path", []),
                     source_order=int(record.get("source_order", 0)),
                     text_preview=str(record.get("text_preview", "")),
+                    generation=generation.name,
                 )
             )
         return hits
+
+    def search_many(self, queries: List[str], top_k: int) -> List[List[FaissHit]]:
+        """Один embed и один матричный index.search на весь список запросов"""
+        if not queries:
+            return []
+        provider = self._get_provider()
+        embeddings = provider.embed(queries)
+        with self._lease() as generation:
+            scores, labels = generation.index.search(embeddings, top_k)
+            return [self._hits_from_row(generation, scores[row], labels[row]) for row in range(len(queries))]
+
+    def _search_batch(self, requests: List[Tuple[str, int]]) -> List[List[FaissHit]]:
+        max_k = max(top_k for _, top_k in requests)
+        results = self.search_many([query for query, _ in requests], max_k)
+        return [hits[:top_k] for hits, (_, top_k) in zip(results, requests)]
+
+    def search(self, query: str, top_k: int) -> List[FaissHit]:
+        if self._search_batcher is not None:
+            return self._search_batcher.submit((query, top_k)).result()
+        return self.search_many([query], top_k)[0]
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+from .config import Settings
+
+logger = logging.getLogger("upvs.api")
+
+# Ответы, после которых повтор безопасен и имеет смысл
+RETRY_STATUSES = {502, 503, 504}
+
+# Запрос не ушел на сервер: повтор безопасен, для вызывающего это «сервис недоступен»
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(httpx.ConnectError):
+    """Сервис помечен недоступным: запрос не отправлялся.
+
+    Наследуется от ConnectError, чтобы вызывающий код шел в ту же ветку,
+    что и при отказе соединения.
+    """
+
+
+class CircuitBreaker:
+    """closed -> open после failure_threshold ошибок подряд; через reset_timeout — одна пробная попытка"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    def before_request(self) -> bool:
+        """Пропускает запрос или бросает CircuitOpenError; True — это пробный запрос после open"""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self._reset_timeout or self._trial_in_flight:
+                raise CircuitOpenError(f"{self.name}: сервис временно помечен недоступным")
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """Пробный запрос прерван без ответа (отмена, ошибка до отправки): следующий вызов пробует снова"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self._failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("%s: circuit breaker открыт после %s ошибок", self.name, self._failures)
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def state(self) -> Dict[str, object]:
+        with self._lock:
+            if self._opened_at is None:
+                state = "closed"
+            elif time.monotonic() - self._opened_at >= self._reset_timeout:
+                state = "half_open"
+            else:
+                state = "open"
+            return {"state": state, "consecutive_failures": self._failures}
+
+
+class HttpClient:
+    """Общий keep-alive клиент (HTTP/1.1 + HTTP/2) для vLLM и HTTP-эмбеддингов.
+
+    Создается и закрывается в lifespan приложения. Для кода в потоках threadpool
+    есть request_sync, который выполняет запрос в event loop приложения.
+    """
+
+    def __init__(self, settings: Settings) -> None:
+        self._settings = settings
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    async def start(self) -> None:
+        self._client = httpx.AsyncClient(
+            http2=self._settings.http_http2,
+            limits=httpx.Limits(
+                max_connections=self._settings.http_max_connections,
+                max_keepalive_connections=self._settings.http_max_keepalive,
+                keepalive_expiry=self._settings.http_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                self._settings.http_timeout, connect=self._settings.http_connect_timeout
+            ),
+        )
+        self._loop = asyncio.get_running_loop()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def breaker(self, service: str) -> CircuitBreaker:
+        if service not in self._breakers:
+            self._breakers[service] = CircuitBreaker(
+                service,
+                self._settings.breaker_failure_threshold,
+                self._settings.breaker_reset_timeout,
+            )
+        return self._breakers[service]
+
+    def _backoff(self, attempt: int) -> float:
+        # Экспоненциальная задержка с full jitter
+        return random.uniform(0, self._settings.http_retry_backoff * (2 ** attempt))
+
+    def _require_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("HttpClient не запущен")
+        return self._client
+
+    async def request(self, service: str, method: str, url: str, **kwargs: object) -> httpx.Response:
+        client = self._require_client()
+        breaker = self.breaker(service)
+        attempts = self._settings.http_retries + 1
+        for attempt in range(attempts):
+            trial = breaker.before_request()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except NOT_SENT_ERRORS:
+                # Запрос не ушел на сервер — повтор безопасен
+                breaker.record_failure()
+                if attempt + 1 >= attempts or breaker.is_open:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except httpx.TransportError:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # Отмена (клиент отключился) или не транспортная ошибка: о сервисе ничего не узнали
+                if trial:
+                    breaker.release_trial()
+                raise
+            if response.status_code in RETRY_STATUSES:
+                breaker.record_failure()
+                if attempt + 1 < attempts and not breaker.is_open:
+                    await response.aclose()
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+                return response
+            breaker.record_success()
+            return response
+        raise AssertionError("unreachable")
+
+    @asynccontextmanager
+    async def stream(self, service: str, method: str, url: str, **kwargs: object) -> AsyncIterator[httpx.Response]:
+        """Потоковый запрос; повторяется только установка соединения"""
+        client = self._require_client()
+        breaker = self.breaker(service)
+        attempts = self._settings.http_retries + 1
+        for attempt in range(attempts):
+            trial = breaker.before_request()
+            try:
+                request = client.build_request(method, url, **kwargs)
+                response = await client.send(request, stream=True)
+            except NOT_SENT_ERRORS:
+                breaker.record_failure()
+                if attempt + 1 >= attempts or breaker.is_open:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except httpx.TransportError:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                if trial:
+                    breaker.release_trial()
+                raise
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            try:
+                yield response
+            finally:
+                await response.aclose()
+            return
+
+    def request_sync(self, service: str, method: str, url: str, **kwargs: object) -> httpx.Response:
+        """Запрос из рабочего потока (не из event loop) через общий клиент"""
+        if self._loop is None:
+            raise RuntimeError("HttpClient не запущен")
+        future = asyncio.run_coroutine_threadsafe(self.request(service, method, url, **kwargs), self._loop)
+        return future.result()
+
+    def stats(self) -> Dict[str, object]:
+        return {name: breaker.state() for name, breaker in self._breakers.items()}
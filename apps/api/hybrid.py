@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from .db import AsyncDatabase
+from .faiss_store import FaissHit
+
+# Выражения должны совпадать с GIN-индексами idx_*_fts из CREATE_SQL, иначе индекс не используется.
+# websearch_to_tsquery требует все слова запроса (кавычки, or и -слово тоже работают): с OR одно частое
+# слово отдавало на ts_rank_cd большую часть text_chunks на каждый /search. Полноту дает векторная ветка.
+LEXICAL_SQL = """
+WITH q AS (
+    SELECT u.n, websearch_to_tsquery('russian', u.query_text) AS query
+    FROM unnest(%s::text[]) WITH ORDINALITY AS u(query_text, n)
+),
+text_hits AS (
+    SELECT q.n, 'text' AS source, h.chunk_id, h.rank
+    FROM q CROSS JOIN LATERAL (
+        SELECT c.chunk_id, ts_rank_cd(to_tsvector('russian', coalesce(c.text, '')), q.query) AS rank
+        FROM text_chunks c
+        WHERE to_tsvector('russian', coalesce(c.text, '')) @@ q.query
+        ORDER BY rank DESC, c.chunk_id
+        LIMIT %s
+    ) h
+),
+title_hits AS (
+    SELECT q.n, 'title' AS source, h.chunk_id, h.rank
+    FROM q CROSS JOIN LATERAL (
+        SELECT head.chunk_id, ts_rank_cd(to_tsvector('russian', coalesce(p.title, '')), q.query) AS rank
+        FROM pages p
+        JOIN LATERAL (
+            SELECT chunk_id
+            FROM text_chunks
+            WHERE text_chunks.page_id = p.page_id
+            ORDER BY text_chunks.source_order
+            LIMIT 1
+        ) head ON TRUE
+        WHERE to_tsvector('russian', coalesce(p.title, '')) @@ q.query
+        ORDER BY rank DESC, head.chunk_id
+        LIMIT %s
+    ) h
+),
+caption_hits AS (
+    SELECT q.n, 'caption' AS source, h.chunk_id, h.rank
+    FROM q CROSS JOIN LATERAL (
+        SELECT nearest.chunk_id, ts_rank_cd(to_tsvector('russian', coalesce(t.caption, '')), q.query) AS rank
+        FROM tables t
+        JOIN LATERAL (
+            SELECT chunk_id
+            FROM text_chunks
+            WHERE text_chunks.page_id = t.page_id
+            ORDER BY abs(text_chunks.source_order - t.source_order), text_chunks.source_order
+            LIMIT 1
+        ) nearest ON TRUE
+        WHERE to_tsvector('russian', coalesce(t.caption, '')) @@ q.query
+        ORDER BY rank DESC, nearest.chunk_id
+        LIMIT %s
+    ) h
+),
+hits AS (
+    SELECT * FROM text_hits
+    UNION ALL SELECT * FROM title_hits
+    UNION ALL SELECT * FROM caption_hits
+)
+SELECT h.n, h.source, h.rank, c.chunk_id, c.page_id, c.section_path, c.source_order,
+       left(c.text, 240) AS text_preview, p.url
+FROM hits h
+JOIN text_chunks c ON c.chunk_id = h.chunk_id
+LEFT JOIN pages p ON p.page_id = c.page_id
+ORDER BY h.n, h.source, h.rank DESC, c.chunk_id
+"""
+
+LEXICAL_SOURCES = ("text", "title", "caption")
+
+
+class LexicalRetriever:
+    """Полнотекстовый поиск Postgres (конфигурация russian) по тексту чанков, заголовкам страниц
+    и подписям таблиц.
+
+    Совпадение в заголовке страницы дает ее первый чанк, в подписи таблицы — ближайший к таблице
+    чанк. Возвращает отдельный рейтинг на каждый источник, для слияния через RRF; запросы
+    пакета (/search/batch) обрабатываются одним SQL-запросом.
+    """
+
+    def __init__(self, adb: AsyncDatabase) -> None:
+        self._adb = adb
+
+    async def search(self, query: str, limit: int) -> Dict[str, List[FaissHit]]:
+        return (await self.search_many([query], limit))[0]
+
+    async def search_many(self, queries: List[str], limit: int) -> List[Dict[str, List[FaissHit]]]:
+        """Рейтинги для всего списка запросов одним SQL-запросом (unnest + LATERAL)"""
+        if not queries:
+            return []
+        rows = await self._adb.fetch_all(LEXICAL_SQL, (list(queries), limit, limit, limit))
+        results: List[Dict[str, List[FaissHit]]] = [
+            {source: [] for source in LEXICAL_SOURCES} for _ in queries
+        ]
+        seen: Set[Tuple[int, str, str]] = set()
+        for row in rows:
+            position = int(row["n"]) - 1
+            source = row["source"]
+            # Несколько таблиц рядом с одним чанком: в рейтинге остается лучшая
+            key = (position, source, row["chunk_id"])
+            if key in seen:
+                continue
+            seen.add(key)
+            results[position][source].append(
+                FaissHit(
+                    chunk_id=row["chunk_id"],
+                    page_id=row["page_id"],
+                    url=row.get("url") or "",
+                    score=float(row["rank"]),
+                    section_path=row.get("section_path") or [],
+                    source_order=int(row.get("source_order") or 0),
+                    text_preview=row.get("text_preview") or "",
+                )
+            )
+        return results
+
+
+@dataclass
+class FusedHit:
+    hit: FaissHit
+    score: float
+    vector_score: Optional[float] = None
+    lexical_score: Optional[float] = None
+
+
+def reciprocal_rank_fusion(
+    vector_hits: Sequence[FaissHit], lexical: Dict[str, List[FaissHit]], k: int = 60
+) -> List[FusedHit]:
+    """RRF: сумма 1 / (k + место) по всем рейтингам; шкалы косинуса и ts_rank не сравниваются"""
+    fused: Dict[str, FusedHit] = {}
+    for rank, hit in enumerate(vector_hits, start=1):
+        item = fused.setdefault(hit.chunk_id, FusedHit(hit=hit, score=0.0))
+        item.score += 1.0 / (k + rank)
+        if item.vector_score is None:
+            item.vector_score = hit.score
+    for hits in lexical.values():
+        for rank, hit in enumerate(hits, start=1):
+            # Для найденных обоими поисками остается хит FAISS: у него поколение индекса
+            item = fused.setdefault(hit.chunk_id, FusedHit(hit=hit, score=0.0))
+            item.score += 1.0 / (k + rank)
+            item.lexical_score = max(item.lexical_score or 0.0, hit.score)
+    return sorted(fused.values(), key=lambda item: (-item.score, item.hit.chunk_id))
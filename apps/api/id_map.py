@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import os
+import struct
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger("upvs.api")
+
+# Формат id_map.bin (пишется scripts/build_faiss/build_faiss.py):
+#   MAGIC (8 байт) | длина заголовка uint64 LE | JSON-заголовок | секции колонок, выровненные по 8 байт.
+# Строковая колонка — массив uint64 из count + 1 смещений в куче и сама куча UTF-8.
+# Числовая колонка — плотный массив фиксированной ширины.
+# Если индекс собран со стабильными id (IndexIDMap), есть колонка id и пара sorted_id/sorted_row
+# для перевода id из результатов поиска в номер строки бинарным поиском.
+MAGIC = b"UPVSIDM1"
+_HEADER_PREFIX = struct.Struct("<8sQ")
+
+
+class IdMap(ABC):
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def record(self, idx: int) -> Dict[str, object]:
+        raise NotImplementedError
+
+    def rows_for_labels(self, labels: np.ndarray) -> np.ndarray:
+        """Номера строк для меток из index.search; -1 — метки нет в карте"""
+        labels = np.asarray(labels, dtype="int64")
+        return np.where((labels >= 0) & (labels < len(self)), labels, -1)
+
+    def close(self) -> None:
+        pass
+
+
+class JsonlIdMap(IdMap):
+    """Старый формат: id_map.jsonl целиком в памяти процесса"""
+
+    def __init__(self, path: str) -> None:
+        self._records: List[Dict[str, object]] = []
+        with open(path, "r", encoding="utf-8") as handle:
+            for line in handle:
+                if line.strip():
+                    self._records.append(json.loads(line))
+        self._rows_by_id: Optional[Dict[int, int]] = None
+        if self._records and "id" in self._records[0]:
+            self._rows_by_id = {int(record["id"]): row for row, record in enumerate(self._records)}
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def record(self, idx: int) -> Dict[str, object]:
+        return self._records[idx]
+
+    def rows_for_labels(self, labels: np.ndarray) -> np.ndarray:
+        if self._rows_by_id is None:
+            return super().rows_for_labels(labels)
+        return np.array([self._rows_by_id.get(int(label), -1) for label in labels], dtype="int64")
+
+
+class MmapIdMap(IdMap):
+    """Колоночный id_map.bin, открытый через mmap: страницы делятся между воркерами через page cache"""
+
+    def __init__(self, path: str) -> None:
+        self._handle = open(path, "rb")
+        self._mm = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_len = _HEADER_PREFIX.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Неизвестный формат id_map: {path}")
+        header_start = _HEADER_PREFIX.size
+        header = json.loads(self._mm[header_start : header_start + header_len].decode("utf-8"))
+        self._count = int(header["count"])
+        self._strings: Dict[str, tuple] = {}
+        self._numbers: Dict[str, np.ndarray] = {}
+        for name, column in header["columns"].items():
+            if column["type"] == "str":
+                offsets = np.frombuffer(
+                    self._mm, dtype="<u8", count=self._count + 1, offset=column["offsets"]
+                )
+                self._strings[name] = (offsets, int(column["heap"]))
+            else:
+                self._numbers[name] = np.frombuffer(
+                    self._mm, dtype=column["type"], count=self._count, offset=column["offset"]
+                )
+
+    def __len__(self) -> int:
+        return self._count
+
+    def rows_for_labels(self, labels: np.ndarray) -> np.ndarray:
+        if "sorted_id" not in self._numbers:
+            return super().rows_for_labels(labels)
+        labels = np.asarray(labels, dtype="int64")
+        if self._count == 0:
+            return np.full(labels.shape, -1, dtype="int64")
+        sorted_ids = self._numbers["sorted_id"]
+        positions = np.minimum(np.searchsorted(sorted_ids, labels), self._count - 1)
+        found = (labels >= 0) & (sorted_ids[positions] == labels)
+        return np.where(found, self._numbers["sorted_row"][positions], -1)
+
+    def _string(self, name: str, idx: int) -> str:
+        offsets, heap = self._strings[name]
+        start = heap + int(offsets[idx])
+        end = heap + int(offsets[idx + 1])
+        return self._mm[start:end].decode("utf-8")
+
+    def record(self, idx: int) -> Dict[str, object]:
+        return {
+            "chunk_id": self._string("chunk_id", idx),
+            "page_id": self._string("page_id", idx),
+            "url": self._string("url", idx),
+            "section_path": json.loads(self._string("section_path", idx) or "[]"),
+            "source_order": int(self._numbers["source_order"][idx]),
+            "text_preview": self._string("text_preview", idx),
+        }
+
+    def close(self) -> None:
+        # Сначала отпускаем numpy-представления, иначе mmap не закроется
+        self._strings.clear()
+        self._numbers.clear()
+        try:
+            self._mm.close()
+        except BufferError:
+            # Представление еще держит чужой код: mmap освободит GC вместе с последней ссылкой
+            logger.warning("id_map: mmap занят представлением numpy, освобождение отложено до GC")
+        self._handle.close()
+
+
+def open_id_map(bin_path: str, jsonl_path: str) -> IdMap:
+    if bin_path and os.path.exists(bin_path):
+        return MmapIdMap(bin_path)
+    return JsonlIdMap(jsonl_path)
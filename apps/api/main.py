@@ -1,25 +1,97 @@
 from __future__ import annotations
 
+import asyncio
+import hmac
 import json
 import logging
-import re
 import time
-from typing import Dict, List
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
 
-import requests
-from fastapi import FastAPI, HTTPException
+import httpx
+import numpy as np
+import psycopg
+from fastapi import FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 
 from .config import get_settings
-from .db import Database
-from .faiss_store import FaissStore
+from .context_packer import ContextPacker
+from .data_version import DataVersion
+from .db import AsyncDatabase, Database
+from .faiss_store import FaissHit, FaissStore
+from .http_client import NOT_SENT_ERRORS, HttpClient
+from .hybrid import FusedHit, LexicalRetriever, reciprocal_rank_fusion
+from .navigation import NavigationTreeCache, subtree
+from .page_metadata import PageMetadataStore
+from .prompts import build_prompts
+from .rag_cache import RagAnswerCache, RagCacheKey
+from .reranker import Reranker, RerankResult
+from .retrieval import fetch_sources, fetch_sources_many, public_sources
 
 settings = get_settings()
 logger = logging.getLogger("upvs.api")
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="UPVS API")
+T = TypeVar("T")
+
+
+async def _warm_up_component(name: str, warm_up: Callable[[], float]) -> None:
+    """Прогрев одного компонента с повтором через WARMUP_RETRY_INTERVAL"""
+    while True:
+        try:
+            duration = await run_in_threadpool(warm_up)
+        except Exception as exc:
+            logger.warning("Прогрев %s не удался: %s", name, exc)
+            if settings.warmup_retry_interval <= 0:
+                return
+            await asyncio.sleep(settings.warmup_retry_interval)
+            continue
+        logger.info("Прогрев %s: %.2fs", name, duration)
+        return
+
+
+async def _warm_up() -> None:
+    """Фоновый прогрев; до готовности FAISS и модели эмбеддингов /ready отвечает 503.
+
+    Компоненты независимы: ошибка FAISS не откладывает модель переранжирования и токенизатор.
+    """
+    tasks = [_warm_up_component("FAISS и модели эмбеддингов", faiss_store.warm_up)]
+    if settings.context_tokenizer == "model":
+        # Токенизатор vLLM качается с HuggingFace Hub: пусть это будет не первый /rag
+        tasks.append(run_in_threadpool(lambda: context_packer.counter))
+    if reranker.enabled:
+        # Без модели переранжирования поиск работает, просто в исходном порядке
+        tasks.append(_warm_up_component("модели переранжирования", reranker.warm_up))
+    await asyncio.gather(*tasks)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    db.init_schema()
+    await adb.open()
+    await http_client.start()
+    # Сервер принимает запросы сразу, индекс и модель грузятся в фоне
+    warm_up = asyncio.create_task(_warm_up())
+    # Заголовки и подписи таблиц для /search: загрузка сейчас, затем после каждой смены версии данных
+    metadata_watcher = asyncio.create_task(
+        page_metadata.watch(max(settings.data_version_check_interval, 1.0))
+    )
+    faiss_store.start_watcher()
+    try:
+        yield
+    finally:
+        warm_up.cancel()
+        metadata_watcher.cancel()
+        await run_in_threadpool(faiss_store.stop_watcher)
+        await http_client.close()
+        await adb.close()
+        db.close()
+
+
+app = FastAPI(title="UPVS API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,7 +101,20 @@ app.add_middleware(
 )
 
 db = Database(settings)
-faiss_store = FaissStore(settings)
+adb = AsyncDatabase(settings)
+http_client = HttpClient(settings)
+faiss_store = FaissStore(settings, http_client)
+data_version = DataVersion(adb, faiss_store.index_version, settings.data_version_check_interval)
+navigation_cache = NavigationTreeCache(adb, data_version)
+page_metadata = PageMetadataStore(adb, data_version)
+lexical_retriever = LexicalRetriever(adb)
+reranker = Reranker(settings)
+context_packer = ContextPacker(settings.context_tokenizer, settings.vllm_model, settings.context_table_max_rows)
+rag_cache = (
+    RagAnswerCache(settings.rag_cache_size, settings.rag_cache_ttl, settings.rag_cache_similarity)
+    if settings.rag_cache_size > 0
+    else None
+)
 
 
 class SearchRequest(BaseModel):
@@ -43,6 +128,17 @@ class ContextRequest(BaseModel):
     tables_window: int = Field(default=2, ge=0, le=10)
 
 
+class SearchBatchRequest(BaseModel):
+    queries: List[str] = Field(min_length=1, max_length=settings.batch_max_queries)
+    top_k: int = Field(default=8, ge=1, le=50)
+
+
+class ContextBatchRequest(BaseModel):
+    queries: List[str] = Field(min_length=1, max_length=settings.batch_max_queries)
+    top_k: int = Field(default=8, ge=1, le=50)
+    tables_window: int = Field(default=2, ge=0, le=10)
+
+
 class RagRequest(BaseModel):
     query: str
     top_k: int = Field(default=8, ge=1, le=50)
@@ -51,20 +147,53 @@ class RagRequest(BaseModel):
     max_tokens: int = Field(default=800, ge=64, le=2048)
 
 
-@app.on_event("startup")
-def on_startup() -> None:
-    db.init_schema()
-
-
 @app.get("/health")
 def health() -> Dict[str, str]:
     return {"status": "ok"}
 
 
+@app.get("/ready")
+def ready() -> JSONResponse:
+    """Готовность к трафику: индекс, id_map и модель загружены и прогреты"""
+    state = faiss_store.readiness()
+    # Переранжирование на готовность не влияет: без него поиск отдает исходный порядок
+    return JSONResponse(
+        {"status": "ready" if state["ready"] else "warming_up", **state, "reranker": reranker.readiness()},
+        status_code=200 if state["ready"] else 503,
+    )
+
+
+@app.get("/metrics")
+def metrics() -> Dict[str, object]:
+    return {
+        "faiss": faiss_store.generations(),
+        "embedding_cache": faiss_store.cache_stats(),
+        "reranker": reranker.stats(),
+        "page_metadata": page_metadata.stats(),
+        "rag_cache": rag_cache.stats() if rag_cache is not None else None,
+        "circuit_breakers": http_client.stats(),
+    }
+
+
+@app.post("/admin/index/reload")
+def reload_index(x_admin_token: str = Header(default="")) -> Dict[str, object]:
+    """Переключает поиск на поколение индекса, на которое сейчас указывает current"""
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail="Admin API выключен: задайте ADMIN_TOKEN")
+    if not hmac.compare_digest(x_admin_token.encode("utf-8"), settings.admin_token.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Неверный X-Admin-Token")
+    try:
+        return faiss_store.reload()
+    except Exception as exc:
+        raise HTTPException(
+            status_code=500, detail=f"Поколение не загружено, поиск остается на прежнем: {exc}"
+        ) from exc
+
+
 @app.get("/pages")
-def list_pages(query: str = "", limit: int = 20, offset: int = 0) -> Dict[str, object]:
+async def list_pages(query: str = "", limit: int = 20, offset: int = 0) -> Dict[str, object]:
     if query:
-        rows = db.fetch_all(
+        rows = await adb.fetch_all(
             """
             SELECT page_id, url, title, fetched_at
             FROM pages
@@ -75,7 +204,7 @@ def list_pages(query: str = "", limit: int = 20, offset: int = 0) -> Dict[str, o
             (f"%{query}%", limit, offset),
         )
     else:
-        rows = db.fetch_all(
+        rows = await adb.fetch_all(
             """
             SELECT page_id, url, title, fetched_at
             FROM pages
@@ -177,57 +306,36 @@ def get_neighbors(page_id: str, depth: int = 1, limit: int = 20) -> Dict[str, ob
 
 
 @app.get("/navigation/tree")
-def get_navigation_tree() -> Dict[str, object]:
-    """Возвращает дерево навигации на основе parent_url"""
-    all_pages = db.fetch_all(
-        """
-        SELECT page_id, url, title, parent_url
-        FROM pages
-        WHERE title IS NOT NULL
-        ORDER BY url
-        """,
-        (),
-    )
-    
-    # Создаем словарь всех страниц
-    pages_by_url: Dict[str, Dict[str, object]] = {}
-    pages_by_id: Dict[str, Dict[str, object]] = {}
-    for page in all_pages:
-        url = page["url"]
-        page_id = page["page_id"]
-        pages_by_url[url] = page
-        pages_by_id[page_id] = page
-        page["children"] = []
-    
-    # Строим дерево
-    root_pages = []
-    for page in all_pages:
-        parent_url = page.get("parent_url")
-        if parent_url and parent_url in pages_by_url:
-            parent = pages_by_url[parent_url]
-            if "children" not in parent:
-                parent["children"] = []
-            parent["children"].append(page)
-        else:
-            root_pages.append(page)
-    
-    # Сортируем детей по title
-    def sort_children(node: Dict[str, object]) -> None:
-        if "children" in node and node["children"]:
-            node["children"].sort(key=lambda x: x.get("title", "") or "")
-            for child in node["children"]:
-                sort_children(child)
-    
-    for root in root_pages:
-        sort_children(root)
-    
-    return {"tree": root_pages}
+async def get_navigation_tree(
+    request: Request,
+    root: Optional[str] = None,
+    depth: Optional[int] = Query(default=None, ge=0),
+) -> Response:
+    """Возвращает дерево навигации на основе parent_url (целиком или поддерево root до глубины depth)"""
+    tree = await navigation_cache.get()
+    etag = tree.etag(root, depth)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if root is None and depth is None:
+        # Полное дерево сериализовано один раз на версию данных
+        return Response(content=tree.body, media_type="application/json", headers=headers)
+
+    if root is None:
+        nodes = tree.roots
+    else:
+        node = tree.by_id.get(root)
+        if node is None:
+            raise HTTPException(status_code=404, detail="Страница не найдена")
+        nodes = [node]
+    return JSONResponse({"tree": [subtree(node, depth) for node in nodes]}, headers=headers)
 
 
 @app.get("/navigation/page/{page_id}")
-def get_page_navigation(page_id: str) -> Dict[str, object]:
+async def get_page_navigation(page_id: str) -> Dict[str, object]:
     """Возвращает навигацию для конкретной страницы: родители, соседи, дети"""
-    page = db.fetch_one(
+    page = await adb.fetch_one(
         """
         SELECT page_id, url, title, parent_url, breadcrumbs
         FROM pages
@@ -241,7 +349,7 @@ def get_page_navigation(page_id: str) -> Dict[str, object]:
     # Получаем родительскую страницу
     parent = None
     if page.get("parent_url"):
-        parent = db.fetch_one(
+        parent = await adb.fetch_one(
             "SELECT page_id, url, title FROM pages WHERE url = %s",
             (page["parent_url"],),
         )
@@ -249,7 +357,7 @@ def get_page_navigation(page_id: str) -> Dict[str, object]:
     # Получаем соседние страницы (дети того же родителя)
     siblings = []
     if page.get("parent_url"):
-        siblings = db.fetch_all(
+        siblings = await adb.fetch_all(
             """
             SELECT page_id, url, title
             FROM pages
@@ -260,7 +368,7 @@ def get_page_navigation(page_id: str) -> Dict[str, object]:
         )
     
     # Получаем дочерние страницы
-    children = db.fetch_all(
+    children = await adb.fetch_all(
         """
         SELECT page_id, url, title
         FROM pages
@@ -304,362 +412,689 @@ def _boost_score_by_keywords(score: float, text: str, title: str, query: str) ->
     return min(score + boost, 1.0)  # Ограничиваем максимумом 1.0
 
 
-@app.post("/search")
-def search(req: SearchRequest) -> Dict[str, object]:
-    start = time.perf_counter()
+async def _timed(awaitable: Awaitable[T], timings: Dict[str, float], stage: str) -> T:
+    started = time.perf_counter()
     try:
-        # Увеличиваем top_k для семантического поиска, чтобы потом отфильтровать
-        semantic_hits = faiss_store.search(req.query, min(req.top_k * 2, 50))
-    except FileNotFoundError as exc:
-        raise HTTPException(status_code=500, detail=str(exc)) from exc
-    
-    page_ids = {hit.page_id for hit in semantic_hits}
-    titles: Dict[str, str] = {}
-    if page_ids:
-        rows = db.fetch_all(
-            "SELECT page_id, title FROM pages WHERE page_id = ANY(%s)", (list(page_ids),)
+        return await awaitable
+    finally:
+        timings[stage] = time.perf_counter() - started
+
+
+async def _lexical_search(queries: List[str], limit: int) -> List[Dict[str, List[FaissHit]]]:
+    """Полнотекстовый поиск; ошибка Postgres не ломает /search, остается выдача FAISS"""
+    try:
+        return await lexical_retriever.search_many(queries, limit)
+    except psycopg.Error as exc:
+        logger.warning("Полнотекстовый поиск не удался, только FAISS: %s", exc)
+        return [{} for _ in queries]
+
+
+async def _page_titles(page_ids: Set[str]) -> Dict[str, str]:
+    """Заголовки из снимка метаданных; в базу — только за страницами, которых в нем нет"""
+    snapshot = page_metadata.snapshot()
+    if snapshot is None:
+        titles: Dict[str, str] = {}
+        missing = page_ids
+    else:
+        titles, _, missing = snapshot.lookup(page_ids)
+    if missing:
+        rows = await adb.fetch_all(
+            "SELECT page_id, title FROM pages WHERE page_id = ANY(%s)", (list(missing),)
         )
-        titles = {row["page_id"]: row.get("title") for row in rows}
-    
-    # Получаем информацию о таблицах для каждой страницы
-    table_captions: Dict[str, List[str]] = {}
-    if page_ids:
-        table_rows = db.fetch_all(
+        titles.update((row["page_id"], row.get("title")) for row in rows)
+    return titles
+
+
+async def _table_captions(page_ids: Set[str]) -> Dict[str, List[str]]:
+    snapshot = page_metadata.snapshot()
+    if snapshot is None:
+        table_captions: Dict[str, List[str]] = {}
+        missing = page_ids
+    else:
+        _, table_captions, missing = snapshot.lookup(page_ids)
+    if missing:
+        rows = await adb.fetch_all(
             """
             SELECT DISTINCT page_id, caption
             FROM tables
             WHERE page_id = ANY(%s) AND caption IS NOT NULL
             """,
-            (list(page_ids),),
+            (list(missing),),
         )
-        for row in table_rows:
-            page_id = row["page_id"]
-            if page_id not in table_captions:
-                table_captions[page_id] = []
-            table_captions[page_id].append(row.get("caption", ""))
-    
-    # Применяем буст на основе ключевых слов
+        for row in rows:
+            table_captions.setdefault(row["page_id"], []).append(row.get("caption", ""))
+    return table_captions
+
+
+def _rank_by_keywords(
+    query: str,
+    semantic_hits: List[FaissHit],
+    limit: int,
+    titles: Dict[str, str],
+    table_captions: Dict[str, List[str]],
+) -> List[FusedHit]:
+    """Режим без полнотекстового поиска: буст хитов FAISS по словам запроса"""
     boosted_hits = []
     for hit in semantic_hits:
         title = titles.get(hit.page_id, "")
         page_tables = " ".join(table_captions.get(hit.page_id, []))
         combined_text = f"{title} {page_tables} {hit.text_preview}"
-        
-        boosted_score = _boost_score_by_keywords(
-            hit.score, combined_text, title, req.query
-        )
+        boosted_score = _boost_score_by_keywords(hit.score, combined_text, title, query)
         boosted_hits.append((boosted_score, hit))
-    
+
     # Сортируем по новому score и берем top_k
     boosted_hits.sort(key=lambda x: x[0], reverse=True)
-    top_hits = [hit for _, hit in boosted_hits[:req.top_k]]
-    
-    duration = time.perf_counter() - start
-    logger.info("search duration=%.3fs query=%s", duration, req.query)
+    return [FusedHit(hit=hit, score=hit.score, vector_score=hit.score) for _, hit in boosted_hits[:limit]]
+
+
+def _search_candidates(top_k: int) -> Tuple[int, int]:
+    """Сколько хитов брать у FAISS и сколько отдавать cross-encoder"""
+    # Кандидатов больше top_k: их порядок еще меняет слияние (или буст по словам) и cross-encoder
+    return min(max(top_k * 2, reranker.candidates), 50), max(top_k, reranker.candidates)
+
+
+def _rerank_hits(
+    query: str, ranked: List[FusedHit], titles: Dict[str, str], top_k: int
+) -> Tuple[List[FusedHit], RerankResult]:
+    reranked = reranker.rerank(
+        query,
+        [f"{titles.get(item.hit.page_id) or ''}\n{item.hit.text_preview}" for item in ranked],
+        top_k,
+    )
+    ordered = [
+        FusedHit(
+            hit=ranked[i].hit,
+            score=reranked.scores.get(i, ranked[i].score),
+            vector_score=ranked[i].vector_score,
+            lexical_score=ranked[i].lexical_score,
+        )
+        for i in reranked.order
+    ]
+    return ordered, reranked
 
+
+def _hits_payload(ranked: List[FusedHit], titles: Dict[str, str]) -> List[Dict[str, object]]:
     result = []
-    for hit in top_hits:
+    for item in ranked:
+        hit = item.hit
         result.append(
             {
                 "chunk_id": hit.chunk_id,
                 "page_id": hit.page_id,
                 "url": hit.url,
-                "score": hit.score,
+                "score": item.score,
+                "vector_score": item.vector_score,
+                "lexical_score": item.lexical_score,
                 "section_path": hit.section_path,
                 "text_preview": hit.text_preview,
                 "title": titles.get(hit.page_id),
             }
         )
-    return {"hits": result, "duration": duration}
+    return result
 
 
-def _collect_tables(page_id: str, source_order: int, window: int) -> List[Dict[str, object]]:
-    tables = db.fetch_all(
-        """
-        SELECT table_id, source_order, caption, columns, rows
-        FROM tables
-        WHERE page_id = %s
-        """,
-        (page_id,),
+@app.post("/search")
+async def search(req: SearchRequest) -> Dict[str, object]:
+    start = time.perf_counter()
+    timings: Dict[str, float] = {}
+    candidates, pool = _search_candidates(req.top_k)
+    vector = _timed(run_in_threadpool(faiss_store.search, req.query, candidates), timings, "vector")
+    try:
+        if settings.search_hybrid:
+            # FAISS в threadpool и запрос к Postgres идут одновременно
+            semantic_hits, (lexical,) = await asyncio.gather(
+                vector, _timed(_lexical_search([req.query], candidates), timings, "lexical")
+            )
+        else:
+            semantic_hits, lexical = await vector, None
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=500, detail=str(exc)) from exc
+
+    if lexical is None:
+        page_ids = {hit.page_id for hit in semantic_hits}
+        titles, table_captions = await _timed(
+            asyncio.gather(_page_titles(page_ids), _table_captions(page_ids)), timings, "keywords"
+        )
+        ranked = _rank_by_keywords(req.query, semantic_hits, pool, titles, table_captions)
+    else:
+        fusion_started = time.perf_counter()
+        ranked = reciprocal_rank_fusion(semantic_hits, lexical, settings.search_rrf_k)[:pool]
+        timings["fusion"] = time.perf_counter() - fusion_started
+        titles = await _timed(_page_titles({item.hit.page_id for item in ranked}), timings, "titles")
+
+    ranked, reranked = await run_in_threadpool(_rerank_hits, req.query, ranked, titles, req.top_k)
+    if reranked.status != "disabled":
+        timings["rerank"] = reranked.duration
+
+    duration = time.perf_counter() - start
+    logger.info(
+        "search duration=%.3fs %s query=%s",
+        duration,
+        " ".join(f"{stage}={value:.3f}s" for stage, value in timings.items()),
+        req.query,
     )
-    if not tables:
-        return []
-    if window == 0:
-        nearest = min(tables, key=lambda t: abs(t["source_order"] - source_order))
-        return [nearest]
-    return [t for t in tables if abs(t["source_order"] - source_order) <= window]
 
+    generation = semantic_hits[0].generation if semantic_hits else faiss_store.index_version()
+    return {
+        "hits": _hits_payload(ranked, titles),
+        "duration": duration,
+        "timings": timings,
+        "rerank": reranked.status,
+        "index_generation": generation,
+    }
 
-@app.post("/context")
-def context(req: ContextRequest) -> Dict[str, object]:
+
+def _chunks(items: List[T], size: int) -> Iterator[Tuple[int, List[T]]]:
+    """Пакеты по size элементов со смещением первого"""
+    size = max(1, size)
+    for offset in range(0, len(items), size):
+        yield offset, items[offset : offset + size]
+
+
+def _ndjson(payload: Dict[str, object]) -> str:
+    return json.dumps(payload, ensure_ascii=False, default=str) + "\n"
+
+
+def _batch_errors(offset: int, queries: List[str], error: str) -> List[Dict[str, object]]:
+    return [{"index": offset + i, "query": query, "error": error} for i, query in enumerate(queries)]
+
+
+async def _search_chunk(offset: int, queries: List[str], top_k: int) -> List[Dict[str, object]]:
+    """Пакет /search/batch: один embed, один index.search, один полнотекстовый запрос
+    и один запрос заголовков на все запросы пакета; переранжирование — по запросу"""
+    start = time.perf_counter()
+    timings: Dict[str, float] = {}
+    candidates, pool = _search_candidates(top_k)
+    # Мимо микро-батчера faiss_store.search: пакет уже собран
+    vector = _timed(run_in_threadpool(faiss_store.search_many, queries, candidates), timings, "vector")
     try:
-        hits = faiss_store.search(req.query, req.top_k)
+        if settings.search_hybrid:
+            semantic, lexical = await asyncio.gather(
+                vector, _timed(_lexical_search(queries, candidates), timings, "lexical")
+            )
+        else:
+            semantic, lexical = await vector, None
     except FileNotFoundError as exc:
-        raise HTTPException(status_code=500, detail=str(exc)) from exc
-    sources = []
-    for hit in hits:
-        chunk = db.fetch_one(
-            """
-            SELECT chunk_id, page_id, section_path, text, source_order
-            FROM text_chunks
-            WHERE chunk_id = %s
-            """,
-            (hit.chunk_id,),
-        )
-        if not chunk:
-            continue
-        page = db.fetch_one(
-            "SELECT page_id, url, title FROM pages WHERE page_id = %s", (chunk["page_id"],)
+        return _batch_errors(offset, queries, str(exc))
+
+    if lexical is None:
+        page_ids = {hit.page_id for hits in semantic for hit in hits}
+        titles, table_captions = await _timed(
+            asyncio.gather(_page_titles(page_ids), _table_captions(page_ids)), timings, "keywords"
         )
-        tables = _collect_tables(chunk["page_id"], chunk["source_order"], req.tables_window)
-        sources.append(
+        ranked = [
+            _rank_by_keywords(query, hits, pool, titles, table_captions)
+            for query, hits in zip(queries, semantic)
+        ]
+    else:
+        fusion_started = time.perf_counter()
+        ranked = [
+            reciprocal_rank_fusion(hits, lexical_hits, settings.search_rrf_k)[:pool]
+            for hits, lexical_hits in zip(semantic, lexical)
+        ]
+        timings["fusion"] = time.perf_counter() - fusion_started
+        page_ids = {item.hit.page_id for items in ranked for item in items}
+        titles = await _timed(_page_titles(page_ids), timings, "titles")
+
+    rerank_started = time.perf_counter()
+    reranked = await run_in_threadpool(
+        lambda: [_rerank_hits(query, items, titles, top_k) for query, items in zip(queries, ranked)]
+    )
+    if reranker.enabled:
+        timings["rerank"] = time.perf_counter() - rerank_started
+
+    timings["total"] = time.perf_counter() - start
+    generation = faiss_store.index_version()
+    lines = []
+    for i, (query, hits, (items, result)) in enumerate(zip(queries, semantic, reranked)):
+        lines.append(
             {
-                "page_id": chunk["page_id"],
-                "url": page.get("url") if page else hit.url,
-                "title": page.get("title") if page else None,
-                "chunk_id": chunk["chunk_id"],
-                "score": hit.score,
-                "section_path": chunk["section_path"],
-                "text": chunk["text"],
-                "tables": tables,
+                "index": offset + i,
+                "query": query,
+                "hits": _hits_payload(items, titles),
+                "rerank": result.status,
+                "index_generation": hits[0].generation if hits else generation,
+                "batch_timings": timings,
             }
         )
-    return {"sources": sources}
-
-
-def _format_tables(tables: List[Dict[str, object]]) -> str:
-    parts: List[str] = []
-    for table in tables:
-        caption = table.get("caption") or "Таблица"
-        columns = table.get("columns") or []
-        rows = table.get("rows") or []
-        parts.append(f"ТАБЛИЦА: {caption}")
-        if columns and len(columns) <= 10 and len(rows) <= 20:
-            # Форматируем как markdown таблицу
-            header = "| " + " | ".join(str(col) for col in columns) + " |"
-            sep = "|" + "|".join([" --- " for _ in columns]) + "|"
-            parts.append(header)
-            parts.append(sep)
-            for row in rows:
-                row_str = "| " + " | ".join(str(cell) for cell in row) + " |"
-                parts.append(row_str)
-        else:
-            # Для больших таблиц используем JSON
-            parts.append(f"Колонки: {', '.join(str(c) for c in columns)}")
-            parts.append(f"Строк данных: {len(rows)}")
-            if rows:
-                parts.append("Первые строки:")
-                for i, row in enumerate(rows[:5]):
-                    parts.append(f"  Строка {i+1}: {dict(zip(columns, row))}")
-    return "\n".join(parts)
+    return lines
+
+
+@app.post("/search/batch")
+async def search_batch(req: SearchBatchRequest) -> StreamingResponse:
+    """/search для списка запросов; NDJSON, по строке на запрос, пакетами по BATCH_CHUNK_SIZE"""
+
+    async def lines() -> AsyncIterator[str]:
+        start = time.perf_counter()
+        for offset, queries in _chunks(req.queries, settings.batch_chunk_size):
+            for line in await _search_chunk(offset, queries, req.top_k):
+                yield _ndjson(line)
+        logger.info("search batch duration=%.3fs queries=%d", time.perf_counter() - start, len(req.queries))
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _rerank_text(source: Dict[str, object]) -> str:
+    """Текст источника для cross-encoder: заголовок, раздел, подписи таблиц и текст чанка"""
+    parts = [str(source.get("title") or ""), " / ".join(source.get("section_path") or [])]
+    parts.extend(str(table.get("caption") or "") for table in source.get("tables") or [])
+    parts.append(str(source.get("text") or ""))
+    return "\n".join(part for part in parts if part)
+
+
+def _rerank_sources(
+    query: str, sources: List[Dict[str, object]], top_k: int
+) -> Tuple[List[Dict[str, object]], RerankResult]:
+    reranked = reranker.rerank(query, [_rerank_text(source) for source in sources], top_k)
+    ordered = []
+    for i in reranked.order:
+        source = sources[i]
+        if i in reranked.scores:
+            # _build_prompts сортирует по score: после переранжирования это оценка cross-encoder
+            source["vector_score"] = source["score"]
+            source["score"] = reranked.scores[i]
+        ordered.append(source)
+    return ordered, reranked
+
+
+def _context(req: ContextRequest) -> Dict[str, object]:
+    """Источники для /context и /rag; у источников есть внутренние поля (public_sources их убирает)"""
+    try:
+        hits = faiss_store.search(req.query, max(req.top_k, reranker.candidates))
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=500, detail=str(exc)) from exc
+    sources = fetch_sources(db, hits, req.tables_window)
+    ordered, reranked = _rerank_sources(req.query, sources, req.top_k)
+    generation = hits[0].generation if hits else faiss_store.index_version()
+    return {
+        "sources": ordered,
+        "rerank": reranked.status,
+        "rerank_duration": reranked.duration,
+        "index_generation": generation,
+    }
+
+
+@app.post("/context")
+def context(req: ContextRequest) -> Dict[str, object]:
+    payload = _context(req)
+    payload["sources"] = public_sources(payload["sources"])
+    return payload
+
+
+@app.post("/context/batch")
+def context_batch(req: ContextBatchRequest) -> StreamingResponse:
+    """/context для списка запросов; NDJSON, по строке на запрос, пакетами по BATCH_CHUNK_SIZE"""
+
+    def lines() -> Iterator[str]:
+        # Синхронный генератор: Starlette выполняет его в threadpool
+        start = time.perf_counter()
+        for offset, queries in _chunks(req.queries, settings.batch_chunk_size):
+            try:
+                hits_per_query = faiss_store.search_many(queries, max(req.top_k, reranker.candidates))
+            except FileNotFoundError as exc:
+                for line in _batch_errors(offset, queries, str(exc)):
+                    yield _ndjson(line)
+                continue
+            # Чанки и таблицы всех запросов пакета — двумя запросами к Postgres
+            sources_per_query = fetch_sources_many(db, hits_per_query, req.tables_window)
+            generation = faiss_store.index_version()
+            for i, (query, hits, sources) in enumerate(zip(queries, hits_per_query, sources_per_query)):
+                ordered, reranked = _rerank_sources(query, sources, req.top_k)
+                yield _ndjson(
+                    {
+                        "index": offset + i,
+                        "query": query,
+                        "sources": public_sources(ordered),
+                        "rerank": reranked.status,
+                        "rerank_duration": reranked.duration,
+                        "index_generation": hits[0].generation if hits else generation,
+                    }
+                )
+        logger.info("context batch duration=%.3fs queries=%d", time.perf_counter() - start, len(req.queries))
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _build_prompts(query: str, sources: List[Dict[str, object]]) -> Tuple[str, str, Dict[str, object]]:
+    return build_prompts(query, sources, context_packer, settings.context_token_budget)
+
+
+def _vllm_unavailable_answer(sources: List[Dict[str, object]]) -> str:
+    answer_parts = [
+        "⚠️ Сервис генерации ответов (vLLM) недоступен.",
+        f"Попытка подключения к: {settings.vllm_url}",
+        "",
+        "Найдены следующие релевантные источники:",
+        "",
+    ]
+    for idx, source in enumerate(sources[:3], start=1):
+        title = source.get("title") or source.get("url", "")
+        section = " / ".join(source.get("section_path") or [])
+        answer_parts.append(f"{idx}. {title}")
+        if section:
+            answer_parts.append(f"   Раздел: {section}")
+        answer_parts.append("")
+    return "\n".join(answer_parts)
+
+
+def _vllm_headers() -> Dict[str, str]:
+    # vLLM требует заголовок Authorization даже если ключ "EMPTY"
+    api_key = settings.vllm_api_key if settings.vllm_api_key else "EMPTY"
+    return {"Authorization": f"Bearer {api_key}"}
+
+
+def _chat_payload(system_prompt: str, user_prompt: str, req: RagRequest, stream: bool) -> Dict[str, object]:
+    return {
+        "model": settings.vllm_model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        "temperature": req.temperature,
+        "max_tokens": req.max_tokens,
+        "stream": stream,
+    }
+
+
+async def _rag_cache_params(
+    req: RagRequest, sources: List[Dict[str, object]]
+) -> Tuple[RagCacheKey, Optional[np.ndarray], str]:
+    key = RagAnswerCache.make_key(
+        [str(source["chunk_id"]) for source in sources],
+        settings.vllm_model,
+        req.temperature,
+        req.max_tokens,
+    )
+    vector = None
+    if rag_cache is not None and rag_cache.uses_embeddings:
+        # Вектор вопроса уже посчитан при поиске и обычно берется из кэша эмбеддингов
+        vector = (await run_in_threadpool(faiss_store.embed, [req.query]))[0]
+    return key, vector, await data_version.current()
 
 
 @app.post("/rag")
-def rag(req: RagRequest) -> Dict[str, object]:
+async def rag(req: RagRequest) -> Dict[str, object]:
     try:
         retrieval_start = time.perf_counter()
-        context_payload = context(ContextRequest(query=req.query, top_k=req.top_k, tables_window=req.tables_window))
+        context_payload = await run_in_threadpool(
+            _context, ContextRequest(query=req.query, top_k=req.top_k, tables_window=req.tables_window)
+        )
         retrieval_duration = time.perf_counter() - retrieval_start
-        logger.info("context duration=%.3fs query=%s", retrieval_duration, req.query)
+        rerank_duration = context_payload.get("rerank_duration")
+        logger.info(
+            "context duration=%.3fs rerank=%.3fs query=%s", retrieval_duration, rerank_duration, req.query
+        )
+        index_generation = context_payload.get("index_generation")
 
         sources = context_payload.get("sources", [])
         if not sources:
-            return {"answer": "Недостаточно данных в источниках для ответа на вопрос.", "sources": [], "error": None}
-
-        system_prompt = (
-            "Ты помощник по справочнику UPVS (Укрупненные Показатели Восстановительной Стоимости). "
-            "Твоя задача - отвечать на вопросы, используя ТОЛЬКО информацию из предоставленных источников. "
-            "\n\n"
-            "КРИТИЧЕСКИ ВАЖНЫЕ ПРАВИЛА (применяются ко ВСЕМ таблицам): "
-            "- В источниках может быть НЕСКОЛЬКО похожих таблиц с РАЗНЫМИ номерами\n"
-            "- Источники отсортированы по релевантности - ПЕРВЫЙ источник обычно наиболее релевантный\n"
-            "- ВНИМАТЕЛЬНО сравнивай название таблицы с вопросом пользователя - они должны ТОЧНО совпадать\n"
-            "- Если в вопросе упоминается конкретный тип здания или характеристика, "
-            "используй ТОЛЬКО таблицу, которая содержит ЭТИ ЖЕ слова в названии\n"
-            "- Если вопрос содержит номер таблицы, используй ТОЛЬКО эту таблицу\n"
-            "- НЕ ПУТАЙ разные таблицы - даже если они похожи, они для РАЗНЫХ типов зданий/сооружений\n"
-            "- Если вопрос про удельный вес, найди раздел 'Удельные веса' в ПРАВИЛЬНОЙ таблице\n"
-            "- Отвечай конкретно, используя ТОЧНЫЕ числа из ПРАВИЛЬНОЙ таблицы\n"
-            "- ВСЕГДА указывай номер и название таблицы, из которой взяты данные"
-        )
-        # Сортируем источники по релевантности (score) - более релевантные первыми
-        sorted_sources = sorted(sources, key=lambda x: x.get("score", 0), reverse=True)
-        
-        chunks_text = []
-        for idx, source in enumerate(sorted_sources, start=1):
-            tables_text = _format_tables(source.get("tables", []))
-            section_path = source.get("section_path") or []
-            title = source.get("title") or ""
-            score = source.get("score", 0)
-            
-            chunk = f"\n{'='*60}\nИСТОЧНИК {idx} (релевантность: {score:.3f})\n{'='*60}\n"
-            if title:
-                # Выделяем название таблицы жирным текстом для лучшей видимости
-                chunk += f"📋 НАЗВАНИЕ ТАБЛИЦЫ: {title}\n"
-            if section_path:
-                chunk += f"📁 РАЗДЕЛ: {' / '.join(section_path)}\n"
-            chunk += f"🔗 URL: {source.get('url', '')}\n\n"
-            
-            # Текст источника
-            text = source.get("text", "")
-            if text:
-                chunk += f"ТЕКСТ:\n{text}\n\n"
-            
-            # Таблицы
-            if tables_text:
-                chunk += f"{tables_text}\n"
-            
-            chunks_text.append(chunk)
-
-        # Анализируем вопрос, чтобы выделить ключевые характеристики для фильтрации
-        query_lower = req.query.lower()
-        
-        # Извлекаем ключевые характеристики из вопроса (универсально для любых таблиц)
-        characteristics = []
-        if "одноэтаж" in query_lower:
-            characteristics.append("одноэтажн")
-        if "двухэтаж" in query_lower:
-            characteristics.append("двухэтажн")
-        if "трехэтаж" in query_lower or "3-этаж" in query_lower:
-            characteristics.append("трехэтажн")
-        if "без подвала" in query_lower:
-            characteristics.append("без подвала")
-        if "с подвалом" in query_lower:
-            characteristics.append("с подвалом")
-        if "таблица" in query_lower:
-            # Извлекаем номер таблицы
-            table_match = re.search(r'таблица\s*(\d+)', query_lower)
-            if table_match:
-                characteristics.append(f"таблица {table_match.group(1)}")
-        
-        # Ищем наиболее релевантный источник
-        best_match_idx = None
-        if characteristics:
-            for idx, source in enumerate(sorted_sources):
-                title_lower = (source.get("title") or "").lower()
-                text_lower = (source.get("text") or "").lower()
-                combined = f"{title_lower} {text_lower}"
-                
-                # Проверяем, содержит ли источник все ключевые характеристики
-                matches = sum(1 for char in characteristics if char in combined)
-                if matches == len(characteristics):
-                    best_match_idx = idx
-                    break
-        
-        user_prompt = (
-            f"ВОПРОС ПОЛЬЗОВАТЕЛЯ: {req.query}\n"
-        )
-        
-        if characteristics:
-            user_prompt += f"\n🔍 КЛЮЧЕВЫЕ ХАРАКТЕРИСТИКИ В ВОПРОСЕ: {', '.join(characteristics)}\n"
-            if best_match_idx is not None:
-                user_prompt += f"✅ НАЙДЕН ТОЧНО СООТВЕТСТВУЮЩИЙ ИСТОЧНИК: Источник {best_match_idx + 1}\n"
-            user_prompt += "⚠️ ВАЖНО: Используй ТОЛЬКО таблицу, которая содержит ВСЕ эти характеристики в названии!\n"
-        
-        user_prompt += (
-            f"\nИСПОЛЬЗУЙ СЛЕДУЮЩИЕ ИСТОЧНИКИ ДЛЯ ОТВЕТА (отсортированы по релевантности):\n"
-            + "".join(chunks_text) + "\n" + "="*60 + "\n\n"
-            "ИНСТРУКЦИИ ПО ВЫБОРУ ПРАВИЛЬНОЙ ТАБЛИЦЫ (применяются ко ВСЕМ таблицам):\n"
-            "- Источники отсортированы по релевантности - первый обычно наиболее подходящий\n"
-            "- В источниках может быть НЕСКОЛЬКО похожих таблиц с РАЗНЫМИ номерами\n"
-            "- ВНИМАТЕЛЬНО сравнивай название таблицы с вопросом - они должны ТОЧНО совпадать\n"
-            "- Если в вопросе упоминается тип здания/сооружения, используй ТОЛЬКО таблицу, "
-            "которая содержит ЭТИ ЖЕ слова в названии\n"
-            "- Если вопрос содержит номер таблицы - используй ТОЛЬКО эту таблицу\n"
-            "- НЕ ПУТАЙ разные таблицы - даже похожие таблицы относятся к РАЗНЫМ типам зданий/сооружений\n"
-            "- Если вопрос про удельный вес, найди раздел 'Удельные веса' в ПРАВИЛЬНОЙ таблице\n"
-            "- Используй ТОЧНЫЕ данные из ПРАВИЛЬНОЙ таблицы - не придумывай числа\n"
-            "- В ответе ВСЕГДА указывай номер и название таблицы, из которой взяты данные\n\n"
-            "ОТВЕТЬ на вопрос пользователя, используя ТОЛЬКО информацию из ПРАВИЛЬНОЙ таблицы:"
-        )
+            return {"answer": "Недостаточно данных в источниках для ответа на вопрос.", "sources": [], "error": None, "cached": False, "index_generation": index_generation}
+
+        cache_params = None
+        if rag_cache is not None:
+            cache_params = await _rag_cache_params(req, sources)
+            cache_key, query_vector, version = cache_params
+            cached_answer = rag_cache.get(cache_key, req.query, query_vector, version)
+            if cached_answer is not None:
+                logger.info("rag cache hit retrieval=%.3fs query=%s", retrieval_duration, req.query)
+                return {
+                    "answer": cached_answer,
+                    "sources": public_sources(sources),
+                    "retrieval_duration": retrieval_duration,
+                    "rerank_duration": rerank_duration,
+                    "generation_duration": 0.0,
+                    "error": None,
+                    "cached": True,
+                    "index_generation": index_generation,
+                }
+
+        system_prompt, user_prompt, prompt_tokens = await run_in_threadpool(_build_prompts, req.query, sources)
 
         gen_start = time.perf_counter()
         try:
             # Пытаемся сделать запрос к vLLM
             logger.info("Attempting to connect to vLLM at %s", settings.vllm_url)
-            # vLLM требует заголовок Authorization даже если ключ "EMPTY"
-            api_key = settings.vllm_api_key if settings.vllm_api_key else "EMPTY"
-            headers = {"Authorization": f"Bearer {api_key}"}
-            response = requests.post(
+            response = await http_client.request(
+                "vllm",
+                "POST",
                 f"{settings.vllm_url}/chat/completions",
-                json={
-                    "model": settings.vllm_model,
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                    "temperature": req.temperature,
-                    "max_tokens": req.max_tokens,
-                },
-                headers=headers,
-                timeout=120,
+                json=_chat_payload(system_prompt, user_prompt, req, stream=False),
+                headers=_vllm_headers(),
             )
             logger.info("vLLM response status: %s", response.status_code)
             response.raise_for_status()
             payload = response.json()
             answer = payload.get("choices", [{}])[0].get("message", {}).get("content", "")
-            if not answer:
-                answer = "Не удалось получить ответ от модели."
-        except requests.exceptions.ConnectionError as exc:
+            # Точное число токенов промпта по версии vLLM, для сверки с оценкой упаковщика
+            prompt_tokens["vllm"] = (payload.get("usage") or {}).get("prompt_tokens")
+        except NOT_SENT_ERRORS as exc:
+            # Сюда же попадает CircuitOpenError: vLLM недавно был недоступен, не ждем таймаута
             logger.error("vLLM connection error: %s (URL: %s)", exc, settings.vllm_url)
             error_msg = str(exc)
-            answer_parts = [
-                "⚠️ Сервис генерации ответов (vLLM) недоступен.",
-                f"Попытка подключения к: {settings.vllm_url}",
-                "",
-                "Найдены следующие релевантные источники:",
-                "",
-            ]
-            for idx, source in enumerate(sources[:3], start=1):
-                title = source.get("title") or source.get("url", "")
-                section = " / ".join(source.get("section_path") or [])
-                answer_parts.append(f"{idx}. {title}")
-                if section:
-                    answer_parts.append(f"   Раздел: {section}")
-                answer_parts.append("")
             return {
-                "answer": "\n".join(answer_parts),
-                "sources": sources,
+                "answer": _vllm_unavailable_answer(sources),
+                "sources": public_sources(sources),
                 "error": error_msg,
                 "retrieval_duration": retrieval_duration,
+                "rerank_duration": rerank_duration,
                 "generation_duration": 0.0,
+                "prompt_tokens": prompt_tokens,
+                "cached": False,
+                "index_generation": index_generation,
             }
-        except requests.exceptions.RequestException as exc:
+        except httpx.HTTPError as exc:
             logger.error("vLLM request error: %s (URL: %s)", exc, settings.vllm_url)
             error_msg = str(exc)
             answer = f"Ошибка при обращении к модели: {error_msg}"
             return {
                 "answer": answer,
-                "sources": sources,
+                "sources": public_sources(sources),
                 "error": error_msg,
                 "retrieval_duration": retrieval_duration,
+                "rerank_duration": rerank_duration,
                 "generation_duration": 0.0,
+                "prompt_tokens": prompt_tokens,
+                "cached": False,
+                "index_generation": index_generation,
             }
         except Exception as exc:
             logger.error("vLLM processing error: %s", exc)
             return {
                 "answer": f"Ошибка при обработке ответа модели: {str(exc)}",
-                "sources": sources,
+                "sources": public_sources(sources),
                 "error": str(exc),
                 "retrieval_duration": retrieval_duration,
+                "rerank_duration": rerank_duration,
                 "generation_duration": 0.0,
+                "prompt_tokens": prompt_tokens,
+                "cached": False,
+                "index_generation": index_generation,
             }
         
         generation_duration = time.perf_counter() - gen_start
         logger.info(
-            "rag duration retrieval=%.3fs generation=%.3fs query=%s",
+            "rag duration retrieval=%.3fs generation=%.3fs prompt_tokens=%d query=%s",
             retrieval_duration,
             generation_duration,
+            prompt_tokens["total"],
             req.query,
         )
 
+        answer = (answer or "").strip()
+        if not answer:
+            # Заглушка вместо ответа в кэш не попадает: иначе ее получат и все похожие запросы
+            answer = "Не удалось получить ответ от модели."
+        elif cache_params is not None:
+            cache_key, query_vector, version = cache_params
+            rag_cache.put(cache_key, req.query, query_vector, version, answer)
+
         return {
-            "answer": answer.strip() if answer else "Не удалось получить ответ.",
-            "sources": sources,
+            "answer": answer,
+            "sources": public_sources(sources),
             "retrieval_duration": retrieval_duration,
+            "rerank_duration": rerank_duration,
             "generation_duration": generation_duration,
+            "prompt_tokens": prompt_tokens,
             "error": None,
+            "cached": False,
+            "index_generation": index_generation,
         }
     except Exception as exc:
         logger.error("RAG error: %s", exc, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Ошибка RAG: {str(exc)}") from exc
+
+
+def _sse(event: str, payload: Dict[str, object]) -> str:
+    data = json.dumps(payload, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+@app.post("/rag/stream")
+async def rag_stream(req: RagRequest) -> StreamingResponse:
+    """RAG с потоковой выдачей (SSE): sources, затем token-дельты vLLM, затем done"""
+    retrieval_start = time.perf_counter()
+    context_payload = await run_in_threadpool(
+        _context, ContextRequest(query=req.query, top_k=req.top_k, tables_window=req.tables_window)
+    )
+    retrieval_duration = time.perf_counter() - retrieval_start
+    sources = context_payload.get("sources", [])
+
+    async def stream_events() -> AsyncIterator[str]:
+        yield _sse(
+            "sources",
+            {
+                "sources": public_sources(sources),
+                "retrieval_duration": retrieval_duration,
+                "rerank_duration": context_payload.get("rerank_duration"),
+                "index_generation": context_payload.get("index_generation"),
+            },
+        )
+        if not sources:
+            yield _sse("token", {"delta": "Недостаточно данных в источниках для ответа на вопрос."})
+            yield _sse(
+                "done",
+                {
+                    "retrieval_duration": retrieval_duration,
+                    "generation_duration": 0.0,
+                    "time_to_first_token": None,
+                    "error": None,
+                    "cached": False,
+                },
+            )
+            return
+
+        cache_params = None
+        if rag_cache is not None:
+            cache_params = await _rag_cache_params(req, sources)
+            cache_key, query_vector, version = cache_params
+            cached_answer = rag_cache.get(cache_key, req.query, query_vector, version)
+            if cached_answer is not None:
+                yield _sse("token", {"delta": cached_answer})
+                yield _sse(
+                    "done",
+                    {
+                        "retrieval_duration": retrieval_duration,
+                        "generation_duration": 0.0,
+                        "time_to_first_token": 0.0,
+                        "error": None,
+                        "cached": True,
+                    },
+                )
+                return
+
+        system_prompt, user_prompt, prompt_tokens = await run_in_threadpool(_build_prompts, req.query, sources)
+        gen_start = time.perf_counter()
+        time_to_first_token = None
+        error = None
+        parts: List[str] = []
+        try:
+            async with http_client.stream(
+                "vllm",
+                "POST",
+                f"{settings.vllm_url}/chat/completions",
+                json=_chat_payload(system_prompt, user_prompt, req, stream=True),
+                headers=_vllm_headers(),
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        choices = json.loads(data).get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content")
+                    except (ValueError, KeyError, TypeError, AttributeError) as exc:
+                        # Одна битая строка SSE не должна обрывать ответ
+                        logger.warning("vLLM: пропущена некорректная строка потока: %s (%r)", exc, data[:200])
+                        continue
+                    if not delta:
+                        continue
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - gen_start
+                    parts.append(delta)
+                    yield _sse("token", {"delta": delta})
+        except NOT_SENT_ERRORS as exc:
+            logger.error("vLLM connection error: %s (URL: %s)", exc, settings.vllm_url)
+            error = str(exc)
+            yield _sse("error", {"error": error, "answer": _vllm_unavailable_answer(sources)})
+        except httpx.HTTPError as exc:
+            logger.error("vLLM request error: %s (URL: %s)", exc, settings.vllm_url)
+            error = str(exc)
+            yield _sse("error", {"error": error, "answer": f"Ошибка при обращении к модели: {error}"})
+
+        generation_duration = time.perf_counter() - gen_start
+        answer = "".join(parts).strip()
+        if cache_params is not None and error is None and answer:
+            # В кэш попадают только полностью полученные ответы
+            cache_key, query_vector, version = cache_params
+            rag_cache.put(cache_key, req.query, query_vector, version, answer)
+        logger.info(
+            "rag stream duration retrieval=%.3fs ttft=%s generation=%.3fs prompt_tokens=%d query=%s",
+            retrieval_duration,
+            f"{time_to_first_token:.3f}s" if time_to_first_token is not None else "-",
+            generation_duration,
+            prompt_tokens["total"],
+            req.query,
+        )
+        yield _sse(
+            "done",
+            {
+                "retrieval_duration": retrieval_duration,
+                "generation_duration": generation_duration,
+                "time_to_first_token": time_to_first_token,
+                "prompt_tokens": prompt_tokens,
+                "error": error,
+                "cached": False,
+            },
+        )
+
+    async def events() -> AsyncIterator[str]:
+        # Любая ошибка после начала потока завершает его событиями error и done, иначе клиент ждет done
+        finished = False
+        try:
+            async for event in stream_events():
+                finished = event.startswith("event: done\n")
+                yield event
+        except Exception as exc:
+            logger.exception("rag stream error query=%s", req.query)
+            if finished:
+                return
+            yield _sse("error", {"error": str(exc), "answer": f"Ошибка RAG: {exc}"})
+            yield _sse(
+                "done",
+                {
+                    "retrieval_duration": retrieval_duration,
+                    "generation_duration": None,
+                    "time_to_first_token": None,
+                    "error": str(exc),
+                    "cached": False,
+                },
+            )
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from .data_version import DataVersion
+from .db import AsyncDatabase
+
+TREE_SQL = """
+SELECT page_id, url, title, parent_url
+FROM pages
+WHERE title IS NOT NULL
+ORDER BY url
+"""
+
+# Глубже JSON-кодировщик упирается в лимит рекурсии (уровень дерева — это dict и список children)
+MAX_TREE_DEPTH = 200
+
+
+def build_tree(pages: List[Dict[str, object]]) -> List[Dict[str, object]]:
+    """Строит дерево по parent_url; дети отсортированы по title"""
+    pages_by_url: Dict[str, Dict[str, object]] = {}
+    for page in pages:
+        page["children"] = []
+        pages_by_url[page["url"]] = page
+
+    root_pages = []
+    for page in pages:
+        parent_url = page.get("parent_url")
+        # Ссылка на себя не должна зацикливать дерево
+        if parent_url and parent_url != page["url"] and parent_url in pages_by_url:
+            pages_by_url[parent_url]["children"].append(page)
+        else:
+            root_pages.append(page)
+
+    # Обход стеком вместо рекурсии; ветка глубже MAX_TREE_DEPTH продолжается от корня,
+    # иначе дерево не сериализуется
+    stack = [(page, 1) for page in root_pages]
+    while stack:
+        node, depth = stack.pop()
+        children = node["children"]
+        if not children:
+            continue
+        children.sort(key=lambda x: x.get("title", "") or "")
+        if depth >= MAX_TREE_DEPTH:
+            node["children"] = []
+            root_pages.extend(children)
+            stack.extend((child, 1) for child in children)
+        else:
+            stack.extend((child, depth + 1) for child in children)
+    return root_pages
+
+
+def _without_children(node: Dict[str, object]) -> Dict[str, object]:
+    return {key: value for key, value in node.items() if key != "children"}
+
+
+def subtree(node: Dict[str, object], depth: Optional[int]) -> Dict[str, object]:
+    """Копия узла с детьми до глубины depth; has_children показывает, есть ли что раскрывать"""
+    result = _without_children(node)
+    # Тем же стеком, что и build_tree: без рекурсии на длинных цепочках parent_url
+    stack = [(node, result, depth)]
+    while stack:
+        source, target, remaining = stack.pop()
+        children = source["children"]
+        target["has_children"] = bool(children)
+        target["children"] = []
+        if remaining is not None and remaining <= 0:
+            continue
+        next_depth = None if remaining is None else remaining - 1
+        for child in children:
+            copy = _without_children(child)
+            target["children"].append(copy)
+            stack.append((child, copy, next_depth))
+    return result
+
+
+@dataclass
+class NavigationTree:
+    version: int
+    roots: List[Dict[str, object]]
+    by_id: Dict[str, Dict[str, object]]
+    body: bytes
+    digest: str
+
+    def etag(self, root: Optional[str] = None, depth: Optional[int] = None) -> str:
+        if root is None and depth is None:
+            return f'"nav-{self.digest}"'
+        return f'"nav-{self.digest}-{root or ""}-{"" if depth is None else depth}"'
+
+
+def _materialize(version: int, pages: List[Dict[str, object]]) -> NavigationTree:
+    roots = build_tree(pages)
+    body = json.dumps({"tree": roots}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return NavigationTree(
+        version=version,
+        roots=roots,
+        by_id={page["page_id"]: page for page in pages},
+        body=body,
+        digest=hashlib.sha1(body).hexdigest()[:16],
+    )
+
+
+class NavigationTreeCache:
+    """Дерево навигации, построенное один раз на версию данных Postgres"""
+
+    def __init__(self, adb: AsyncDatabase, data_version: DataVersion) -> None:
+        self._adb = adb
+        self._data_version = data_version
+        self._tree: Optional[NavigationTree] = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> NavigationTree:
+        version = await self._data_version.postgres()
+        tree = self._tree
+        if tree is not None and tree.version == version:
+            return tree
+        async with self._lock:
+            # Пока ждали блокировку, дерево мог построить другой запрос
+            tree = self._tree
+            if tree is not None and tree.version == version:
+                return tree
+            pages = await self._adb.fetch_all(TREE_SQL, ())
+            tree = await run_in_threadpool(_materialize, version, pages)
+            self._tree = tree
+            return tree
@@ -0,0 +1,81 @@
+"""Эмбеддинги ONNX Runtime: один код для запросов API и для сборки индекса.
+
+Векторы запросов (apps/api/embeddings.py) и векторы чанков (scripts/build_faiss/build_faiss.py)
+должны считаться одинаково: токенизация, пулинг и нормализация живут только здесь.
+Модуль не зависит от остального apps.api, чтобы его импортировал скрипт сборки.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from typing import List
+
+import numpy as np
+
+
+def onnx_model_digest(path: str) -> str:
+    """Хэш содержимого ONNX-файла: повторный экспорт под тем же именем дает другие векторы"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def pool_embeddings(hidden: np.ndarray, attention_mask: np.ndarray, pooling: str) -> np.ndarray:
+    """Пулинг last_hidden_state и L2-нормализация, как в sentence-transformers"""
+    if pooling == "cls":
+        pooled = hidden[:, 0]
+    else:
+        mask = attention_mask[:, :, None].astype("float32")
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+    norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+    return (pooled / np.maximum(norms, 1e-12)).astype("float32")
+
+
+class OnnxEmbeddingModel:
+    """Модель из scripts/export_onnx/export_onnx.py в ONNX Runtime на CPU (нужны onnxruntime и tokenizers).
+
+    Рядом с model_path лежат tokenizer.json и embedding_config.json.
+    """
+
+    def __init__(self, model_path: str, model_name: str, threads: int = 0) -> None:
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_dir = os.path.dirname(str(model_path))
+        with open(os.path.join(model_dir, "embedding_config.json"), "r", encoding="utf-8") as handle:
+            config = json.load(handle)
+        if config.get("model") != model_name:
+            raise ValueError(
+                f"ONNX модель {model_path} экспортирована из {config.get('model')}, а EMBEDDINGS_MODEL={model_name}"
+            )
+        self._pooling = config.get("pooling", "mean")
+        self._dimension = int(config["dimension"])
+        self._tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self._tokenizer.enable_truncation(int(config["max_length"]))
+        self._tokenizer.enable_padding(pad_id=int(config["pad_token_id"]), pad_token=str(config["pad_token"]))
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 — число потоков выбирает ONNX Runtime (по физическим ядрам)
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self._session = onnxruntime.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self._inputs = {item.name for item in self._session.get_inputs()}
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self._dimension), dtype="float32")
+        encodings = self._tokenizer.encode_batch(texts)
+        attention_mask = np.asarray([encoding.attention_mask for encoding in encodings], dtype="int64")
+        feeds = {
+            "input_ids": np.asarray([encoding.ids for encoding in encodings], dtype="int64"),
+            "attention_mask": attention_mask,
+        }
+        if "token_type_ids" in self._inputs:
+            feeds["token_type_ids"] = np.asarray([encoding.type_ids for encoding in encodings], dtype="int64")
+        (hidden,) = self._session.run(["last_hidden_state"], feeds)
+        return pool_embeddings(hidden, attention_mask, self._pooling)
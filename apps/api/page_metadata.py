@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from .data_version import DataVersion
+from .db import AsyncDatabase
+
+logger = logging.getLogger("upvs.api")
+
+PAGES_SQL = "SELECT page_id, title FROM pages ORDER BY page_id"
+
+CAPTIONS_SQL = """
+SELECT DISTINCT page_id, caption
+FROM tables
+WHERE caption IS NOT NULL
+ORDER BY page_id, caption
+"""
+
+
+@dataclass
+class PageMetadata:
+    """Заголовки страниц и подписи их таблиц для одной версии данных.
+
+    Списки индексируются порядковым номером страницы; строки интернированы: одинаковые
+    подписи вида «Таблица 1» и заголовки разделов хранятся в одном экземпляре.
+    """
+
+    version: int
+    ordinals: Dict[str, int]
+    titles: List[Optional[str]]
+    captions: List[Tuple[str, ...]]
+    loaded_at: float
+    load_duration: float = 0.0
+
+    def lookup(
+        self, page_ids: Iterable[str]
+    ) -> Tuple[Dict[str, Optional[str]], Dict[str, List[str]], Set[str]]:
+        """Заголовки и подписи таблиц страниц; третьим — страницы, которых нет в снимке"""
+        titles: Dict[str, Optional[str]] = {}
+        captions: Dict[str, List[str]] = {}
+        missing: Set[str] = set()
+        for page_id in page_ids:
+            ordinal = self.ordinals.get(page_id)
+            if ordinal is None:
+                missing.add(page_id)
+                continue
+            titles[page_id] = self.titles[ordinal]
+            if self.captions[ordinal]:
+                captions[page_id] = list(self.captions[ordinal])
+        return titles, captions, missing
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value else value
+
+
+def _materialize(
+    version: int, pages: List[Dict[str, object]], caption_rows: List[Dict[str, object]], started: float
+) -> PageMetadata:
+    ordinals: Dict[str, int] = {}
+    titles: List[Optional[str]] = []
+    for row in pages:
+        ordinals[sys.intern(str(row["page_id"]))] = len(titles)
+        titles.append(_intern(row.get("title")))
+
+    by_ordinal: Dict[int, List[str]] = {}
+    for row in caption_rows:
+        ordinal = ordinals.get(str(row["page_id"]))
+        # Таблица страницы, которой нет в pages: в буст она и раньше не попадала
+        if ordinal is not None:
+            by_ordinal.setdefault(ordinal, []).append(sys.intern(str(row["caption"])))
+    empty: Tuple[str, ...] = ()
+    captions = [tuple(by_ordinal[i]) if i in by_ordinal else empty for i in range(len(titles))]
+    return PageMetadata(
+        version=version,
+        ordinals=ordinals,
+        titles=titles,
+        captions=captions,
+        loaded_at=time.time(),
+        load_duration=time.perf_counter() - started,
+    )
+
+
+class PageMetadataStore:
+    """Метаданные страниц для /search в памяти процесса, на версию данных Postgres.
+
+    Снимок грузится при старте и перегружается фоновой задачей watch() после смены
+    data_version_seq; обработчики читают текущий снимок без обращения к базе.
+    """
+
+    def __init__(self, adb: AsyncDatabase, data_version: DataVersion) -> None:
+        self._adb = adb
+        self._data_version = data_version
+        self._snapshot: Optional[PageMetadata] = None
+        self._lock = asyncio.Lock()
+
+    def snapshot(self) -> Optional[PageMetadata]:
+        return self._snapshot
+
+    async def refresh(self) -> bool:
+        """Перегружает снимок, если сменилась версия данных; True — снимок обновлен"""
+        version = await self._data_version.postgres()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return False
+        async with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version == version:
+                return False
+            # Версия читается до данных: загрузка, попавшая на середину, догрузится следующей проверкой
+            started = time.perf_counter()
+            pages = await self._adb.fetch_all(PAGES_SQL, ())
+            caption_rows = await self._adb.fetch_all(CAPTIONS_SQL, ())
+            snapshot = await run_in_threadpool(_materialize, version, pages, caption_rows, started)
+            self._snapshot = snapshot
+        logger.info(
+            "Метаданные страниц: версия %d, страниц %d, %.3fs",
+            snapshot.version,
+            len(snapshot.titles),
+            snapshot.load_duration,
+        )
+        return True
+
+    async def watch(self, interval: float) -> None:
+        """Фоновая проверка версии данных; ошибка базы оставляет прежний снимок"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as exc:
+                logger.warning("Метаданные страниц не обновлены: %s", exc)
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict[str, object]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {"loaded": False}
+        return {
+            "loaded": True,
+            "version": snapshot.version,
+            "pages": len(snapshot.titles),
+            "captions": sum(len(captions) for captions in snapshot.captions),
+            "loaded_at": snapshot.loaded_at,
+            "load_duration": snapshot.load_duration,
+        }
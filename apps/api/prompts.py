@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .context_packer import ContextPacker
+
+# Промпт устроен под автоматический prefix caching vLLM: неизменная часть (system с правилами)
+# идет первой, затем источники в каноническом порядке (page_id, source_order) без оценок,
+# и только в конце — все, что зависит от вопроса. Одинаковые источники дают байт-в-байт
+# одинаковый префикс, и KV-кэш переиспользуется даже при другом вопросе или порядке score.
+SYSTEM_PROMPT = (
+    "Ты помощник по справочнику UPVS (Укрупненные Показатели Восстановительной Стоимости). "
+    "Твоя задача - отвечать на вопросы, используя ТОЛЬКО информацию из предоставленных источников.\n\n"
+    "КРИТИЧЕСКИ ВАЖНЫЕ ПРАВИЛА (применяются ко ВСЕМ таблицам):\n"
+    "- В источниках может быть НЕСКОЛЬКО похожих таблиц с РАЗНЫМИ номерами\n"
+    "- Источники перечислены в порядке страниц; самые релевантные названы после источников, перед вопросом\n"
+    "- ВНИМАТЕЛЬНО сравнивай название таблицы с вопросом пользователя - они должны ТОЧНО совпадать\n"
+    "- Если в вопросе упоминается конкретный тип здания/сооружения или характеристика, "
+    "используй ТОЛЬКО таблицу, которая содержит ЭТИ ЖЕ слова в названии\n"
+    "- Если вопрос содержит номер таблицы, используй ТОЛЬКО эту таблицу\n"
+    "- НЕ ПУТАЙ разные таблицы - даже если они похожи, они для РАЗНЫХ типов зданий/сооружений\n"
+    "- Если вопрос про удельный вес, найди раздел 'Удельные веса' в ПРАВИЛЬНОЙ таблице\n"
+    "- Отвечай конкретно, используя ТОЧНЫЕ числа из ПРАВИЛЬНОЙ таблицы - не придумывай числа\n"
+    "- ВСЕГДА указывай номер и название таблицы, из которой взяты данные"
+)
+
+SOURCES_HEADER = "ИСТОЧНИКИ:\n"
+SOURCES_FOOTER = "\n" + "=" * 60 + "\n\n"
+
+
+def format_tables(tables: List[Dict[str, object]]) -> str:
+    parts: List[str] = []
+    for table in tables:
+        caption = table.get("caption") or "Таблица"
+        columns = table.get("columns") or []
+        rows = table.get("rows") or []
+        parts.append(f"ТАБЛИЦА: {caption}")
+        if table.get("rows_total"):
+            parts.append(f"Показаны строки, подходящие к вопросу: {len(rows)} из {table['rows_total']}")
+        if columns and len(columns) <= 10 and len(rows) <= 20:
+            # Форматируем как markdown таблицу
+            header = "| " + " | ".join(str(col) for col in columns) + " |"
+            sep = "|" + "|".join([" --- " for _ in columns]) + "|"
+            parts.append(header)
+            parts.append(sep)
+            for row in rows:
+                row_str = "| " + " | ".join(str(cell) for cell in row) + " |"
+                parts.append(row_str)
+        else:
+            # Для больших таблиц используем JSON
+            parts.append(f"Колонки: {', '.join(str(c) for c in columns)}")
+            parts.append(f"Строк данных: {len(rows)}")
+            if rows:
+                parts.append("Первые строки:")
+                for i, row in enumerate(rows[:5]):
+                    parts.append(f"  Строка {i+1}: {dict(zip(columns, row))}")
+    return "\n".join(parts)
+
+
+def render_source(idx: int, source: Dict[str, object]) -> str:
+    """Блок одного источника; без score, чтобы блок не зависел от вопроса"""
+    tables_text = format_tables(source.get("tables", []))
+    section_path = source.get("section_path") or []
+    title = source.get("title") or ""
+
+    chunk = f"\n{'='*60}\nИСТОЧНИК {idx}\n{'='*60}\n"
+    if title:
+        # Выделяем название таблицы жирным текстом для лучшей видимости
+        chunk += f"📋 НАЗВАНИЕ ТАБЛИЦЫ: {title}\n"
+    if section_path:
+        chunk += f"📁 РАЗДЕЛ: {' / '.join(section_path)}\n"
+    chunk += f"🔗 URL: {source.get('url', '')}\n\n"
+
+    # Текст источника
+    text = source.get("text", "")
+    if text:
+        chunk += f"ТЕКСТ:\n{text}\n\n"
+
+    # Таблицы
+    if tables_text:
+        chunk += f"{tables_text}\n"
+
+    return chunk
+
+
+def canonical_key(source: Dict[str, object]) -> Tuple[str, int, str]:
+    return (
+        str(source.get("page_id") or ""),
+        int(source.get("source_order") or 0),
+        str(source.get("chunk_id") or ""),
+    )
+
+
+def query_characteristics(query: str) -> List[str]:
+    """Ключевые характеристики из вопроса (универсально для любых таблиц)"""
+    query_lower = query.lower()
+    characteristics = []
+    if "одноэтаж" in query_lower:
+        characteristics.append("одноэтажн")
+    if "двухэтаж" in query_lower:
+        characteristics.append("двухэтажн")
+    if "трехэтаж" in query_lower or "3-этаж" in query_lower:
+        characteristics.append("трехэтажн")
+    if "без подвала" in query_lower:
+        characteristics.append("без подвала")
+    if "с подвалом" in query_lower:
+        characteristics.append("с подвалом")
+    if "таблица" in query_lower:
+        # Извлекаем номер таблицы
+        table_match = re.search(r'таблица\s*(\d+)', query_lower)
+        if table_match:
+            characteristics.append(f"таблица {table_match.group(1)}")
+    return characteristics
+
+
+def question_part(
+    query: str, characteristics: List[str], ranking: List[int], best_match: Optional[int]
+) -> str:
+    """Хвост user-промпта после источников: все, что зависит от вопроса и score"""
+    part = ""
+    if ranking:
+        part += f"ИСТОЧНИКИ ПО УБЫВАНИЮ РЕЛЕВАНТНОСТИ: {', '.join(str(number) for number in ranking)}\n"
+    if characteristics:
+        part += f"🔍 КЛЮЧЕВЫЕ ХАРАКТЕРИСТИКИ В ВОПРОСЕ: {', '.join(characteristics)}\n"
+        if best_match is not None:
+            part += f"✅ НАЙДЕН ТОЧНО СООТВЕТСТВУЮЩИЙ ИСТОЧНИК: Источник {best_match}\n"
+        part += "⚠️ ВАЖНО: Используй ТОЛЬКО таблицу, которая содержит ВСЕ эти характеристики в названии!\n"
+    part += (
+        f"\nВОПРОС ПОЛЬЗОВАТЕЛЯ: {query}\n\n"
+        "ОТВЕТЬ на вопрос пользователя, используя ТОЛЬКО информацию из ПРАВИЛЬНОЙ таблицы:"
+    )
+    return part
+
+
+def build_prompts(
+    query: str, sources: List[Dict[str, object]], packer: ContextPacker, budget: int
+) -> Tuple[str, str, Dict[str, object]]:
+    """Собирает system и user промпты для vLLM из источников, уложенных в бюджет токенов"""
+    # В бюджет источники попадают по убыванию score
+    by_score = sorted(sources, key=lambda x: x.get("score", 0), reverse=True)
+    characteristics = query_characteristics(query)
+
+    # Источникам достается бюджет за вычетом постоянной части (с запасом на номера источников)
+    fixed = SOURCES_HEADER + SOURCES_FOOTER
+    fixed += question_part(query, characteristics, list(range(1, len(by_score) + 1)), len(by_score))
+    fixed_tokens = packer.count_messages(SYSTEM_PROMPT, fixed)
+    packed = packer.pack(query, by_score, budget - fixed_tokens, render_source)
+
+    # В промпте — канонический порядок, номер источника — его место в нем
+    order = sorted(range(len(packed.sources)), key=lambda i: canonical_key(packed.sources[i]))
+    number = {index: position for position, index in enumerate(order, start=1)}
+    blocks = [render_source(number[index], packed.sources[index]) for index in order]
+    ranking = [number[index] for index in range(len(packed.sources))]
+
+    # Ищем наиболее релевантный источник среди попавших в промпт
+    best_match = None
+    if characteristics:
+        for index, source in enumerate(packed.sources):
+            title_lower = (source.get("title") or "").lower()
+            text_lower = (source.get("text") or "").lower()
+            combined = f"{title_lower} {text_lower}"
+
+            # Проверяем, содержит ли источник все ключевые характеристики
+            matches = sum(1 for char in characteristics if char in combined)
+            if matches == len(characteristics):
+                best_match = number[index]
+                break
+
+    user_prompt = (
+        SOURCES_HEADER
+        + "".join(blocks)
+        + SOURCES_FOOTER
+        + question_part(query, characteristics, ranking, best_match)
+    )
+    prompt_tokens = {
+        "total": packer.count_messages(SYSTEM_PROMPT, user_prompt),
+        "sources": packed.tokens,
+        "budget": budget,
+        "sources_used": len(packed.sources),
+        "sources_dropped": packed.dropped,
+        "sources_deduplicated": packed.deduplicated,
+        "tokenizer": packer.counter.name,
+    }
+    return SYSTEM_PROMPT, user_prompt, prompt_tokens
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .embedding_cache import normalize_query
+
+RagCacheKey = Tuple[Tuple[str, ...], str, float, int]
+
+# Сколько формулировок одного вопроса хранится на один набор источников
+MAX_VARIANTS_PER_KEY = 8
+
+
+@dataclass
+class _Entry:
+    query: str
+    vector: Optional[np.ndarray]
+    answer: str
+    created_at: float
+
+
+class RagAnswerCache:
+    """Кэш ответов /rag.
+
+    Ключ — отсортированные chunk_id найденных источников и параметры генерации.
+    Внутри ключа ответ переиспользуется для того же нормализованного вопроса или для
+    вопроса с косинусной близостью эмбеддингов не ниже similarity_threshold.
+    При смене версии данных (Postgres или FAISS) кэш очищается целиком.
+    """
+
+    def __init__(self, max_size: int, ttl: float, similarity_threshold: float) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[RagCacheKey, List[_Entry]]" = OrderedDict()
+        self._version: Optional[str] = None
+        self._hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @property
+    def uses_embeddings(self) -> bool:
+        return self._similarity_threshold < 1.0
+
+    @staticmethod
+    def make_key(chunk_ids: Sequence[str], model: str, temperature: float, max_tokens: int) -> RagCacheKey:
+        return (tuple(sorted(chunk_ids)), model, round(temperature, 4), max_tokens)
+
+    def _check_version(self, version: str) -> None:
+        if self._version != version:
+            if self._version is not None:
+                self._invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    def get(
+        self, key: RagCacheKey, query: str, vector: Optional[np.ndarray], version: str
+    ) -> Optional[str]:
+        normalized = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(version)
+            variants = self._entries.get(key)
+            if variants and self._ttl > 0:
+                variants[:] = [entry for entry in variants if now - entry.created_at <= self._ttl]
+            if not variants:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            for entry in variants:
+                if entry.query == normalized:
+                    self._hits += 1
+                    return entry.answer
+            if vector is not None and self.uses_embeddings:
+                # Векторы нормализованы, скалярное произведение = косинус
+                best = max(
+                    (entry for entry in variants if entry.vector is not None),
+                    key=lambda entry: float(np.dot(entry.vector, vector)),
+                    default=None,
+                )
+                if best is not None and float(np.dot(best.vector, vector)) >= self._similarity_threshold:
+                    self._semantic_hits += 1
+                    return best.answer
+            self._misses += 1
+            return None
+
+    def put(
+        self, key: RagCacheKey, query: str, vector: Optional[np.ndarray], version: str, answer: str
+    ) -> None:
+        with self._lock:
+            self._check_version(version)
+            variants = self._entries.setdefault(key, [])
+            variants.append(_Entry(normalize_query(query), vector, answer, time.monotonic()))
+            del variants[:-MAX_VARIANTS_PER_KEY]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            lookups = self._hits + self._semantic_hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_size": self._max_size,
+                "version": self._version,
+                "hits": self._hits,
+                "semantic_hits": self._semantic_hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_rate": (self._hits + self._semantic_hits) / lookups if lookups else 0.0,
+            }
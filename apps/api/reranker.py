@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from .config import Settings
+
+logger = logging.getLogger("upvs.api")
+
+WARMUP_PAIR = ("одноэтажное здание без подвала", "Таблица 12. Одноэтажные здания без подвала")
+
+
+class CrossEncoderModel(ABC):
+    @abstractmethod
+    def score(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        """Оценки релевантности пар (запрос, текст) в [0, 1]"""
+        raise NotImplementedError
+
+
+class SentenceTransformersCrossEncoder(CrossEncoderModel):
+    def __init__(self, model_name: str, max_length: int) -> None:
+        from sentence_transformers import CrossEncoder
+
+        self._model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+    def score(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        # Для моделей с одним выходом CrossEncoder сам применяет сигмоиду
+        scores = self._model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        return np.asarray(scores, dtype="float32").reshape(len(pairs))
+
+
+class OnnxCrossEncoder(CrossEncoderModel):
+    """Cross-encoder из scripts/export_onnx/export_onnx.py --reranker в ONNX Runtime на CPU.
+
+    Рядом с model_path лежат tokenizer.json и reranker_config.json; выход logits, оценка — сигмоида.
+    """
+
+    def __init__(self, model_path: str, model_name: str, threads: int = 0) -> None:
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_dir = os.path.dirname(model_path)
+        with open(os.path.join(model_dir, "reranker_config.json"), "r", encoding="utf-8") as handle:
+            config = json.load(handle)
+        if config.get("model") != model_name:
+            raise ValueError(
+                f"ONNX модель {model_path} экспортирована из {config.get('model')}, а RERANKER_MODEL={model_name}"
+            )
+        self._tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self._tokenizer.enable_truncation(int(config["max_length"]))
+        self._tokenizer.enable_padding(pad_id=int(config["pad_token_id"]), pad_token=str(config["pad_token"]))
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self._session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._inputs = {item.name for item in self._session.get_inputs()}
+
+    def score(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        if not pairs:
+            return np.zeros(0, dtype="float32")
+        encodings = self._tokenizer.encode_batch(pairs)
+        feeds = {
+            "input_ids": np.asarray([encoding.ids for encoding in encodings], dtype="int64"),
+            "attention_mask": np.asarray([encoding.attention_mask for encoding in encodings], dtype="int64"),
+        }
+        if "token_type_ids" in self._inputs:
+            feeds["token_type_ids"] = np.asarray([encoding.type_ids for encoding in encodings], dtype="int64")
+        (logits,) = self._session.run(["logits"], feeds)
+        return (1.0 / (1.0 + np.exp(-logits[:, 0]))).astype("float32")
+
+
+def get_cross_encoder(
+    provider: str, model: str, max_length: int, onnx_path: str = "", threads: int = 0
+) -> CrossEncoderModel:
+    if provider == "onnx":
+        return OnnxCrossEncoder(onnx_path, model, threads)
+    return SentenceTransformersCrossEncoder(model, max_length)
+
+
+@dataclass
+class RerankResult:
+    # Индексы кандидатов в итоговом порядке, не больше top_k
+    order: List[int]
+    # Оценки cross-encoder по индексу кандидата; пусто, если остался исходный порядок
+    scores: Dict[int, float] = field(default_factory=dict)
+    duration: float = 0.0
+    # ok, disabled, not_ready, budget, error
+    status: str = "ok"
+
+    @property
+    def applied(self) -> bool:
+        return self.status == "ok"
+
+
+class Reranker:
+    """Переранжирование кандидатов поиска cross-encoder'ом в пределах бюджета времени на запрос.
+
+    Кандидаты оцениваются пакетами; если следующий пакет не укладывается в бюджет, остается
+    исходный порядок. Модель грузится в warm_up(), до этого запросы идут без переранжирования.
+    """
+
+    def __init__(self, settings: Settings) -> None:
+        self._settings = settings
+        self._model: CrossEncoderModel | None = None
+        self._load_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, int] = {"ok": 0, "not_ready": 0, "budget": 0, "error": 0}
+        self._warmup_error: str | None = None
+
+    @property
+    def enabled(self) -> bool:
+        provider = self._settings.reranker_provider
+        return provider not in ("", "none") and self._settings.reranker_candidates > 0
+
+    @property
+    def candidates(self) -> int:
+        return self._settings.reranker_candidates if self.enabled else 0
+
+    def warm_up(self) -> float:
+        """Загружает модель и оценивает пробную пару; возвращает длительность"""
+        start = time.perf_counter()
+        with self._load_lock:
+            if self._model is None:
+                try:
+                    model = get_cross_encoder(
+                        self._settings.reranker_provider,
+                        self._settings.reranker_model,
+                        self._settings.reranker_max_length,
+                        self._settings.reranker_onnx_path,
+                        self._settings.reranker_threads,
+                    )
+                    model.score([WARMUP_PAIR])
+                except Exception as exc:
+                    self._warmup_error = str(exc)
+                    raise
+                self._warmup_error = None
+                self._model = model
+        return time.perf_counter() - start
+
+    def readiness(self) -> Dict[str, object]:
+        return {"enabled": self.enabled, "ready": self._model is not None, "error": self._warmup_error}
+
+    def rerank(self, query: str, texts: Sequence[str], top_k: int) -> RerankResult:
+        start = time.perf_counter()
+        original = list(range(min(len(texts), top_k)))
+        if not self.enabled:
+            return RerankResult(original, status="disabled")
+        model = self._model
+        if model is None:
+            return self._finish(RerankResult(original, status="not_ready"), start)
+
+        budget = self._settings.reranker_budget_ms / 1000
+        batch_size = max(1, self._settings.reranker_batch_size)
+        scores: List[float] = []
+        batch_duration = 0.0
+        try:
+            for offset in range(0, len(texts), batch_size):
+                elapsed = time.perf_counter() - start
+                # Пакет не прерывается на середине: не начинаем тот, что не успеет по оценке предыдущего
+                if budget > 0 and elapsed + batch_duration > budget:
+                    return self._finish(RerankResult(original, status="budget"), start)
+                batch_start = time.perf_counter()
+                batch = [(query, text) for text in texts[offset : offset + batch_size]]
+                scores.extend(float(value) for value in model.score(batch))
+                batch_duration = time.perf_counter() - batch_start
+        except Exception as exc:
+            logger.warning("Переранжирование не удалось, исходный порядок: %s", exc)
+            return self._finish(RerankResult(original, status="error"), start)
+
+        # Устойчивая сортировка: при равных оценках сохраняется порядок поиска
+        order = sorted(range(len(scores)), key=lambda i: -scores[i])[:top_k]
+        return self._finish(RerankResult(order, {i: scores[i] for i in order}), start)
+
+    def _finish(self, result: RerankResult, start: float) -> RerankResult:
+        result.duration = time.perf_counter() - start
+        with self._stats_lock:
+            self._stats[result.status] += 1
+        return result
+
+    def stats(self) -> Dict[str, object]:
+        with self._stats_lock:
+            counts = dict(self._stats)
+        return {
+            "enabled": self.enabled,
+            "ready": self._model is not None,
+            "model": self._settings.reranker_model,
+            "requests": counts,
+        }
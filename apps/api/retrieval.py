@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from typing import Dict, List, Sequence
+
+from .db import Database
+from .faiss_store import FaissHit
+
+
+CHUNKS_SQL = """
+SELECT c.chunk_id, c.page_id, c.section_path, c.text, c.source_order,
+       p.page_id AS page_page_id, p.url AS page_url, p.title AS page_title
+FROM text_chunks c
+LEFT JOIN pages p ON p.page_id = c.page_id
+WHERE c.chunk_id = ANY(%s)
+"""
+
+# Таблицы в окне |t.source_order - c.source_order| <= window вокруг каждого чанка
+TABLES_WINDOW_SQL = """
+SELECT c.chunk_id AS hit_chunk_id, t.table_id, t.source_order, t.caption, t.columns, t.rows
+FROM text_chunks c
+JOIN LATERAL (
+    SELECT table_id, source_order, caption, columns, rows
+    FROM tables
+    WHERE tables.page_id = c.page_id
+      AND abs(tables.source_order - c.source_order) <= %s
+) t ON TRUE
+WHERE c.chunk_id = ANY(%s)
+ORDER BY c.chunk_id, t.source_order, t.table_id
+"""
+
+# window == 0: одна ближайшая таблица на чанк
+TABLES_NEAREST_SQL = """
+SELECT c.chunk_id AS hit_chunk_id, t.table_id, t.source_order, t.caption, t.columns, t.rows
+FROM text_chunks c
+JOIN LATERAL (
+    SELECT table_id, source_order, caption, columns, rows
+    FROM tables
+    WHERE tables.page_id = c.page_id
+    ORDER BY abs(tables.source_order - c.source_order), tables.source_order, tables.table_id
+    LIMIT 1
+) t ON TRUE
+WHERE c.chunk_id = ANY(%s)
+"""
+
+
+# Нужны внутри (раскладка промпта по source_order), но не входят в публичный payload /context и /rag
+INTERNAL_FIELDS = ("source_order",)
+
+
+def public_sources(sources: Sequence[Dict[str, object]]) -> List[Dict[str, object]]:
+    return [{key: value for key, value in source.items() if key not in INTERNAL_FIELDS} for source in sources]
+
+
+def fetch_sources(db: Database, hits: Sequence[FaissHit], tables_window: int) -> List[Dict[str, object]]:
+    """Загружает чанки, страницы и таблицы для всех хитов за два запроса"""
+    return fetch_sources_many(db, [hits], tables_window)[0]
+
+
+def fetch_sources_many(
+    db: Database, hits_per_query: Sequence[Sequence[FaissHit]], tables_window: int
+) -> List[List[Dict[str, object]]]:
+    """То же для пакета запросов: два запроса на все хиты всех запросов (/context/batch)"""
+    chunk_ids = list({hit.chunk_id for hits in hits_per_query for hit in hits})
+    if not chunk_ids:
+        return [[] for _ in hits_per_query]
+    with db.connection() as conn:
+        chunk_rows = db.fetch_all_with_connection(conn, CHUNKS_SQL, (chunk_ids,))
+        if tables_window == 0:
+            table_rows = db.fetch_all_with_connection(conn, TABLES_NEAREST_SQL, (chunk_ids,))
+        else:
+            table_rows = db.fetch_all_with_connection(
+                conn, TABLES_WINDOW_SQL, (tables_window, chunk_ids)
+            )
+
+    chunks = {row["chunk_id"]: row for row in chunk_rows}
+    tables_by_chunk: Dict[str, List[Dict[str, object]]] = {}
+    for row in table_rows:
+        chunk_id = row.pop("hit_chunk_id")
+        tables_by_chunk.setdefault(chunk_id, []).append(row)
+
+    results: List[List[Dict[str, object]]] = []
+    for hits in hits_per_query:
+        sources: List[Dict[str, object]] = []
+        for hit in hits:
+            chunk = chunks.get(hit.chunk_id)
+            if not chunk:
+                continue
+            has_page = chunk["page_page_id"] is not None
+            sources.append(
+                {
+                    "page_id": chunk["page_id"],
+                    "url": chunk["page_url"] if has_page else hit.url,
+                    "title": chunk["page_title"] if has_page else None,
+                    "chunk_id": chunk["chunk_id"],
+                    "source_order": chunk["source_order"],
+                    "score": hit.score,
+                    "section_path": chunk["section_path"],
+                    "text": chunk["text"],
+                    "tables": [dict(table) for table in tables_by_chunk.get(hit.chunk_id, [])],
+                }
+            )
+        results.append(sources)
+    return results
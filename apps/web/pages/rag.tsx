@@ -12,25 +12,76 @@ interface RagSource {
   text: string;
 }
 
+interface RagTimings {
+  retrieval_duration: number;
+  generation_duration: number;
+  time_to_first_token: number | null;
+}
+
+// Разбирает SSE-поток /rag/stream: события разделены пустой строкой
+async function readEvents(
+  res: Response,
+  onEvent: (event: string, data: any) => void
+): Promise<void> {
+  const reader = res.body!.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    let boundary = buffer.indexOf('\n\n');
+    while (boundary !== -1) {
+      const raw = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = 'message';
+      const dataLines: string[] = [];
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+          dataLines.push(line.slice(5).trim());
+        }
+      }
+      if (dataLines.length > 0) {
+        onEvent(event, JSON.parse(dataLines.join('\n')));
+      }
+      boundary = buffer.indexOf('\n\n');
+    }
+  }
+}
+
 export default function RagPage() {
   const [query, setQuery] = useState('');
   const [answer, setAnswer] = useState('');
   const [sources, setSources] = useState<RagSource[]>([]);
+  const [timings, setTimings] = useState<RagTimings | null>(null);
   const [loading, setLoading] = useState(false);
 
   const onAsk = async () => {
     setLoading(true);
     setAnswer('');
     setSources([]);
+    setTimings(null);
     try {
-      const res = await fetch(apiUrl('/rag'), {
+      const res = await fetch(apiUrl('/rag/stream'), {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ query })
       });
-      const data = await res.json();
-      setAnswer(data.answer || '');
-      setSources(data.sources || []);
+      await readEvents(res, (event, data) => {
+        if (event === 'sources') {
+          setSources(data.sources || []);
+        } else if (event === 'token') {
+          setAnswer((prev) => prev + (data.delta || ''));
+        } else if (event === 'error') {
+          setAnswer(data.answer || data.error || '');
+        } else if (event === 'done') {
+          setTimings(data);
+        }
+      });
     } finally {
       setLoading(false);
     }
@@ -58,7 +109,14 @@ export default function RagPage() {
       {answer ? (
         <div className="card">
           <h3>Ответ</h3>
-          <p>{answer}</p>
+          <p style={{ whiteSpace: 'pre-wrap' }}>{answer}</p>
+          {timings ? (
+            <div className="block-meta">
+              Поиск: {timings.retrieval_duration.toFixed(2)} с · Первый токен:{' '}
+              {timings.time_to_first_token !== null ? `${timings.time_to_first_token.toFixed(2)} с` : '—'} ·
+              Генерация: {timings.generation_duration.toFixed(2)} с
+            </div>
+          ) : null}
         </div>
       ) : null}
       {sources.length > 0 ? (
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк выборки источников для /context: старый путь (по три запроса на хит)
+против пакетного apps.api.retrieval.fetch_sources.
+
+Запуск из корня репозитория:
+    PYTHONPATH=. python scripts/bench/bench_context.py --top-k 50 --iterations 200
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from apps.api.config import get_settings
+from apps.api.db import Database
+from apps.api.faiss_store import FaissHit
+from apps.api.retrieval import fetch_sources, public_sources
+
+
+def legacy_fetch_sources(db: Database, hits: List[FaissHit], tables_window: int) -> List[Dict[str, object]]:
+    """Прежняя реализация /context: chunk + page + tables на каждый хит"""
+    sources = []
+    for hit in hits:
+        chunk = db.fetch_one(
+            """
+            SELECT chunk_id, page_id, section_path, text, source_order
+            FROM text_chunks
+            WHERE chunk_id = %s
+            """,
+            (hit.chunk_id,),
+        )
+        if not chunk:
+            continue
+        page = db.fetch_one(
+            "SELECT page_id, url, title FROM pages WHERE page_id = %s", (chunk["page_id"],)
+        )
+        tables = db.fetch_all(
+            """
+            SELECT table_id, source_order, caption, columns, rows
+            FROM tables
+            WHERE page_id = %s
+            ORDER BY source_order, table_id
+            """,
+            (chunk["page_id"],),
+        )
+        if tables and tables_window == 0:
+            tables = [min(tables, key=lambda t: abs(t["source_order"] - chunk["source_order"]))]
+        elif tables:
+            tables = [t for t in tables if abs(t["source_order"] - chunk["source_order"]) <= tables_window]
+        sources.append(
+            {
+                "page_id": chunk["page_id"],
+                "url": page.get("url") if page else hit.url,
+                "title": page.get("title") if page else None,
+                "chunk_id": chunk["chunk_id"],
+                "score": hit.score,
+                "section_path": chunk["section_path"],
+                "text": chunk["text"],
+                "tables": tables,
+            }
+        )
+    return sources
+
+
+def sample_hits(db: Database, count: int) -> List[FaissHit]:
+    rows = db.fetch_all(
+        """
+        SELECT chunk_id, page_id, source_order
+        FROM text_chunks
+        ORDER BY random()
+        LIMIT %s
+        """,
+        (count,),
+    )
+    return [
+        FaissHit(
+            chunk_id=row["chunk_id"],
+            page_id=row["page_id"],
+            url="",
+            score=1.0 - idx / max(count, 1),
+            section_path=[],
+            source_order=int(row["source_order"] or 0),
+            text_preview="",
+        )
+        for idx, row in enumerate(rows)
+    ]
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    pos = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[pos]
+
+
+def measure(name: str, fn: Callable[[], object], iterations: int) -> None:
+    durations: List[float] = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    print(
+        f"{name:<8} p50={percentile(durations, 0.5):8.2f}ms "
+        f"p99={percentile(durations, 0.99):8.2f}ms "
+        f"mean={statistics.mean(durations):8.2f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк выборки источников /context")
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--tables-window", type=int, default=2)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=13)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    db = Database(get_settings())
+    hit_sets = [sample_hits(db, args.top_k) for _ in range(8)]
+
+    # Оба пути должны отдавать одинаковый payload
+    for hits in hit_sets:
+        # source_order — внутреннее поле пакетного пути, в ответ /context оно не попадает
+        batched = public_sources(fetch_sources(db, hits, args.tables_window))
+        if legacy_fetch_sources(db, hits, args.tables_window) != batched:
+            raise SystemExit("Расхождение payload между старым и пакетным путём")
+
+    print(f"top_k={args.top_k} tables_window={args.tables_window} iterations={args.iterations}")
+    measure("legacy", lambda: legacy_fetch_sources(db, random.choice(hit_sets), args.tables_window), args.iterations)
+    measure("batched", lambda: fetch_sources(db, random.choice(hit_sets), args.tables_window), args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк провайдеров эмбеддингов API: sentence-transformers (torch) против ONNX Runtime
+(fp32 и int8 из scripts/export_onnx/export_onnx.py).
+
+Для каждого провайдера печатаются время загрузки, p50/p99 одного вызова embed на пакетах
+разного размера и косинус с векторами torch (паритет для того же FAISS индекса).
+
+Запуск из корня репозитория:
+    PYTHONPATH=. python scripts/bench/bench_embeddings.py \\
+        --onnx data/derived/onnx/model.onnx data/derived/onnx/model.int8.onnx --threads 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from apps.api.config import get_settings
+from apps.api.embeddings import EmbeddingProvider, OnnxEmbeddingProvider, SentenceTransformersEmbeddingProvider
+
+QUERIES = [
+    "Одноэтажное здание без подвала, удельный вес конструкций",
+    "таблица 12 стоимость строительства",
+    "жилые дома кирпичные двухэтажные",
+    "восстановительная стоимость складских помещений",
+    "Что такое метод конечных элементов?",
+    "укрупненные показатели для гаражей",
+    "здания с подвалом, фундаменты ленточные",
+    "сборник 4 промышленные здания",
+]
+
+
+def load_texts(data_dir: Path, limit: int) -> List[str]:
+    texts = list(QUERIES)
+    path = data_dir / "text_chunks.jsonl"
+    if path.exists():
+        with path.open("r", encoding="utf-8") as handle:
+            for line in handle:
+                if len(texts) >= limit:
+                    break
+                if line.strip():
+                    text = json.loads(line).get("text") or ""
+                    if text:
+                        texts.append(text)
+    return texts[:limit]
+
+
+def measure(provider: EmbeddingProvider, texts: List[str], batch_size: int, iterations: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    for i in range(iterations):
+        start = (i * batch_size) % max(len(texts) - batch_size, 1)
+        batch = texts[start : start + batch_size]
+        began = time.perf_counter()
+        provider.embed(batch)
+        latencies.append((time.perf_counter() - began) * 1000)
+    ordered = sorted(latencies)
+    return {
+        "p50_ms": ordered[len(ordered) // 2],
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        "texts_per_sec": batch_size * len(latencies) / (sum(latencies) / 1000),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк провайдеров эмбеддингов: torch против ONNX")
+    parser.add_argument("--onnx", nargs="*", default=None, help="файлы ONNX; по умолчанию EMBEDDINGS_ONNX_PATH")
+    parser.add_argument("--threads", type=int, default=0, help="потоки torch и ONNX Runtime; 0 — по умолчанию")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--texts", type=int, default=512)
+    parser.add_argument("--no-torch", action="store_true", help="без torch: только задержка ONNX, без паритета")
+    args = parser.parse_args()
+
+    settings = get_settings()
+    texts = load_texts(Path(settings.data_raw_dir), args.texts)
+    onnx_paths = args.onnx if args.onnx is not None else [settings.embeddings_onnx_path]
+
+    providers: Dict[str, EmbeddingProvider] = {}
+    load_seconds: Dict[str, float] = {}
+    if not args.no_torch:
+        if args.threads > 0:
+            import torch
+
+            torch.set_num_threads(args.threads)
+        began = time.perf_counter()
+        providers["torch"] = SentenceTransformersEmbeddingProvider(settings.embeddings_model)
+        load_seconds["torch"] = time.perf_counter() - began
+    for path in onnx_paths:
+        began = time.perf_counter()
+        providers[Path(path).name] = OnnxEmbeddingProvider(path, settings.embeddings_model, args.threads)
+        load_seconds[Path(path).name] = time.perf_counter() - began
+
+    reference = providers["torch"].embed(texts) if "torch" in providers else None
+    print(f"Модель: {settings.embeddings_model}, текстов: {len(texts)}, потоков: {args.threads or 'default'}")
+    for name, provider in providers.items():
+        # Прогрев: первые вызовы ONNX Runtime и torch заметно медленнее
+        provider.embed(texts[:8])
+        parity = ""
+        if reference is not None and name != "torch":
+            cosine = (provider.embed(texts) * reference).sum(axis=1)
+            parity = f"  косинус с torch: mean={cosine.mean():.5f} min={cosine.min():.5f}"
+        print(f"{name}: загрузка {load_seconds[name]:.2f} с{parity}")
+        for batch_size in args.batch_sizes:
+            row = measure(provider, texts, batch_size, args.iterations)
+            print(
+                f"  batch={batch_size:<4} p50={row['p50_ms']:8.2f}ms p99={row['p99_ms']:8.2f}ms "
+                f"{row['texts_per_sec']:8.0f} текстов/с"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк раскладки промпта /rag под prefix caching: прежняя раскладка (вопрос в начале, источники по
+score с оценками, инструкции дважды) против apps.api.prompts.build_prompts (постоянный system, источники
+в порядке page_id/source_order, вопрос в конце).
+
+Запросы идут в локальный mock OpenAI-совместимого сервера со стримингом. Он имитирует автоматический
+prefix caching vLLM: промпт режется на блоки, блок с уже виденным префиксом не считается заново,
+остальные «считаются» с задержкой --prefill-ms-per-1k-chars. Нагрузка — группы вопросов к одному набору
+источников с разным порядком score (перефразы и уточнения). Печатаются размер промпта, доля префикса из
+кэша и p50/p95 time-to-first-token.
+
+Запуск из корня репозитория:
+    PYTHONPATH=. python scripts/bench/bench_prompt_cache.py --groups 20 --questions 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import httpx
+
+from apps.api.config import get_settings
+from apps.api.context_packer import ContextPacker
+from apps.api.prompts import build_prompts, format_tables
+
+QUESTIONS = [
+    "Удельный вес конструкций одноэтажного здания без подвала",
+    "Какая восстановительная стоимость по таблице 12?",
+    "Что входит в фундаменты для этих зданий?",
+    "Стоимость 1 м3 для кирпичных стен",
+    "Чем отличаются здания с подвалом?",
+    "Какие поправки применяются к укрупненным показателям?",
+    "Удельный вес перекрытий и кровли",
+]
+
+# Размер блока prefix cache в символах (в vLLM — 16 токенов, ~3 символа на токен)
+BLOCK_CHARS = 48
+
+
+class PrefixCacheSimulator:
+    """Цепочка хэшей блоков промпта, как в automatic prefix caching vLLM, с LRU-вытеснением"""
+
+    def __init__(self, capacity_blocks: int) -> None:
+        self._capacity = capacity_blocks
+        self._blocks: "OrderedDict[bytes, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.cached_chars = 0
+        self.total_chars = 0
+
+    def lookup(self, prompt: str) -> int:
+        """Возвращает число символов, которые нужно посчитать заново, и запоминает блоки"""
+        digest = hashlib.sha256()
+        cached = 0
+        full_blocks = len(prompt) // BLOCK_CHARS
+        with self._lock:
+            prefix_hit = True
+            for block in range(full_blocks):
+                digest.update(prompt[block * BLOCK_CHARS : (block + 1) * BLOCK_CHARS].encode("utf-8"))
+                key = digest.copy().digest()
+                if prefix_hit and key in self._blocks:
+                    self._blocks.move_to_end(key)
+                    cached += BLOCK_CHARS
+                    continue
+                prefix_hit = False
+                self._blocks[key] = None
+                if len(self._blocks) > self._capacity:
+                    self._blocks.popitem(last=False)
+            self.cached_chars += cached
+            self.total_chars += len(prompt)
+        return len(prompt) - cached
+
+
+def start_mock_server(cache: PrefixCacheSimulator, prefill_ms_per_1k: float, tokens: int, decode_ms: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args: object) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            # Так chat template склеивает сообщения: префикс — с начала system
+            prompt = "".join(f"<|{m['role']}|>\n{m['content']}\n" for m in body["messages"])
+            uncached = cache.lookup(prompt)
+            time.sleep(uncached / 1000 * prefill_ms_per_1k / 1000)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for _ in range(tokens):
+                data = json.dumps({"choices": [{"delta": {"content": "ок "}}]}, ensure_ascii=False)
+                self._chunk(f"data: {data}\n\n")
+                time.sleep(decode_ms / 1000)
+            self._chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, text: str) -> None:
+            payload = text.encode("utf-8")
+            self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+            self.wfile.flush()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_prompts(query: str, sources: List[Dict[str, object]]) -> Tuple[str, str]:
+    """Прежняя раскладка _build_prompts (без эвристик characteristics, на размер они почти не влияют)"""
+    system_prompt = (
+        "Ты помощник по справочнику UPVS (Укрупненные Показатели Восстановительной Стоимости). "
+        "Твоя задача - отвечать на вопросы, используя ТОЛЬКО информацию из предоставленных источников. "
+        "\n\n"
+        "КРИТИЧЕСКИ ВАЖНЫЕ ПРАВИЛА (применяются ко ВСЕМ таблицам): "
+        "- В источниках может быть НЕСКОЛЬКО похожих таблиц с РАЗНЫМИ номерами\n"
+        "- Источники отсортированы по релевантности - ПЕРВЫЙ источник обычно наиболее релевантный\n"
+        "- ВНИМАТЕЛЬНО сравнивай название таблицы с вопросом пользователя - они должны ТОЧНО совпадать\n"
+        "- Если в вопросе упоминается конкретный тип здания или характеристика, "
+        "используй ТОЛЬКО таблицу, которая содержит ЭТИ ЖЕ слова в названии\n"
+        "- Если вопрос содержит номер таблицы, используй ТОЛЬКО эту таблицу\n"
+        "- НЕ ПУТАЙ разные таблицы - даже если они похожи, они для РАЗНЫХ типов зданий/сооружений\n"
+        "- Если вопрос про удельный вес, найди раздел 'Удельные веса' в ПРАВИЛЬНОЙ таблице\n"
+        "- Отвечай конкретно, используя ТОЧНЫЕ числа из ПРАВИЛЬНОЙ таблицы\n"
+        "- ВСЕГДА указывай номер и название таблицы, из которой взяты данные"
+    )
+    chunks_text = []
+    ordered = sorted(sources, key=lambda x: x.get("score", 0), reverse=True)
+    for idx, source in enumerate(ordered, start=1):
+        chunk = f"\n{'='*60}\nИСТОЧНИК {idx} (релевантность: {source['score']:.3f})\n{'='*60}\n"
+        chunk += f"📋 НАЗВАНИЕ ТАБЛИЦЫ: {source['title']}\n🔗 URL: {source['url']}\n\n"
+        chunk += f"ТЕКСТ:\n{source['text']}\n\n"
+        tables_text = format_tables(source.get("tables", []))
+        if tables_text:
+            chunk += f"{tables_text}\n"
+        chunks_text.append(chunk)
+    user_prompt = (
+        f"ВОПРОС ПОЛЬЗОВАТЕЛЯ: {query}\n"
+        f"\nИСПОЛЬЗУЙ СЛЕДУЮЩИЕ ИСТОЧНИКИ ДЛЯ ОТВЕТА (отсортированы по релевантности):\n"
+        + "".join(chunks_text) + "\n" + "="*60 + "\n\n"
+        "ИНСТРУКЦИИ ПО ВЫБОРУ ПРАВИЛЬНОЙ ТАБЛИЦЫ (применяются ко ВСЕМ таблицам):\n"
+        "- Источники отсортированы по релевантности - первый обычно наиболее подходящий\n"
+        "- В источниках может быть НЕСКОЛЬКО похожих таблиц с РАЗНЫМИ номерами\n"
+        "- ВНИМАТЕЛЬНО сравнивай название таблицы с вопросом - они должны ТОЧНО совпадать\n"
+        "- Если в вопросе упоминается тип здания/сооружения, используй ТОЛЬКО таблицу, "
+        "которая содержит ЭТИ ЖЕ слова в названии\n"
+        "- Если вопрос содержит номер таблицы - используй ТОЛЬКО эту таблицу\n"
+        "- НЕ ПУТАЙ разные таблицы - даже похожие таблицы относятся к РАЗНЫМ типам зданий/сооружений\n"
+        "- Если вопрос про удельный вес, найди раздел 'Удельные веса' в ПРАВИЛЬНОЙ таблице\n"
+        "- Используй ТОЧНЫЕ данные из ПРАВИЛЬНОЙ таблицы - не придумывай числа\n"
+        "- В ответе ВСЕГДА указывай номер и название таблицы, из которой взяты данные\n\n"
+        "ОТВЕТЬ на вопрос пользователя, используя ТОЛЬКО информацию из ПРАВИЛЬНОЙ таблицы:"
+    )
+    return system_prompt, user_prompt
+
+
+def load_source_groups(data_dir: Path, groups: int, top_k: int, seed: int) -> List[List[Dict[str, object]]]:
+    """Наборы источников: чанки корпуса, если он есть, иначе синтетический текст"""
+    chunks: List[Dict[str, object]] = []
+    path = data_dir / "text_chunks.jsonl"
+    if path.exists():
+        with path.open("r", encoding="utf-8") as handle:
+            for line in handle:
+                if len(chunks) >= groups * top_k * 4:
+                    break
+                if line.strip():
+                    row = json.loads(line)
+                    if row.get("text"):
+                        chunks.append(row)
+    rng = random.Random(seed)
+    result = []
+    for group in range(groups):
+        sources = []
+        for position in range(top_k):
+            row = rng.choice(chunks) if chunks else {}
+            sources.append(
+                {
+                    "page_id": row.get("page_id", f"page-{group}-{position // 3}"),
+                    "chunk_id": row.get("chunk_id", f"chunk-{group}-{position}"),
+                    "source_order": int(row.get("source_order") or position),
+                    "title": f"Таблица {group + 1}. Укрупненные показатели",
+                    "url": f"https://example/{group}",
+                    "section_path": row.get("section_path") or [],
+                    "text": row.get("text") or "Укрупненные показатели восстановительной стоимости. " * 12,
+                    "tables": [],
+                }
+            )
+        result.append(sources)
+    return result
+
+
+async def run_layout(
+    name: str,
+    url: str,
+    requests: List[Tuple[str, List[Dict[str, object]]]],
+    packer: ContextPacker,
+    budget: int,
+) -> Dict[str, float]:
+    ttfts: List[float] = []
+    prompt_bytes: List[int] = []
+
+    async def one(client: httpx.AsyncClient, query: str, sources: List[Dict[str, object]]) -> None:
+        if name == "legacy":
+            system_prompt, user_prompt = legacy_prompts(query, sources)
+        else:
+            system_prompt, user_prompt, _ = build_prompts(query, sources, packer, budget)
+        prompt_bytes.append(len((system_prompt + user_prompt).encode("utf-8")))
+        payload = {
+            "model": "mock",
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            "stream": True,
+        }
+        started = time.perf_counter()
+        async with client.stream("POST", f"{url}/chat/completions", json=payload) as response:
+            first_token = None
+            async for line in response.aiter_lines():
+                if first_token is None and line.startswith("data:") and "content" in line:
+                    first_token = (time.perf_counter() - started) * 1000
+            ttfts.append(first_token or 0.0)
+
+    async with httpx.AsyncClient(timeout=60) as client:
+        for query, sources in requests:
+            # Вопросы одной группы приходят один за другим, как уточнения в диалоге
+            await one(client, query, sources)
+    ordered = sorted(ttfts)
+    return {
+        "prompt_kb": sum(prompt_bytes) / len(prompt_bytes) / 1024,
+        "ttft_p50": ordered[len(ordered) // 2],
+        "ttft_p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Prefix caching: прежняя раскладка промпта /rag против новой")
+    parser.add_argument("--groups", type=int, default=20, help="наборов источников")
+    parser.add_argument("--questions", type=int, default=5, help="вопросов к одному набору")
+    parser.add_argument("--top-k", type=int, default=6)
+    parser.add_argument("--budget", type=int, default=0, help="бюджет токенов; 0 — CONTEXT_TOKEN_BUDGET")
+    parser.add_argument("--prefill-ms-per-1k-chars", type=float, default=30.0)
+    parser.add_argument("--tokens", type=int, default=4, help="токенов ответа mock-сервера")
+    parser.add_argument("--decode-ms", type=float, default=5.0)
+    parser.add_argument("--cache-blocks", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=13)
+    args = parser.parse_args()
+
+    settings = get_settings()
+    packer = ContextPacker("approx", settings.vllm_model, settings.context_table_max_rows)
+    budget = args.budget or settings.context_token_budget
+    rng = random.Random(args.seed)
+    requests: List[Tuple[str, List[Dict[str, object]]]] = []
+    for sources in load_source_groups(Path(settings.data_raw_dir), args.groups, args.top_k, args.seed):
+        for question in range(args.questions):
+            # Другой вопрос к тем же источникам — другой порядок score
+            scored = [dict(source, score=rng.random()) for source in sources]
+            requests.append((QUESTIONS[question % len(QUESTIONS)], scored))
+
+    print(f"Запросов: {len(requests)} ({args.groups} наборов x {args.questions} вопросов), бюджет {budget} токенов")
+    for layout in ("legacy", "prefix"):
+        cache = PrefixCacheSimulator(args.cache_blocks)
+        server = start_mock_server(cache, args.prefill_ms_per_1k_chars, args.tokens, args.decode_ms)
+        url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        try:
+            row = asyncio.run(run_layout(layout, url, requests, packer, budget))
+        finally:
+            server.shutdown()
+        hit_ratio = cache.cached_chars / cache.total_chars if cache.total_chars else 0.0
+        print(
+            f"{layout:<7} промпт {row['prompt_kb']:6.1f} КБ  из кэша {hit_ratio:6.1%}  "
+            f"TTFT p50={row['ttft_p50']:7.1f}ms p95={row['ttft_p95']:7.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
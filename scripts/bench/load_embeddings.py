@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест микро-батчинга эмбеддингов: N конкурентных клиентов,
+каждый эмбеддит по одному запросу, как обработчики /search в threadpool.
+
+Сравниваются прямые вызовы модели из всех потоков и BatchingEmbeddingProvider.
+С --faiss дополнительно гоняется FaissStore.search (индекс из настроек API)
+без батчинга и с батчингом поиска.
+
+Запуск из корня репозитория:
+    PYTHONPATH=. python scripts/bench/load_embeddings.py --clients 32 64 128 --window-ms 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import threading
+import time
+from typing import Callable, List
+
+from apps.api.config import get_settings
+from apps.api.embeddings import BatchingEmbeddingProvider, get_provider
+from apps.api.faiss_store import FaissStore
+
+QUERIES = [
+    "Одноэтажное здание без подвала, удельный вес конструкций",
+    "таблица 12 стоимость строительства",
+    "жилые дома кирпичные двухэтажные",
+    "восстановительная стоимость складских помещений",
+    "Что такое метод конечных элементов?",
+    "укрупненные показатели для гаражей",
+    "здания с подвалом, фундаменты ленточные",
+    "сборник 4 промышленные здания",
+]
+
+
+def run_load(name: str, call: Callable[[str], object], clients: int, requests_per_client: int) -> None:
+    latencies: List[float] = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def worker(offset: int) -> None:
+        local: List[float] = []
+        barrier.wait()
+        for i in range(requests_per_client):
+            # Уникальный текст, чтобы не мерить кэши
+            query = f"{QUERIES[(offset + i) % len(QUERIES)]} #{offset}-{i}"
+            start = time.perf_counter()
+            call(query)
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    total = clients * requests_per_client
+    print(
+        f"{name:<16} clients={clients:<4} qps={total / elapsed:8.1f} "
+        f"p50={latencies[len(latencies) // 2]:8.2f}ms "
+        f"p99={latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:8.2f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест батчинга эмбеддингов")
+    parser.add_argument("--clients", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--requests", type=int, default=20, help="запросов на клиента")
+    parser.add_argument("--window-ms", type=float, default=3.0)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--faiss", action="store_true", help="также нагрузить FaissStore.search")
+    args = parser.parse_args()
+
+    settings = get_settings()
+    provider = get_provider(
+        settings.embeddings_provider,
+        settings.embeddings_model,
+        settings.vllm_url,
+        onnx_path=settings.embeddings_onnx_path,
+        onnx_threads=settings.embeddings_onnx_threads,
+    )
+    batching = BatchingEmbeddingProvider(provider, args.window_ms / 1000, args.max_batch)
+    provider.embed(["прогрев модели"])
+
+    for clients in args.clients:
+        run_load("embed direct", lambda q: provider.embed([q]), clients, args.requests)
+        run_load("embed batched", lambda q: batching.embed([q]), clients, args.requests)
+
+    if args.faiss:
+        base = dataclasses.replace(settings, embedding_cache_size=0, embedding_batch_window_ms=0)
+        direct_store = FaissStore(dataclasses.replace(base, search_batch_window_ms=0))
+        batched_store = FaissStore(
+            dataclasses.replace(
+                base, search_batch_window_ms=args.window_ms, search_batch_max_size=args.max_batch
+            )
+        )
+        direct_store.search("прогрев", 8)
+        batched_store.search("прогрев", 8)
+        for clients in args.clients:
+            run_load("search direct", lambda q: direct_store.search(q, 8), clients, args.requests)
+            run_load("search batched", lambda q: batched_store.search(q, 8), clients, args.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,47 @@ from __future__ import annotations
 
 import argparse
 import csv
+import functools
+import hashlib
 import json
 import os
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Generator, List
+from typing import BinaryIO, Dict, Generator, List, Optional, Set, Tuple
 
 import faiss
 import numpy as np
 import requests
-from sentence_transformers import SentenceTransformer
+
+# Корень репозитория (в Docker — PYTHONPATH=/app): эмбеддинги ONNX общие с API
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from apps.api.onnx_embedding import OnnxEmbeddingModel, onnx_model_digest
+from embedding_cache import EmbeddingDiskCache, cache_dir_for, text_key
+from pipeline import EmbeddingPipeline
+from index_types import (
+    IndexSpec,
+    add_in_chunks,
+    apply_runtime_params,
+    create_index,
+    default_runtime_params,
+    evaluate_recall,
+    exact_neighbors,
+    parse_index_type,
+    runtime_sweep,
+    sample_queries,
+    stored_vectors,
+    supports_remove,
+    train_index,
+    training_sample,
+)
 
 
 def read_jsonl(path: Path) -> Generator[dict, None, None]:
@@ -29,6 +60,252 @@ class ChunkMeta:
     section_path: List[str]
     source_order: int
     text_preview: str
+    id: int
+    text_hash: str
+
+
+def stable_id(chunk_id: str) -> int:
+    """Стабильный неотрицательный int64 id вектора, выведенный из chunk_id"""
+    digest = hashlib.blake2b(chunk_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") & 0x7FFF_FFFF_FFFF_FFFF
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Каждая сборка пишется в свой каталог generations/<время>; API читает то, на что указывает current
+GENERATIONS_DIR = "generations"
+CURRENT_LINK = "current"
+# Ссылки для читателей старой раскладки (FAISS_INDEX_PATH и т.п.)
+GENERATION_FILES = ("index.faiss", "id_map.bin", "id_map.jsonl", "meta.json")
+
+
+def current_generation_dir(output_dir: Path) -> Path:
+    """Каталог текущей сборки; у сборок до поколений файлы лежат прямо в output_dir"""
+    current = output_dir / CURRENT_LINK
+    return current.resolve() if current.exists() else output_dir
+
+
+def new_generation_dir(output_dir: Path) -> Path:
+    root = output_dir / GENERATIONS_DIR
+    root.mkdir(parents=True, exist_ok=True)
+    name = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    directory = root / name
+    suffix = 1
+    while directory.exists():
+        suffix += 1
+        directory = root / f"{name}-{suffix}"
+    directory.mkdir()
+    return directory
+
+
+def replace_symlink(link: Path, target: str) -> None:
+    tmp_link = link.with_name(link.name + ".tmp")
+    if tmp_link.is_symlink() or tmp_link.exists():
+        tmp_link.unlink()
+    tmp_link.symlink_to(target)
+    os.replace(tmp_link, link)
+
+
+def publish_generation(output_dir: Path, generation_dir: Path) -> None:
+    """Атомарно переключает current на готовое поколение"""
+    replace_symlink(output_dir / CURRENT_LINK, f"{GENERATIONS_DIR}/{generation_dir.name}")
+    for name in GENERATION_FILES:
+        replace_symlink(output_dir / name, f"{CURRENT_LINK}/{name}")
+
+
+def prune_generations(output_dir: Path, keep: int) -> List[str]:
+    """Удаляет поколения старше текущего, кроме keep - 1 последних готовых (для отката)"""
+    root = output_dir / GENERATIONS_DIR
+    current = (output_dir / CURRENT_LINK).resolve().name
+    older = sorted(path.name for path in root.iterdir() if path.is_dir() and path.name < current)
+    complete = [name for name in older if (root / name / "meta.json").exists()]
+    kept = set(complete[max(0, len(complete) - (keep - 1)) :])
+    removed = [name for name in older if name not in kept]
+    for name in removed:
+        # API с открытым старым поколением не пострадает: индекс в памяти, mmap держит inode
+        shutil.rmtree(root / name, ignore_errors=True)
+    return removed
+
+
+# Формат id_map.bin должен совпадать с apps/api/id_map.py (MmapIdMap)
+ID_MAP_MAGIC = b"UPVSIDM1"
+ID_MAP_STRING_COLUMNS = ("chunk_id", "page_id", "url", "section_path", "text_preview", "text_hash")
+ID_MAP_NUMBER_COLUMNS = {"source_order": "<i4", "id": "<i8"}
+# Строятся при закрытии: id по возрастанию и номера их строк, для searchsorted в API
+ID_MAP_SORTED_COLUMNS = {"sorted_id": "<i8", "sorted_row": "<i8"}
+
+
+def _align8(value: int) -> int:
+    return (value + 7) & ~7
+
+
+class IdMapWriter:
+    """Потоковая запись колоночного id_map.bin (и id_map.jsonl): колонки копятся во временных файлах"""
+
+    def __init__(self, path: Path, jsonl_path: Optional[Path] = None) -> None:
+        self._path = path
+        self._jsonl_path = jsonl_path
+        self._tmp = tempfile.TemporaryDirectory(dir=path.parent)
+        tmp_dir = Path(self._tmp.name)
+        self._jsonl = (tmp_dir / "id_map.jsonl").open("w", encoding="utf-8") if jsonl_path else None
+        self._heaps: Dict[str, BinaryIO] = {}
+        self._offsets: Dict[str, BinaryIO] = {}
+        self._heap_sizes: Dict[str, int] = {}
+        for name in ID_MAP_STRING_COLUMNS:
+            self._heaps[name] = (tmp_dir / f"{name}.heap").open("w+b")
+            self._offsets[name] = (tmp_dir / f"{name}.offsets").open("w+b")
+            self._offsets[name].write(struct.pack("<Q", 0))
+            self._heap_sizes[name] = 0
+        self._numbers: Dict[str, BinaryIO] = {
+            name: (tmp_dir / f"{name}.values").open("w+b") for name in ID_MAP_NUMBER_COLUMNS
+        }
+        self._count = 0
+
+    def add(self, meta: ChunkMeta) -> None:
+        values = {
+            "chunk_id": meta.chunk_id,
+            "page_id": meta.page_id,
+            "url": meta.url,
+            "section_path": json.dumps(meta.section_path, ensure_ascii=False),
+            "text_preview": meta.text_preview,
+            "text_hash": meta.text_hash,
+        }
+        for name in ID_MAP_STRING_COLUMNS:
+            data = values[name].encode("utf-8")
+            self._heaps[name].write(data)
+            self._heap_sizes[name] += len(data)
+            self._offsets[name].write(struct.pack("<Q", self._heap_sizes[name]))
+        self._numbers["source_order"].write(struct.pack("<i", meta.source_order))
+        self._numbers["id"].write(struct.pack("<q", meta.id))
+        self._count += 1
+        if self._jsonl is not None:
+            record = {
+                "id": meta.id,
+                "chunk_id": meta.chunk_id,
+                "page_id": meta.page_id,
+                "url": meta.url,
+                "section_path": meta.section_path,
+                "source_order": meta.source_order,
+                "text_preview": meta.text_preview,
+                "text_hash": meta.text_hash,
+            }
+            self._jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _write_sorted_ids(self) -> None:
+        ids_file = self._numbers["id"]
+        ids_file.flush()
+        ids = np.fromfile(ids_file.name, dtype="<i8", count=self._count)
+        order = np.argsort(ids, kind="stable")
+        tmp_dir = Path(self._tmp.name)
+        for name, values in (("sorted_id", ids[order]), ("sorted_row", order)):
+            handle = (tmp_dir / f"{name}.values").open("w+b")
+            handle.write(values.astype("<i8").tobytes())
+            self._numbers[name] = handle
+
+    def _sections(self) -> List[BinaryIO]:
+        sections: List[BinaryIO] = []
+        for name in ID_MAP_STRING_COLUMNS:
+            sections.extend([self._offsets[name], self._heaps[name]])
+        sections.extend(self._numbers[name] for name in self._number_dtypes())
+        return sections
+
+    def _number_dtypes(self) -> Dict[str, str]:
+        return {**ID_MAP_NUMBER_COLUMNS, **ID_MAP_SORTED_COLUMNS}
+
+    def _header(self, data_start: int) -> Dict[str, object]:
+        columns: Dict[str, Dict[str, object]] = {}
+        position = data_start
+        for name in ID_MAP_STRING_COLUMNS:
+            offsets_at = position
+            position = _align8(position + (self._count + 1) * 8)
+            columns[name] = {"type": "str", "offsets": offsets_at, "heap": position}
+            position = _align8(position + self._heap_sizes[name])
+        for name, dtype in self._number_dtypes().items():
+            columns[name] = {"type": dtype, "offset": position}
+            position = _align8(position + self._count * np.dtype(dtype).itemsize)
+        return {"count": self._count, "columns": columns}
+
+    def close(self) -> None:
+        self._write_sorted_ids()
+        # Длина заголовка зависит от смещений, а смещения — от длины заголовка
+        header_len = 256
+        while True:
+            data_start = _align8(16 + header_len)
+            header = json.dumps(self._header(data_start)).encode("utf-8")
+            if len(header) <= header_len:
+                header = header.ljust(header_len)
+                break
+            header_len = len(header)
+
+        tmp_path = self._path.with_name(self._path.name + ".tmp")
+        with tmp_path.open("wb") as out:
+            out.write(struct.pack("<8sQ", ID_MAP_MAGIC, header_len))
+            out.write(header)
+            for section in self._sections():
+                out.write(b"\0" * (_align8(out.tell()) - out.tell()))
+                section.flush()
+                section.seek(0)
+                shutil.copyfileobj(section, out)
+                section.close()
+        os.replace(tmp_path, self._path)
+        if self._jsonl is not None:
+            self._jsonl.close()
+            os.replace(self._jsonl.name, self._jsonl_path)
+        self._tmp.cleanup()
+
+    def discard(self) -> None:
+        """Бросает запись: файлы сборки остаются прежними"""
+        for handle in [*self._heaps.values(), *self._offsets.values(), *self._numbers.values()]:
+            handle.close()
+        if self._jsonl is not None:
+            self._jsonl.close()
+        self._tmp.cleanup()
+
+
+class VectorStaging:
+    """Векторы сборки во временном файле рядом с индексом; читаются обратно через np.memmap"""
+
+    def __init__(self, directory: Path, dimension: int) -> None:
+        self._tmp = tempfile.TemporaryDirectory(dir=directory)
+        self.dimension = dimension
+        self.count = 0
+        self._vectors_path = Path(self._tmp.name) / "vectors.f32"
+        self._ids_path = Path(self._tmp.name) / "ids.i8"
+        self._vectors_file = self._vectors_path.open("wb")
+        self._ids_file = self._ids_path.open("wb")
+
+    def append(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        self._vectors_file.write(np.ascontiguousarray(vectors, dtype="<f4").tobytes())
+        self._ids_file.write(np.ascontiguousarray(ids, dtype="<i8").tobytes())
+        self.count += len(ids)
+
+    def vectors(self) -> np.ndarray:
+        self._vectors_file.flush()
+        return np.memmap(self._vectors_path, dtype="<f4", mode="r", shape=(self.count, self.dimension))
+
+    def ids(self) -> np.ndarray:
+        self._ids_file.flush()
+        return np.memmap(self._ids_path, dtype="<i8", mode="r", shape=(self.count,))
+
+    def close(self) -> None:
+        self._vectors_file.close()
+        self._ids_file.close()
+        self._tmp.cleanup()
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Пиковый RSS сборки и самого тяжелого из завершившихся процессов эмбеддинга, МБ"""
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "main": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "workers": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
 
 
 class EmbeddingProvider:
@@ -38,6 +315,9 @@ class EmbeddingProvider:
 
 class SentenceTransformersEmbeddingProvider(EmbeddingProvider):
     def __init__(self, model_name: str) -> None:
+        # Процессы конвейера с onnx не тянут torch
+        from sentence_transformers import SentenceTransformer
+
         self._model = SentenceTransformer(model_name)
 
     def embed(self, texts: List[str]) -> np.ndarray:
@@ -45,6 +325,10 @@ class SentenceTransformersEmbeddingProvider(EmbeddingProvider):
         return np.asarray(embeddings, dtype="float32")
 
 
+class OnnxEmbeddingProvider(OnnxEmbeddingModel, EmbeddingProvider):
+    """ONNX Runtime: тот же код, что считает векторы запросов в API (apps/api/onnx_embedding.py)"""
+
+
 class HttpEmbeddingProvider(EmbeddingProvider):
     def __init__(self, url: str) -> None:
         self._url = url.rstrip("/")
@@ -61,12 +345,25 @@ class HttpEmbeddingProvider(EmbeddingProvider):
         return np.asarray(vectors, dtype="float32")
 
 
-def get_provider(provider: str, model_name: str, http_url: str) -> EmbeddingProvider:
+def get_provider(
+    provider: str, model_name: str, http_url: str, onnx_path: str = "", onnx_threads: int = 0
+) -> EmbeddingProvider:
     if provider == "http":
         return HttpEmbeddingProvider(http_url)
+    if provider == "onnx":
+        return OnnxEmbeddingProvider(onnx_path, model_name, onnx_threads)
     return SentenceTransformersEmbeddingProvider(model_name)
 
 
+def embedding_cache_dir(root: Path, provider: str, model_name: str, onnx_path: str) -> Path:
+    """Каталог дискового кэша эмбеддингов для провайдера и модели"""
+    if provider == "onnx":
+        # fp32 и int8 экспорт (и повторный экспорт под тем же именем) дают разные векторы:
+        # кэш привязан к содержимому файла модели, как embedding_namespace в API
+        provider = f"onnx:{onnx_model_digest(onnx_path)}"
+    return cache_dir_for(root, provider, model_name)
+
+
 def load_page_info(pages_path: Path) -> Dict[str, Dict[str, str]]:
     """Загружает информацию о страницах: url и title"""
     page_info: Dict[str, Dict[str, str]] = {}
@@ -98,11 +395,75 @@ def load_table_captions(tables_path: Path) -> Dict[str, List[str]]:
     return table_captions
 
 
+def load_previous_build(
+    previous_dir: Path, provider_name: str, model_name: str, index_type: str
+) -> Optional[Tuple[Dict[str, str], Dict[str, object]]]:
+    """(chunk_id -> text_hash, meta) прошлой сборки, если ее можно дополнить; иначе None"""
+    meta_path = previous_dir / "meta.json"
+    map_path = previous_dir / "id_map.jsonl"
+    if not (meta_path.exists() and map_path.exists() and (previous_dir / "index.faiss").exists()):
+        print("--update: прошлой сборки нет, полная сборка")
+        return None
+    with meta_path.open("r", encoding="utf-8") as handle:
+        meta = json.load(handle)
+    if meta.get("id_mode") != "stable":
+        print("--update: индекс собран без стабильных id, полная сборка")
+        return None
+    if (meta.get("provider"), meta.get("model"), meta.get("index_type")) != (provider_name, model_name, index_type):
+        print("--update: изменились модель или тип индекса, полная сборка")
+        return None
+    hashes = {str(record["chunk_id"]): str(record.get("text_hash") or "") for record in read_jsonl(map_path)}
+    return hashes, meta
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Сборка FAISS индекса для UPVS")
     parser.add_argument("--data-dir", default="data/raw")
     parser.add_argument("--output-dir", default="data/derived/faiss")
     parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="процессов эмбеддинга; у каждого своя копия модели и cpu_count/workers потоков",
+    )
+    parser.add_argument(
+        "--index-type",
+        default="flat",
+        help="flat | hnsw[M] | ivf{nlist}[,pq{m}] | opq[{m},ivf{nlist},pq{m}]",
+    )
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, default=None, help="nprobe по умолчанию для IVF")
+    parser.add_argument("--ef-search", type=int, default=None, help="efSearch по умолчанию для HNSW")
+    parser.add_argument("--recall-queries", type=int, default=200)
+    parser.add_argument("--recall-k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=13)
+    parser.add_argument(
+        "--changeset",
+        default=None,
+        help="changeset.json из load_all.py --incremental: без изменений чанков индекс не пересобирается",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="дополнить прошлую сборку: эмбеддятся только новые и измененные чанки, удаленные убираются",
+    )
+    parser.add_argument(
+        "--embedding-cache",
+        default=None,
+        help="каталог дискового кэша эмбеддингов (по умолчанию рядом с --output-dir; none — не использовать)",
+    )
+    parser.add_argument(
+        "--keep-generations",
+        type=int,
+        default=3,
+        help="сколько готовых поколений индекса хранить, включая текущее (остальные — для отката)",
+    )
+    parser.add_argument(
+        "--compact-embedding-cache",
+        action="store_true",
+        help="после сборки удалить из кэша векторы текстов, которых нет в текущем корпусе",
+    )
     args = parser.parse_args()
 
     provider_name = os.getenv("EMBEDDINGS_PROVIDER", "st")
@@ -110,6 +471,11 @@ def main() -> None:
         "EMBEDDINGS_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
     )
     http_url = os.getenv("EMBEDDINGS_HTTP_URL", "http://localhost:8000/v1")
+    onnx_path = os.getenv("EMBEDDINGS_ONNX_PATH", "data/derived/onnx/model.int8.onnx")
+    # Как у torch в конвейере: ядра делятся между процессами
+    onnx_threads = int(os.getenv("EMBEDDINGS_ONNX_THREADS", "0")) or (
+        max(1, (os.cpu_count() or 1) // args.workers) if args.workers > 1 else 0
+    )
 
     data_dir = Path(args.data_dir)
     chunks_path = data_dir / "text_chunks.jsonl"
@@ -122,95 +488,276 @@ def main() -> None:
 
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-
-    provider = get_provider(provider_name, model_name, http_url)
+    previous_dir = current_generation_dir(output_dir)
+
+    if args.changeset and (previous_dir / "index.faiss").exists():
+        with Path(args.changeset).open("r", encoding="utf-8") as handle:
+            changeset = json.load(handle)
+        if not any(changeset["chunks"].values()) and not any(changeset["pages"].values()):
+            print("Changeset пуст: индекс актуален, пересборка не нужна")
+            return
+
+    embedding_cache = None
+    cache_root = args.embedding_cache or str(output_dir.parent / "embedding_cache")
+    if cache_root.lower() not in ("", "none", "off"):
+        embedding_cache = EmbeddingDiskCache(
+            embedding_cache_dir(Path(cache_root), provider_name, model_name, onnx_path)
+        )
+    # Модель создается в каждом процессе конвейера (или здесь же при --workers 1)
+    pipeline = EmbeddingPipeline(
+        functools.partial(get_provider, provider_name, model_name, http_url, onnx_path, onnx_threads),
+        args.batch_size,
+        args.workers,
+        embedding_cache,
+    )
     page_info = load_page_info(pages_path)
     
     tables_path = data_dir / "tables.jsonl"
     table_captions = load_table_captions(tables_path)
 
-    embeddings_list: List[np.ndarray] = []
-    metas: List[ChunkMeta] = []
-
-    batch_texts: List[str] = []
-    batch_meta: List[ChunkMeta] = []
-
-    for item in read_jsonl(chunks_path):
-        page_id = str(item["page_id"])
-        original_text = item.get("text", "")
-        
-        # Обогащаем текст контекстом страницы и таблиц
-        enriched_parts = []
-        
-        # Добавляем название страницы
-        page_data = page_info.get(page_id, {})
-        if page_data.get("title"):
-            enriched_parts.append(page_data["title"])
-        
-        # Добавляем названия таблиц с этой страницы
-        if page_id in table_captions:
-            enriched_parts.extend(table_captions[page_id])
-        
-        # Добавляем section_path
-        section_path = item.get("section_path") or []
-        if section_path:
-            enriched_parts.extend(section_path)
-        
-        # Добавляем оригинальный текст
-        enriched_parts.append(original_text)
-        
-        # Собираем обогащенный текст
-        enriched_text = ". ".join(enriched_parts)
-        
-        batch_texts.append(enriched_text)
-        batch_meta.append(
-            ChunkMeta(
-                chunk_id=str(item["chunk_id"]),
+    previous = None
+    if args.update:
+        previous = load_previous_build(previous_dir, provider_name, model_name, args.index_type)
+    previous_hashes = previous[0] if previous is not None else {}
+
+    # id_map пишется по мере чтения чанков, в памяти остаются только chunk_id
+    generation_dir = new_generation_dir(output_dir)
+    id_map_writer = IdMapWriter(generation_dir / "id_map.bin", generation_dir / "id_map.jsonl")
+    current_hashes: Dict[str, str] = {}
+    seen: Set[str] = set()
+    duplicates = 0
+
+    def texts_to_embed() -> Generator[Tuple[int, str], None, None]:
+        """Стадия чтения: обогащает чанки и отдает тексты, которым нужен вектор"""
+        nonlocal duplicates
+        for item in read_jsonl(chunks_path):
+            chunk_id = str(item["chunk_id"])
+            if chunk_id in seen:
+                # Повтор chunk_id дал бы два вектора с одним id
+                duplicates += 1
+                continue
+            seen.add(chunk_id)
+            page_id = str(item["page_id"])
+            original_text = item.get("text", "")
+
+            # Обогащаем текст контекстом страницы и таблиц
+            enriched_parts = []
+
+            # Добавляем название страницы
+            page_data = page_info.get(page_id, {})
+            if page_data.get("title"):
+                enriched_parts.append(page_data["title"])
+
+            # Добавляем названия таблиц с этой страницы
+            if page_id in table_captions:
+                enriched_parts.extend(table_captions[page_id])
+
+            # Добавляем section_path
+            section_path = item.get("section_path") or []
+            if section_path:
+                enriched_parts.extend(section_path)
+
+            # Добавляем оригинальный текст
+            enriched_parts.append(original_text)
+
+            # Собираем обогащенный текст
+            enriched_text = ". ".join(enriched_parts)
+
+            meta = ChunkMeta(
+                chunk_id=chunk_id,
                 page_id=page_id,
                 url=page_data.get("url", ""),
                 section_path=section_path,
                 source_order=int(item.get("source_order", 0)),
                 text_preview=original_text[:240],
+                id=stable_id(chunk_id),
+                text_hash=text_hash(enriched_text),
             )
-        )
-        if len(batch_texts) >= args.batch_size:
-            embeddings_list.append(provider.embed(batch_texts))
-            metas.extend(batch_meta)
-            batch_texts = []
-            batch_meta = []
-
-    if batch_texts:
-        embeddings_list.append(provider.embed(batch_texts))
-        metas.extend(batch_meta)
-
-    embeddings = np.vstack(embeddings_list)
-    dimension = embeddings.shape[1]
-
-    index = faiss.IndexFlatIP(dimension)
-    index.add(embeddings)
-
-    faiss.write_index(index, str(output_dir / "index.faiss"))
+            id_map_writer.add(meta)
+            if previous is not None:
+                current_hashes[chunk_id] = meta.text_hash
+            if previous_hashes.get(chunk_id) == meta.text_hash:
+                # Текст для эмбеддинга не изменился — вектор уже в индексе
+                if embedding_cache is not None:
+                    embedding_cache.touch(text_key(enriched_text))
+                continue
+            yield meta.id, enriched_text
+
+    # Стадия записи: окна приходят в порядке корпуса. Индексы без обучения (flat, HNSW) при
+    # полной сборке пополняются сразу; векторы для обучения, recall и --update копятся на диске
+    index: Optional[faiss.Index] = None
+    index_spec: Optional[IndexSpec] = None
+    staging: Optional[VectorStaging] = None
+    dimension: Optional[int] = None
+    added = 0
+    embed_start = time.perf_counter()
+    for window_ids, window_vectors in pipeline.run(texts_to_embed()):
+        ids = np.asarray(window_ids, dtype="int64")
+        if dimension is None:
+            dimension = int(window_vectors.shape[1])
+            index_spec = parse_index_type(args.index_type, 0, dimension)
+            if previous is None and not index_spec.needs_training:
+                index = create_index(index_spec, dimension, args.ef_construction)
+            if index is None or args.recall_queries > 0:
+                staging = VectorStaging(generation_dir, dimension)
+        if index is not None:
+            index.add_with_ids(window_vectors, ids)
+        if staging is not None:
+            staging.append(ids, window_vectors)
+        added += len(window_ids)
+    embed_seconds = time.perf_counter() - embed_start
+    chunks_per_sec = len(id_map_writer) / embed_seconds if embed_seconds > 0 else 0.0
+    print(
+        f"Чанков: {len(id_map_writer)}, к эмбеддингу: {added}, {embed_seconds:.1f} с "
+        f"({chunks_per_sec:.0f} чанков/с, процессов: {max(args.workers, 1)})"
+    )
 
-    with (output_dir / "id_map.jsonl").open("w", encoding="utf-8") as handle:
-        for meta in metas:
-            record = {
-                "chunk_id": meta.chunk_id,
-                "page_id": meta.page_id,
-                "url": meta.url,
-                "section_path": meta.section_path,
-                "source_order": meta.source_order,
-                "text_preview": meta.text_preview,
-            }
-            handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+    if duplicates:
+        print(f"Пропущено повторов chunk_id: {duplicates}")
 
-    with (output_dir / "meta.json").open("w", encoding="utf-8") as handle:
-        json.dump(
-            {"dimension": dimension, "provider": provider_name, "model": model_name},
-            handle,
-            ensure_ascii=False,
+    cache_stats = None
+    if embedding_cache is not None:
+        embedding_cache.flush()
+        cache_stats = embedding_cache.stats()
+        print(
+            f"Кэш эмбеддингов: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+            f"hit ratio {cache_stats['hit_ratio']:.3f}"
         )
 
-    print(f"Готово. Векторов: {embeddings.shape[0]}")
+    # Удаленные чанки и чанки с новым текстом: их старые векторы убираются из индекса
+    stale_ids = np.asarray(
+        [
+            stable_id(chunk_id)
+            for chunk_id, old_hash in previous_hashes.items()
+            if current_hashes.get(chunk_id) != old_hash
+        ],
+        dtype="int64",
+    )
+
+    if previous is None:
+        if dimension is None:
+            id_map_writer.discard()
+            shutil.rmtree(generation_dir)
+            raise ValueError(f"Нет чанков для индексации: {chunks_path}")
+        if index is None:
+            # IVF/PQ: обучение на выборке с диска, затем добавление кусками
+            index_spec = parse_index_type(args.index_type, staging.count, dimension)
+            index = create_index(index_spec, dimension, args.ef_construction)
+            train_index(index, index_spec, training_sample(staging.vectors(), index_spec, args.seed))
+            add_in_chunks(index, staging.vectors(), staging.ids())
+        print(f"Индекс: {index_spec.factory}")
+        index_params = dict(index_spec.params)
+        if index_spec.kind == "hnsw":
+            index_params["ef_construction"] = args.ef_construction
+
+        runtime_params = default_runtime_params(index_spec)
+        base_meta: Dict[str, object] = {}
+    else:
+        base_meta = previous[1]
+        if added == 0 and stale_ids.size == 0:
+            id_map_writer.discard()
+            shutil.rmtree(generation_dir)
+            print("Изменений в чанках нет: индекс актуален")
+            return
+        print(f"Обновление индекса: эмбеддингов {added}, удаляется векторов {stale_ids.size}")
+        index = faiss.read_index(str(previous_dir / "index.faiss"))
+        dimension = index.d
+        index_spec = parse_index_type(args.index_type, index.ntotal, dimension)
+        index_params = dict(base_meta.get("params") or {})
+        if supports_remove(index_spec):
+            # Сначала удаление: измененный чанк возвращается с тем же id
+            if stale_ids.size:
+                index.remove_ids(stale_ids)
+        else:
+            # HNSW: граф строится заново из сохраненных векторов, эмбеддятся только новые чанки
+            rebuilt = create_index(index_spec, dimension, int(index_params.get("ef_construction", args.ef_construction)))
+            for kept_ids, kept_vectors in stored_vectors(index):
+                keep = ~np.isin(kept_ids, stale_ids)
+                rebuilt.add_with_ids(kept_vectors[keep], kept_ids[keep])
+            index = rebuilt
+        if staging is not None:
+            add_in_chunks(index, staging.vectors(), staging.ids())
+        if index.ntotal != len(id_map_writer):
+            print(f"Предупреждение: векторов в индексе {index.ntotal}, чанков {len(id_map_writer)}")
+        runtime_params = dict(base_meta.get("runtime") or default_runtime_params(index_spec))
+
+    if args.nprobe is not None and "nprobe" in runtime_params:
+        runtime_params["nprobe"] = args.nprobe
+    if args.ef_search is not None and "efSearch" in runtime_params:
+        runtime_params["efSearch"] = args.ef_search
+
+    # recall@k против точного IndexFlatIP на выборке векторов корпуса как запросов.
+    # Точный поиск идет кусками по векторам на диске. При --update векторов всего корпуса
+    # нет: остается отчет полной сборки
+    recall_report = list(base_meta.get("recall") or [])
+    queries = None
+    if previous is None and staging is not None:
+        queries = sample_queries(staging.vectors(), args.recall_queries, args.seed)
+    if queries is not None:
+        k = min(args.recall_k, staging.count)
+        # Индекс возвращает стабильные id, точный поиск — номера строк
+        ground_truth = np.asarray(staging.ids())[exact_neighbors(staging.vectors(), queries, k)]
+        recall_report = []
+        print(f"recall@{k} на {queries.shape[0]} запросах:")
+        for params in runtime_sweep(index_spec):
+            row = evaluate_recall(index, queries, ground_truth, k, params)
+            recall_report.append(row)
+            knobs = " ".join(f"{name}={value}" for name, value in params.items()) or "exact"
+            print(
+                f"  {knobs:<14} recall={row[f'recall@{k}']:.4f} "
+                f"p50={row['latency_p50_ms']:.3f}ms p99={row['latency_p99_ms']:.3f}ms"
+            )
+    apply_runtime_params(index, runtime_params)
+    if staging is not None:
+        staging.close()
+
+    # Файлы пишутся в новый каталог поколения, который API не читает, пока на него не укажет current
+    faiss.write_index(index, str(generation_dir / "index.faiss"))
+    id_map_writer.close()
+
+    peak_rss = peak_rss_mb()
+    print(f"Пиковый RSS: сборка {peak_rss['main']:.0f} МБ, процесс эмбеддинга {peak_rss['workers']:.0f} МБ")
+
+    now = datetime.now(timezone.utc).isoformat()
+    meta_payload = {
+        "dimension": dimension,
+        "provider": provider_name,
+        "model": model_name,
+        "index_type": index_spec.spec,
+        "factory": index_spec.factory,
+        "metric": "inner_product",
+        "id_mode": "stable",
+        "ntotal": int(index.ntotal),
+        "params": index_params,
+        "runtime": runtime_params,
+        "recall": recall_report,
+        "built_at": base_meta.get("built_at", now),
+        "updated_at": now,
+        "generation": generation_dir.name,
+        "last_run": {
+            "mode": "update" if previous is not None else "full",
+            "added": added,
+            "removed": int(stale_ids.size),
+            "embedding_cache": cache_stats,
+            "workers": max(args.workers, 1),
+            "chunks_per_sec": round(chunks_per_sec, 1),
+            "peak_rss_mb": peak_rss,
+        },
+    }
+
+    with (generation_dir / "meta.json").open("w", encoding="utf-8") as handle:
+        json.dump(meta_payload, handle, ensure_ascii=False, indent=2)
+
+    publish_generation(output_dir, generation_dir)
+    print(f"Поколение индекса: {generation_dir.name}")
+    removed_generations = prune_generations(output_dir, args.keep_generations)
+    if removed_generations:
+        print(f"Удалены старые поколения: {', '.join(removed_generations)}")
+
+    if embedding_cache is not None and args.compact_embedding_cache:
+        print(f"Компактизация кэша эмбеддингов: удалено {embedding_cache.compact()} векторов")
+
+    print(f"Готово. Векторов: {index.ntotal}, добавлено в этом запуске: {added}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+"""
+Дисковый кэш эмбеддингов для build_faiss.py.
+
+Ключ — sha256 обогащенного текста внутри каталога модели (каталог выбирается по провайдеру и
+имени модели). Векторы хранятся в float16:
+    keys.bin     — подряд идущие 32-байтные ключи
+    vectors.f16  — матрица count x dimension, читается через np.memmap
+    meta.json    — dimension, count (источник истины при обрыве записи) и статистика последнего запуска
+Новые векторы дописываются в конец; compact() оставляет только использованные в запуске ключи.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+KEY_SIZE = 32
+# Сколько новых векторов держать в памяти до дозаписи на диск
+FLUSH_EVERY = 4096
+
+
+def cache_dir_for(root: Path, provider: str, model_name: str) -> Path:
+    slug = re.sub(r"[^A-Za-z0-9._-]+", "_", model_name).strip("_")[-64:]
+    digest = hashlib.sha256(f"{provider}\0{model_name}".encode("utf-8")).hexdigest()[:12]
+    return root / f"{slug}-{digest}"
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingDiskCache:
+    def __init__(self, directory: Path) -> None:
+        self._dir = directory
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._meta_path = directory / "meta.json"
+        self._keys_path = directory / "keys.bin"
+        self._vectors_path = directory / "vectors.f16"
+        self.dimension: Optional[int] = None
+        self._count = 0
+        if self._meta_path.exists():
+            with self._meta_path.open("r", encoding="utf-8") as handle:
+                meta = json.load(handle)
+            self.dimension = meta.get("dimension")
+            self._count = int(meta.get("count", 0))
+        self._rows: Dict[bytes, int] = {}
+        self._vectors: Optional[np.memmap] = None
+        self._open_existing()
+        self._pending: List[np.ndarray] = []
+        self._pending_rows: Dict[bytes, int] = {}
+        self._used: Set[bytes] = set()
+        # get() зовется из потока чтения конвейера, put() — из сборщика результатов
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _open_existing(self) -> None:
+        if not self._count or self.dimension is None:
+            self._count = 0
+            return
+        keys_size = self._count * KEY_SIZE
+        vectors_size = self._count * self.dimension * 2
+        if (
+            not self._keys_path.exists()
+            or not self._vectors_path.exists()
+            or self._keys_path.stat().st_size < keys_size
+            or self._vectors_path.stat().st_size < vectors_size
+        ):
+            print(f"Кэш эмбеддингов {self._dir} поврежден, начинаем заново")
+            self._count = 0
+            self._keys_path.unlink(missing_ok=True)
+            self._vectors_path.unlink(missing_ok=True)
+            return
+        # Хвост после count — след прерванной записи, его отрезаем
+        with self._keys_path.open("r+b") as handle:
+            handle.truncate(keys_size)
+            keys = handle.read()
+        with self._vectors_path.open("r+b") as handle:
+            handle.truncate(vectors_size)
+        for row in range(self._count):
+            self._rows[keys[row * KEY_SIZE : (row + 1) * KEY_SIZE]] = row
+        self._vectors = np.memmap(
+            self._vectors_path, dtype="<f2", mode="r", shape=(self._count, self.dimension)
+        )
+
+    def __len__(self) -> int:
+        return self._count + len(self._pending)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            self._used.add(key)
+            row = self._rows.get(key)
+            if row is not None and self._vectors is not None:
+                self.hits += 1
+                return np.asarray(self._vectors[row], dtype="float32")
+            pending_row = self._pending_rows.get(key)
+            if pending_row is not None:
+                self.hits += 1
+                return self._pending[pending_row].astype("float32")
+            self.misses += 1
+            return None
+
+    def touch(self, key: bytes) -> None:
+        """Отмечает ключ используемым без чтения вектора (для compact)"""
+        with self._lock:
+            self._used.add(key)
+
+    def put(self, key: bytes, vector: np.ndarray) -> np.ndarray:
+        """Сохраняет вектор; возвращает его после округления до float16, как при чтении из кэша"""
+        if self.dimension is None:
+            self.dimension = int(vector.shape[0])
+        stored = vector.astype("<f2")
+        with self._lock:
+            if key not in self._rows and key not in self._pending_rows:
+                self._pending_rows[key] = len(self._pending)
+                self._pending.append(stored)
+                if len(self._pending) >= FLUSH_EVERY:
+                    self.flush()
+        return stored.astype("float32")
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._pending:
+            with self._vectors_path.open("ab") as handle:
+                handle.write(np.vstack(self._pending).tobytes())
+            with self._keys_path.open("ab") as handle:
+                for key in self._pending_rows:
+                    handle.write(key)
+            base = self._count
+            for key, row in self._pending_rows.items():
+                self._rows[key] = base + row
+            self._count += len(self._pending)
+            self._pending = []
+            self._pending_rows = {}
+            self._vectors = np.memmap(
+                self._vectors_path, dtype="<f2", mode="r", shape=(self._count, self.dimension)
+            )
+        self._write_meta()
+
+    def stats(self) -> Dict[str, object]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _write_meta(self) -> None:
+        tmp_path = self._meta_path.with_name(self._meta_path.name + ".tmp")
+        with tmp_path.open("w", encoding="utf-8") as handle:
+            json.dump(
+                {"dimension": self.dimension, "count": self._count, "last_run": self.stats()},
+                handle,
+                ensure_ascii=False,
+                indent=2,
+            )
+        os.replace(tmp_path, self._meta_path)
+
+    def compact(self) -> int:
+        """Оставляет только ключи, запрошенные в этом запуске; возвращает число удаленных векторов"""
+        self.flush()
+        if self._vectors is None:
+            return 0
+        keep = [(key, row) for key, row in self._rows.items() if key in self._used]
+        removed = self._count - len(keep)
+        if not removed:
+            return 0
+        keys_tmp = self._keys_path.with_name(self._keys_path.name + ".tmp")
+        vectors_tmp = self._vectors_path.with_name(self._vectors_path.name + ".tmp")
+        with keys_tmp.open("wb") as keys_out, vectors_tmp.open("wb") as vectors_out:
+            for key, row in keep:
+                keys_out.write(key)
+                vectors_out.write(np.asarray(self._vectors[row]).tobytes())
+        self._vectors = None
+        os.replace(vectors_tmp, self._vectors_path)
+        os.replace(keys_tmp, self._keys_path)
+        self._rows = {key: row for row, (key, _) in enumerate(keep)}
+        self._count = len(keep)
+        self._write_meta()
+        if self._count:
+            self._vectors = np.memmap(
+                self._vectors_path, dtype="<f2", mode="r", shape=(self._count, self.dimension)
+            )
+        return removed
@@ -0,0 +1,235 @@
+"""
+Типы FAISS индексов для build_faiss.py и оценка recall@k относительно точного поиска.
+
+Спецификация --index-type:
+    flat                     точный поиск (IndexFlatIP)
+    hnsw | hnsw{M}           граф HNSW, M связей на узел (по умолчанию 32)
+    ivf{nlist}               IVF с плоскими списками
+    ivf{nlist},pq{m}         IVF + product quantization на m подвекторов
+    opq | opq{m},ivf{nlist},pq{m}
+                             то же с OPQ-поворотом перед IVF-PQ
+Пропущенные числа подбираются по размеру корпуса и размерности.
+"""
+
+from __future__ import annotations
+
+import math
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+
+_TOKEN_RE = re.compile(r"^(flat|hnsw|ivf|pq|opq)(\d*)$")
+
+# k-means в FAISS хочет хотя бы 39 точек на центроид и больше 256 все равно не берет
+MIN_POINTS_PER_CENTROID = 39
+MAX_POINTS_PER_CENTROID = 256
+PQ_CENTROIDS = 256
+# Векторы добавляются и сравниваются кусками, чтобы не поднимать в память весь корпус
+CHUNK_ROWS = 65536
+
+
+@dataclass
+class IndexSpec:
+    spec: str
+    factory: str
+    kind: str
+    params: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def needs_training(self) -> bool:
+        return self.kind in ("ivf", "ivfpq", "opq")
+
+    def min_train_size(self) -> int:
+        required = 0
+        if "nlist" in self.params:
+            required = self.params["nlist"] * MIN_POINTS_PER_CENTROID
+        if "pq_m" in self.params:
+            required = max(required, PQ_CENTROIDS * MIN_POINTS_PER_CENTROID)
+        return required
+
+
+def _default_nlist(n_vectors: int) -> int:
+    nlist = int(4 * math.sqrt(max(n_vectors, 1)))
+    return max(1, min(nlist, n_vectors // MIN_POINTS_PER_CENTROID or 1))
+
+
+def _default_pq_m(dimension: int) -> int:
+    # ~8 измерений на подвектор, m обязано делить размерность
+    for m in range(max(1, dimension // 8), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def parse_index_type(spec: str, n_vectors: int, dimension: int) -> IndexSpec:
+    tokens = []
+    for part in spec.lower().replace(" ", "").split(","):
+        match = _TOKEN_RE.match(part)
+        if not match:
+            raise ValueError(f"Неизвестный элемент --index-type: {part!r}")
+        tokens.append((match.group(1), int(match.group(2)) if match.group(2) else None))
+    names = [name for name, _ in tokens]
+    values = dict(tokens)
+
+    if names == ["flat"]:
+        return IndexSpec(spec, "Flat", "flat")
+
+    if names == ["hnsw"]:
+        m = values["hnsw"] or 32
+        return IndexSpec(spec, f"HNSW{m}", "hnsw", {"hnsw_m": m})
+
+    if names == ["ivf"]:
+        nlist = values["ivf"] or _default_nlist(n_vectors)
+        return IndexSpec(spec, f"IVF{nlist},Flat", "ivf", {"nlist": nlist})
+
+    if names in (["ivf", "pq"], ["opq"], ["opq", "ivf", "pq"]):
+        nlist = values.get("ivf") or _default_nlist(n_vectors)
+        pq_m = values.get("pq") or values.get("opq") or _default_pq_m(dimension)
+        if dimension % pq_m != 0:
+            raise ValueError(f"pq{pq_m}: размерность {dimension} должна делиться на m")
+        params = {"nlist": nlist, "pq_m": pq_m}
+        if names[0] == "opq":
+            return IndexSpec(spec, f"OPQ{pq_m},IVF{nlist},PQ{pq_m}", "opq", params)
+        return IndexSpec(spec, f"IVF{nlist},PQ{pq_m}", "ivfpq", params)
+
+    raise ValueError(f"Неподдерживаемая комбинация --index-type: {spec!r}")
+
+
+def create_index(index_spec: IndexSpec, dimension: int, ef_construction: int) -> faiss.Index:
+    """Индекс с метками-id: IVF хранит id сам, flat и HNSW оборачиваются в IndexIDMap2"""
+    factory = index_spec.factory if index_spec.kind in ("ivf", "ivfpq", "opq") else f"IDMap2,{index_spec.factory}"
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_INNER_PRODUCT)
+    if index_spec.kind == "hnsw":
+        faiss.downcast_index(index.index).hnsw.efConstruction = ef_construction
+    return index
+
+
+def supports_remove(index_spec: IndexSpec) -> bool:
+    # Из графа HNSW удалять нельзя: при обновлении он перестраивается из сохраненных векторов
+    return index_spec.kind != "hnsw"
+
+
+def stored_vectors(index: faiss.Index, chunk_rows: int = CHUNK_ROWS) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Куски (id, векторы) из IndexIDMap2 над хранилищем без потерь (Flat, HNSW,Flat)"""
+    inner = faiss.downcast_index(index.index)
+    ids = faiss.vector_to_array(index.id_map).astype("int64")
+    for start in range(0, index.ntotal, chunk_rows):
+        count = min(chunk_rows, index.ntotal - start)
+        yield ids[start : start + count], inner.reconstruct_n(start, count)
+
+
+def add_in_chunks(index: faiss.Index, vectors: np.ndarray, ids: np.ndarray, chunk_rows: int = CHUNK_ROWS) -> None:
+    """add_with_ids по кускам: vectors может быть np.memmap с диска"""
+    for start in range(0, vectors.shape[0], chunk_rows):
+        chunk = np.ascontiguousarray(vectors[start : start + chunk_rows], dtype="float32")
+        index.add_with_ids(chunk, np.ascontiguousarray(ids[start : start + chunk_rows]))
+
+
+def training_sample(vectors: np.ndarray, index_spec: IndexSpec, seed: int) -> np.ndarray:
+    """Выборка для обучения IVF/PQ: k-means больше MAX_POINTS_PER_CENTROID точек на центроид не использует"""
+    wanted = 0
+    if "nlist" in index_spec.params:
+        wanted = index_spec.params["nlist"] * MAX_POINTS_PER_CENTROID
+    if "pq_m" in index_spec.params:
+        wanted = max(wanted, PQ_CENTROIDS * MAX_POINTS_PER_CENTROID)
+    if wanted >= vectors.shape[0]:
+        return np.ascontiguousarray(vectors, dtype="float32")
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(vectors.shape[0], size=wanted, replace=False))
+    return np.ascontiguousarray(vectors[rows], dtype="float32")
+
+
+def train_index(index: faiss.Index, index_spec: IndexSpec, sample: np.ndarray) -> None:
+    if not index_spec.needs_training:
+        return
+    required = index_spec.min_train_size()
+    if sample.shape[0] < required:
+        raise ValueError(
+            f"Для {index_spec.factory} нужно не меньше {required} векторов для обучения, "
+            f"есть {sample.shape[0]}. Уменьшите nlist/pq или используйте --index-type flat/hnsw"
+        )
+    index.train(sample)
+
+
+def default_runtime_params(index_spec: IndexSpec) -> Dict[str, int]:
+    if index_spec.kind == "hnsw":
+        return {"efSearch": 64}
+    if "nlist" in index_spec.params:
+        return {"nprobe": min(index_spec.params["nlist"], 16)}
+    return {}
+
+
+def apply_runtime_params(index: faiss.Index, params: Dict[str, int]) -> None:
+    space = faiss.ParameterSpace()
+    for name, value in params.items():
+        space.set_index_parameter(index, name, value)
+
+
+def runtime_sweep(index_spec: IndexSpec) -> List[Dict[str, int]]:
+    if index_spec.kind == "hnsw":
+        return [{"efSearch": ef} for ef in (16, 32, 64, 128, 256)]
+    if "nlist" in index_spec.params:
+        nlist = index_spec.params["nlist"]
+        values = sorted({min(v, nlist) for v in (1, 2, 4, 8, 16, 32, 64, 128)})
+        return [{"nprobe": v} for v in values]
+    return [{}]
+
+
+def exact_neighbors(vectors: np.ndarray, queries: np.ndarray, k: int, chunk_rows: int = CHUNK_ROWS) -> np.ndarray:
+    """Номера строк k точных ближайших соседей; корпус просматривается кусками"""
+    best_scores = np.full((queries.shape[0], 0), -np.inf, dtype="float32")
+    best_rows = np.empty((queries.shape[0], 0), dtype="int64")
+    for start in range(0, vectors.shape[0], chunk_rows):
+        chunk = np.ascontiguousarray(vectors[start : start + chunk_rows], dtype="float32")
+        exact = faiss.IndexFlatIP(chunk.shape[1])
+        exact.add(chunk)
+        scores, rows = exact.search(queries, min(k, chunk.shape[0]))
+        best_scores = np.hstack([best_scores, scores])
+        best_rows = np.hstack([best_rows, rows + start])
+        order = np.argsort(-best_scores, axis=1, kind="stable")[:, :k]
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+    return best_rows
+
+
+def evaluate_recall(
+    index: faiss.Index,
+    queries: np.ndarray,
+    ground_truth: np.ndarray,
+    k: int,
+    params: Dict[str, int],
+) -> Dict[str, float]:
+    """recall@k и задержка одиночного запроса при заданных nprobe/efSearch"""
+    apply_runtime_params(index, params)
+    latencies: List[float] = []
+    found: List[np.ndarray] = []
+    for query in queries:
+        start = time.perf_counter()
+        _, indices = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(indices[0])
+    hits = sum(
+        len(set(row[row >= 0].tolist()) & set(truth[truth >= 0].tolist()))
+        for row, truth in zip(found, ground_truth)
+    )
+    total = sum(int((truth >= 0).sum()) for truth in ground_truth) or 1
+    ordered = sorted(latencies)
+    return {
+        **params,
+        f"recall@{k}": hits / total,
+        "latency_p50_ms": ordered[len(ordered) // 2],
+        "latency_p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+    }
+
+
+def sample_queries(vectors: np.ndarray, count: int, seed: int) -> Optional[np.ndarray]:
+    if count <= 0 or vectors.shape[0] == 0:
+        return None
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(vectors.shape[0], size=min(count, vectors.shape[0]), replace=False)
+    return np.ascontiguousarray(vectors[np.sort(rows)])
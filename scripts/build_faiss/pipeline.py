@@ -0,0 +1,154 @@
+"""
+Конвейер эмбеддинга для build_faiss.py.
+
+Чтение и обогащение чанков идет в потоке-поставщике, тексты режутся на окна, внутри окна
+сортируются по длине и делятся на пакеты (меньше паддинга в трансформере). Пакеты считают
+N процессов с собственной копией модели; результаты собираются обратно в порядке корпуса.
+Число пакетов в работе ограничено, поэтому чтение не убегает вперед на весь корпус.
+"""
+
+from __future__ import annotations
+
+import itertools
+import multiprocessing
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from embedding_cache import EmbeddingDiskCache, text_key
+
+# (номер окна, позиции текстов в окне, тексты)
+Task = Tuple[int, List[int], List[str]]
+TaskResult = Tuple[int, List[int], Optional[np.ndarray]]
+
+# Окно сортировки по длине — столько пакетов
+WINDOW_BATCHES = 32
+
+_worker_provider = None
+
+
+def _init_worker(provider_factory: Callable[[], object], threads: int) -> None:
+    global _worker_provider
+    try:
+        import torch
+
+        # Иначе каждый процесс займет все ядра и они будут мешать друг другу
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_provider = provider_factory()
+
+
+def _embed_in_worker(task: Task) -> TaskResult:
+    number, positions, texts = task
+    return number, positions, _worker_provider.embed(texts) if texts else None
+
+
+@dataclass
+class _Window:
+    ids: List[int]
+    keys: List[bytes]
+    vectors: List[Optional[np.ndarray]]
+    pending: int
+
+
+class EmbeddingPipeline:
+    def __init__(
+        self,
+        provider_factory: Callable[[], object],
+        batch_size: int,
+        workers: int,
+        cache: Optional[EmbeddingDiskCache] = None,
+    ) -> None:
+        self._provider_factory = provider_factory
+        self._batch_size = batch_size
+        self._workers = workers
+        self._cache = cache
+        self._windows: Dict[int, _Window] = {}
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max(2, workers * 4))
+        self._next_window = 0
+
+    def _window_tasks(self, items: List[Tuple[int, str]]) -> Iterator[Task]:
+        number = self._next_window
+        self._next_window += 1
+        keys = [text_key(text) for _, text in items] if self._cache is not None else []
+        if self._cache is not None:
+            vectors = [self._cache.get(key) for key in keys]
+        else:
+            vectors = [None] * len(items)
+        missing = sorted(
+            (i for i, vector in enumerate(vectors) if vector is None), key=lambda i: len(items[i][1])
+        )
+        batches = [missing[i : i + self._batch_size] for i in range(0, len(missing), self._batch_size)]
+        with self._lock:
+            self._windows[number] = _Window(
+                [item_id for item_id, _ in items], keys, vectors, max(len(batches), 1)
+            )
+        if not batches:
+            # Окно целиком из кэша: пустая задача, чтобы сборщик выдал его по порядку
+            batches = [[]]
+        for batch in batches:
+            self._in_flight.acquire()
+            yield number, batch, [items[i][1] for i in batch]
+
+    def _tasks(self, items: Iterable[Tuple[int, str]]) -> Iterator[Task]:
+        window: List[Tuple[int, str]] = []
+        window_size = self._batch_size * WINDOW_BATCHES
+        for item in items:
+            window.append(item)
+            if len(window) >= window_size:
+                yield from self._window_tasks(window)
+                window = []
+        if window:
+            yield from self._window_tasks(window)
+
+    def _collect(self, results: Iterable[TaskResult]) -> Iterator[Tuple[List[int], np.ndarray]]:
+        for number, positions, vectors in results:
+            self._in_flight.release()
+            with self._lock:
+                window = self._windows[number]
+            if vectors is not None:
+                for position, vector in zip(positions, vectors):
+                    if self._cache is not None:
+                        vector = self._cache.put(window.keys[position], vector)
+                    window.vectors[position] = vector
+            window.pending -= 1
+            if window.pending == 0:
+                with self._lock:
+                    del self._windows[number]
+                yield window.ids, np.vstack(window.vectors)
+
+    def run(self, items: Iterable[Tuple[int, str]]) -> Iterator[Tuple[List[int], np.ndarray]]:
+        """(id, текст) -> окна (id, векторы) в исходном порядке"""
+        tasks = self._tasks(items)
+        # Окна, целиком найденные в кэше, не требуют модели: процессы поднимаются на первом промахе
+        first: Optional[Task] = None
+        for task in tasks:
+            if task[2]:
+                first = task
+                break
+            yield from self._collect([(task[0], task[1], None)])
+        if first is None:
+            return
+        tasks = itertools.chain([first], tasks)
+
+        if self._workers <= 1:
+            provider = self._provider_factory()
+            results = (
+                (number, positions, provider.embed(texts) if texts else None)
+                for number, positions, texts in tasks
+            )
+            yield from self._collect(results)
+            return
+
+        threads = max(1, (os.cpu_count() or 1) // self._workers)
+        # spawn: fork процесса с уже загруженными torch/faiss ненадежен
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(
+            self._workers, initializer=_init_worker, initargs=(self._provider_factory, threads)
+        ) as pool:
+            yield from self._collect(pool.imap(_embed_in_worker, tasks))
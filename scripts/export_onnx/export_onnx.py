@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Экспорт модели sentence-transformers в ONNX для EMBEDDINGS_PROVIDER=onnx.
+
+В --output-dir пишутся:
+    model.onnx             трансформер до пулинга (выход last_hidden_state), fp32
+    model.int8.onnx        то же после динамической int8-квантизации весов
+    tokenizer.json         быстрый токенизатор для пакета tokenizers
+    embedding_config.json  модель, max_length, пулинг, размерность, pad-токен
+
+После экспорта проверяется паритет: косинус векторов ONNX (fp32 и int8) с векторами torch
+на текстах корпуса. Ниже --min-cosine скрипт завершается с ошибкой.
+
+С --reranker экспортируется cross-encoder RERANKER_MODEL (apps/api/reranker.py): model.onnx и
+model.int8.onnx с выходом logits, tokenizer.json и reranker_config.json; паритет — наибольшее
+расхождение оценок с CrossEncoder.predict на парах (запрос, текст корпуса).
+
+Нужны torch, sentence-transformers, onnx и onnxruntime. Запуск из корня репозитория:
+    python scripts/export_onnx/export_onnx.py --output-dir data/derived/onnx
+    python scripts/export_onnx/export_onnx.py --reranker --output-dir data/derived/onnx-reranker
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import onnxruntime
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from sentence_transformers import CrossEncoder, SentenceTransformer
+
+# Корень репозитория: пулинг общий с API и сборкой индекса
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from apps.api.onnx_embedding import pool_embeddings
+
+# Если корпуса под рукой нет
+SAMPLE_TEXTS = [
+    "Одноэтажное здание без подвала, удельный вес конструкций",
+    "таблица 12 стоимость строительства",
+    "жилые дома кирпичные двухэтажные",
+    "восстановительная стоимость складских помещений",
+    "укрупненные показатели для гаражей",
+    "здания с подвалом, фундаменты ленточные",
+]
+
+MODEL_INPUTS = ("input_ids", "attention_mask", "token_type_ids")
+
+
+def load_texts(data_dir: Path, limit: int) -> List[str]:
+    path = data_dir / "text_chunks.jsonl"
+    if not path.exists():
+        return SAMPLE_TEXTS
+    texts: List[str] = []
+    with path.open("r", encoding="utf-8") as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            text = json.loads(line).get("text") or ""
+            if text:
+                texts.append(text)
+            if len(texts) >= limit:
+                break
+    return texts or SAMPLE_TEXTS
+
+
+def pooling_mode(model: SentenceTransformer) -> str:
+    pooling = model[1]
+    if getattr(pooling, "pooling_mode_mean_tokens", False):
+        return "mean"
+    if getattr(pooling, "pooling_mode_cls_token", False):
+        return "cls"
+    raise ValueError(f"Пулинг {pooling} не поддерживается провайдером onnx (только mean и cls)")
+
+
+def export(model: SentenceTransformer, model_name: str, output_dir: Path, opset: int) -> Dict[str, object]:
+    transformer = model[0].auto_model
+    tokenizer = model.tokenizer
+    transformer.eval()
+
+    dummy = tokenizer(["пример текста", "еще один"], return_tensors="pt", padding=True)
+    input_names = [name for name in MODEL_INPUTS if name in dummy]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            ({name: dummy[name] for name in input_names},),
+            str(output_dir / "model.onnx"),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    tokenizer.backend_tokenizer.save(str(output_dir / "tokenizer.json"))
+
+    config = {
+        "model": model_name,
+        "max_length": int(model.max_seq_length),
+        "pooling": pooling_mode(model),
+        "dimension": int(model.get_sentence_embedding_dimension()),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": int(tokenizer.pad_token_id),
+        "inputs": input_names,
+    }
+    with (output_dir / "embedding_config.json").open("w", encoding="utf-8") as handle:
+        json.dump(config, handle, ensure_ascii=False, indent=2)
+    return config
+
+
+def onnx_embed(
+    session: onnxruntime.InferenceSession,
+    model: SentenceTransformer,
+    config: Dict[str, object],
+    texts: List[str],
+    batch_size: int,
+) -> np.ndarray:
+    """Эталонный прогон ONNX с токенизатором transformers: проверяет сам экспорт"""
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        encoded = model.tokenizer(
+            texts[start : start + batch_size],
+            padding=True,
+            truncation=True,
+            max_length=int(config["max_length"]),
+            return_tensors="np",
+        )
+        feeds = {name: encoded[name].astype("int64") for name in config["inputs"]}
+        (hidden,) = session.run(["last_hidden_state"], feeds)
+        vectors.append(pool_embeddings(hidden, feeds["attention_mask"], str(config["pooling"])))
+    return np.vstack(vectors).astype("float32")
+
+
+def export_reranker(model: CrossEncoder, model_name: str, output_dir: Path, opset: int) -> Dict[str, object]:
+    transformer = model.model
+    tokenizer = model.tokenizer
+    transformer.eval()
+
+    dummy = tokenizer(
+        ["пример запроса", "еще запрос"], ["пример текста", "еще один текст"], return_tensors="pt", padding=True
+    )
+    input_names = [name for name in MODEL_INPUTS if name in dummy]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            ({name: dummy[name] for name in input_names},),
+            str(output_dir / "model.onnx"),
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    tokenizer.backend_tokenizer.save(str(output_dir / "tokenizer.json"))
+
+    config = {
+        "model": model_name,
+        "max_length": int(model.max_length),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": int(tokenizer.pad_token_id),
+        "inputs": input_names,
+    }
+    with (output_dir / "reranker_config.json").open("w", encoding="utf-8") as handle:
+        json.dump(config, handle, ensure_ascii=False, indent=2)
+    return config
+
+
+def onnx_rerank(
+    session: onnxruntime.InferenceSession,
+    model: CrossEncoder,
+    config: Dict[str, object],
+    pairs: List[Tuple[str, str]],
+    batch_size: int,
+) -> np.ndarray:
+    """Эталонный прогон cross-encoder в ONNX с токенизатором transformers; оценка — сигмоида logits"""
+    scores = []
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start : start + batch_size]
+        encoded = model.tokenizer(
+            [query for query, _ in batch],
+            [text for _, text in batch],
+            padding=True,
+            truncation=True,
+            max_length=int(config["max_length"]),
+            return_tensors="np",
+        )
+        feeds = {name: encoded[name].astype("int64") for name in config["inputs"]}
+        (logits,) = session.run(["logits"], feeds)
+        scores.append(1.0 / (1.0 + np.exp(-logits[:, 0])))
+    return np.concatenate(scores).astype("float32")
+
+
+def main_reranker(args: argparse.Namespace) -> None:
+    model_name = os.getenv("RERANKER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+    output_dir = Path(args.output_dir or "data/derived/onnx-reranker")
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    print(f"Экспорт cross-encoder {model_name} в {output_dir}")
+    model = CrossEncoder(model_name, max_length=args.max_length, device="cpu")
+    config = export_reranker(model, model_name, output_dir, args.opset)
+    quantize_dynamic(
+        str(output_dir / "model.onnx"), str(output_dir / "model.int8.onnx"), weight_type=QuantType.QInt8
+    )
+
+    texts = load_texts(Path(args.data_dir), args.parity_texts)
+    pairs = [(SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)], text) for i, text in enumerate(texts)]
+    reference = np.asarray(
+        model.predict(pairs, batch_size=args.batch_size, show_progress_bar=False), dtype="float32"
+    ).reshape(len(pairs))
+    failed = False
+    for name, threshold in (("model.onnx", 0.001), ("model.int8.onnx", args.max_score_diff)):
+        path = output_dir / name
+        session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+        diff = np.abs(onnx_rerank(session, model, config, pairs, args.batch_size) - reference)
+        size_mb = path.stat().st_size / (1024 * 1024)
+        print(
+            f"{name:<16} {size_mb:7.1f} МБ  расхождение оценок с torch: mean={diff.mean():.5f} "
+            f"max={diff.max():.5f} на {len(pairs)} парах"
+        )
+        if diff.max() > threshold:
+            print(f"  выше порога {threshold}: модель {name} не подходит для переранжирования")
+            failed = True
+    if failed:
+        sys.exit(1)
+    print("Готово. RERANKER_PROVIDER=onnx, RERANKER_ONNX_PATH=" + str(output_dir / "model.int8.onnx"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Экспорт модели эмбеддингов (или cross-encoder) в ONNX с int8-квантизацией"
+    )
+    parser.add_argument(
+        "--output-dir", default=None, help="по умолчанию data/derived/onnx (data/derived/onnx-reranker с --reranker)"
+    )
+    parser.add_argument("--reranker", action="store_true", help="экспортировать cross-encoder RERANKER_MODEL")
+    parser.add_argument("--max-length", type=int, default=int(os.getenv("RERANKER_MAX_LENGTH", "256")))
+    parser.add_argument("--data-dir", default=os.getenv("DATA_RAW_DIR", "data/raw"))
+    parser.add_argument("--opset", type=int, default=14)
+    parser.add_argument("--parity-texts", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--min-cosine",
+        type=float,
+        default=0.98,
+        help="минимальный косинус int8-векторов с векторами torch; fp32 обязан быть не ниже 0.999",
+    )
+    parser.add_argument(
+        "--max-score-diff",
+        type=float,
+        default=0.05,
+        help="--reranker: наибольшее расхождение int8-оценок с torch; fp32 обязан быть не выше 0.001",
+    )
+    args = parser.parse_args()
+    if args.reranker:
+        main_reranker(args)
+        return
+
+    model_name = os.getenv(
+        "EMBEDDINGS_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+    )
+    output_dir = Path(args.output_dir or "data/derived/onnx")
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    print(f"Экспорт {model_name} в {output_dir}")
+    model = SentenceTransformer(model_name, device="cpu")
+    config = export(model, model_name, output_dir, args.opset)
+    quantize_dynamic(
+        str(output_dir / "model.onnx"), str(output_dir / "model.int8.onnx"), weight_type=QuantType.QInt8
+    )
+
+    texts = load_texts(Path(args.data_dir), args.parity_texts)
+    reference = model.encode(
+        texts, batch_size=args.batch_size, normalize_embeddings=True, show_progress_bar=False
+    )
+    failed = False
+    for name, threshold in (("model.onnx", 0.999), ("model.int8.onnx", args.min_cosine)):
+        path = output_dir / name
+        session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+        vectors = onnx_embed(session, model, config, texts, args.batch_size)
+        cosine = (vectors * reference).sum(axis=1)
+        size_mb = path.stat().st_size / (1024 * 1024)
+        print(
+            f"{name:<16} {size_mb:7.1f} МБ  косинус с torch: mean={cosine.mean():.5f} "
+            f"min={cosine.min():.5f} на {len(texts)} текстах"
+        )
+        if cosine.min() < threshold:
+            print(f"  ниже порога {threshold}: модель {name} не подходит для индекса")
+            failed = True
+    if failed:
+        sys.exit(1)
+    print("Готово. EMBEDDINGS_PROVIDER=onnx, EMBEDDINGS_ONNX_PATH=" + str(output_dir / "model.int8.onnx"))
+
+
+if __name__ == "__main__":
+    main()
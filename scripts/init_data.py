@@ -85,38 +85,78 @@ def main() -> None:
     # Шаг 1: Ожидание PostgreSQL
     wait_for_postgres(database_url)
 
-    # Шаг 2: Подготовка фронт-бандлов
+    # full — полная пересборка; incremental — только изменения по content_hash
+    incremental = os.getenv("INIT_MODE", "full") == "incremental"
+    changeset_path = derived_dir / "changeset.json"
+    changeset_args = ["--changeset", str(changeset_path)] if incremental else []
+
+    # Шаг 2: Загрузка данных в Postgres (в incremental-режиме он же формирует changeset)
+    load_postgres_script = Path(__file__).parent.parent / "scripts" / "load_postgres" / "load_all.py"
+    if incremental:
+        load_args = ["--incremental", "--data-dir", str(data_dir), "--changeset", str(changeset_path)]
+    else:
+        # Полная перезаливка: COPY быстрее execute_values на порядок
+        load_args = ["--truncate", "--data-dir", str(data_dir), "--mode", os.getenv("LOAD_MODE", "copy")]
+    if load_postgres_script.exists():
+        run_script(
+            load_postgres_script,
+            "Загрузка данных в Postgres",
+            args=load_args,
+            env={"DATABASE_URL": database_url},
+        )
+    else:
+        print("Пропуск: скрипт load_all.py не найден")
+
+    # Шаг 3: Подготовка фронт-бандлов
     build_bundles_script = Path(__file__).parent.parent / "scripts" / "prepare_front_data" / "build_page_bundles.py"
     if build_bundles_script.exists():
         run_script(
             build_bundles_script,
             "Сборка фронт-бандлов",
+            args=changeset_args,
             env={"DATA_RAW_DIR": str(data_dir), "DATA_DERIVED_DIR": str(derived_dir)},
         )
     else:
         print("Пропуск: скрипт build_page_bundles.py не найден")
 
-    # Шаг 3: Загрузка данных в Postgres
-    load_postgres_script = Path(__file__).parent.parent / "scripts" / "load_postgres" / "load_all.py"
-    if load_postgres_script.exists():
+    # Шаг 4: ONNX-экспорт моделей, если выбран провайдер onnx и модели еще нет
+    embeddings_provider = os.getenv("EMBEDDINGS_PROVIDER", "st")
+    onnx_path = Path(os.getenv("EMBEDDINGS_ONNX_PATH", str(derived_dir / "onnx" / "model.int8.onnx")))
+    export_onnx_script = Path(__file__).parent.parent / "scripts" / "export_onnx" / "export_onnx.py"
+    if embeddings_provider == "onnx" and not onnx_path.exists():
         run_script(
-            load_postgres_script,
-            "Загрузка данных в Postgres",
-            args=["--truncate", "--data-dir", str(data_dir)],
-            env={"DATABASE_URL": database_url},
+            export_onnx_script,
+            "Экспорт модели эмбеддингов в ONNX",
+            args=["--output-dir", str(onnx_path.parent), "--data-dir", str(data_dir)],
+        )
+    # То же для cross-encoder переранжирования в API
+    reranker_onnx_path = Path(
+        os.getenv("RERANKER_ONNX_PATH", str(derived_dir / "onnx-reranker" / "model.int8.onnx"))
+    )
+    if os.getenv("RERANKER_PROVIDER", "none") == "onnx" and not reranker_onnx_path.exists():
+        run_script(
+            export_onnx_script,
+            "Экспорт cross-encoder переранжирования в ONNX",
+            args=["--reranker", "--output-dir", str(reranker_onnx_path.parent), "--data-dir", str(data_dir)],
         )
-    else:
-        print("Пропуск: скрипт load_all.py не найден")
 
-    # Шаг 4: Сборка FAISS индекса
+    # Шаг 5: Сборка FAISS индекса
     build_faiss_script = Path(__file__).parent.parent / "scripts" / "build_faiss" / "build_faiss.py"
     if build_faiss_script.exists():
         run_script(
             build_faiss_script,
             "Сборка FAISS индекса",
-            args=["--data-dir", str(data_dir), "--output-dir", str(derived_dir / "faiss"), "--batch-size", "32"],
+            args=[
+                "--data-dir", str(data_dir),
+                "--output-dir", str(derived_dir / "faiss"),
+                "--batch-size", "32",
+                "--workers", os.getenv("EMBED_WORKERS", "1"),
+            ]
+            + changeset_args
+            + (["--update"] if incremental else []),
             env={
-                "EMBEDDINGS_PROVIDER": os.getenv("EMBEDDINGS_PROVIDER", "st"),
+                "EMBEDDINGS_PROVIDER": embeddings_provider,
+                "EMBEDDINGS_ONNX_PATH": str(onnx_path),
                 "EMBEDDINGS_MODEL": os.getenv(
                     "EMBEDDINGS_MODEL",
                     "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
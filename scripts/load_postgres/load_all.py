@@ -4,15 +4,18 @@ import argparse
 import csv
 import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import psycopg2
 import psycopg2.extras
 from psycopg2.extras import Json
 
 
-CREATE_SQL = """
+SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS pages (
     page_id TEXT PRIMARY KEY,
     url TEXT UNIQUE,
@@ -51,13 +54,60 @@ CREATE TABLE IF NOT EXISTS edges (
     to_url TEXT
 );
 
+-- Версия данных: растет при любом изменении pages/text_chunks/tables.
+-- Sequence не блокирует параллельные загрузки, в отличие от счетчика в строке.
+CREATE SEQUENCE IF NOT EXISTS data_version_seq;
+
+CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+BEGIN
+    PERFORM nextval('data_version_seq');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER pages_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pages
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE OR REPLACE TRIGGER text_chunks_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON text_chunks
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+CREATE OR REPLACE TRIGGER tables_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON tables
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+"""
+
+INDEXES_SQL = """
 CREATE INDEX IF NOT EXISTS idx_pages_url ON pages(url);
 CREATE INDEX IF NOT EXISTS idx_chunks_page_id ON text_chunks(page_id);
 CREATE INDEX IF NOT EXISTS idx_tables_page_id ON tables(page_id);
 CREATE INDEX IF NOT EXISTS idx_edges_from_url ON edges(from_url);
 CREATE INDEX IF NOT EXISTS idx_edges_to_url ON edges(to_url);
+
+-- Полнотекстовый поиск (apps/api/hybrid.py): выражения должны совпадать с запросом
+CREATE INDEX IF NOT EXISTS idx_chunks_text_fts
+    ON text_chunks USING GIN (to_tsvector('russian', coalesce(text, '')));
+CREATE INDEX IF NOT EXISTS idx_pages_title_fts
+    ON pages USING GIN (to_tsvector('russian', coalesce(title, '')));
+CREATE INDEX IF NOT EXISTS idx_tables_caption_fts
+    ON tables USING GIN (to_tsvector('russian', coalesce(caption, '')));
 """
 
+CREATE_SQL = SCHEMA_SQL + INDEXES_SQL
+
+
+# Вторичные индексы из INDEXES_SQL: в режиме copy удаляются на время загрузки
+# и строятся заново повторным выполнением INDEXES_SQL
+SECONDARY_INDEXES = (
+    "idx_pages_url",
+    "idx_chunks_page_id",
+    "idx_tables_page_id",
+    "idx_edges_from_url",
+    "idx_edges_to_url",
+    "idx_chunks_text_fts",
+    "idx_pages_title_fts",
+    "idx_tables_caption_fts",
+)
+
 
 def read_jsonl(path: Path) -> Iterable[dict]:
     with path.open("r", encoding="utf-8") as handle:
@@ -78,13 +128,40 @@ def batch_iter(rows: Iterable[Tuple[object, ...]], batch_size: int) -> Iterable[
         yield batch
 
 
-def load_pages(cur: psycopg2.extensions.cursor, pages_path: Path, batch_size: int) -> None:
-    rows: List[Tuple[object, ...]] = []
-    with pages_path.open("r", encoding="utf-8") as handle:
-        reader = csv.DictReader(handle)
-        for row in reader:
-            rows.append(
-                (
+PAGES_INSERT_SQL = """
+INSERT INTO pages (
+    page_id, url, title, parent_url, breadcrumbs, toc, fetched_at, http_status, content_hash
+) VALUES %s
+"""
+
+PAGES_UPSERT_SQL = PAGES_INSERT_SQL + """
+ON CONFLICT (page_id) DO UPDATE SET
+    url = EXCLUDED.url,
+    title = EXCLUDED.title,
+    parent_url = EXCLUDED.parent_url,
+    breadcrumbs = EXCLUDED.breadcrumbs,
+    toc = EXCLUDED.toc,
+    fetched_at = EXCLUDED.fetched_at,
+    http_status = EXCLUDED.http_status,
+    content_hash = EXCLUDED.content_hash
+"""
+
+
+def load_pages(
+    cur: psycopg2.extensions.cursor,
+    pages_path: Path,
+    batch_size: int,
+    page_ids: Optional[Set[str]] = None,
+    upsert: bool = False,
+) -> None:
+    """Загружает pages.csv; page_ids ограничивает загрузку указанными страницами"""
+    def row_iter() -> Iterable[Tuple[object, ...]]:
+        with pages_path.open("r", encoding="utf-8") as handle:
+            reader = csv.DictReader(handle)
+            for row in reader:
+                if page_ids is not None and row.get("page_id") not in page_ids:
+                    continue
+                yield (
                     row.get("page_id"),
                     row.get("url"),
                     row.get("title"),
@@ -95,36 +172,22 @@ def load_pages(cur: psycopg2.extensions.cursor, pages_path: Path, batch_size: in
                     int(row.get("http_status")) if row.get("http_status") else None,
                     row.get("content_hash"),
                 )
-            )
-            if len(rows) >= batch_size:
-                psycopg2.extras.execute_values(
-                    cur,
-                    """
-                    INSERT INTO pages (
-                        page_id, url, title, parent_url, breadcrumbs, toc, fetched_at, http_status, content_hash
-                    ) VALUES %s
-                    ON CONFLICT (page_id) DO NOTHING
-                    """,
-                    rows,
-                )
-                rows = []
 
-    if rows:
-        psycopg2.extras.execute_values(
-            cur,
-            """
-            INSERT INTO pages (
-                page_id, url, title, parent_url, breadcrumbs, toc, fetched_at, http_status, content_hash
-            ) VALUES %s
-            ON CONFLICT (page_id) DO NOTHING
-            """,
-            rows,
-        )
+    sql = PAGES_UPSERT_SQL if upsert else PAGES_INSERT_SQL + "ON CONFLICT (page_id) DO NOTHING"
+    for batch in batch_iter(row_iter(), batch_size):
+        psycopg2.extras.execute_values(cur, sql, batch)
 
 
-def load_chunks(cur: psycopg2.extensions.cursor, chunks_path: Path, batch_size: int) -> None:
+def load_chunks(
+    cur: psycopg2.extensions.cursor,
+    chunks_path: Path,
+    batch_size: int,
+    page_ids: Optional[Set[str]] = None,
+) -> None:
     def row_iter() -> Iterable[Tuple[object, ...]]:
         for item in read_jsonl(chunks_path):
+            if page_ids is not None and str(item.get("page_id")) not in page_ids:
+                continue
             yield (
                 item.get("chunk_id"),
                 item.get("page_id"),
@@ -147,9 +210,16 @@ def load_chunks(cur: psycopg2.extensions.cursor, chunks_path: Path, batch_size:
         )
 
 
-def load_tables(cur: psycopg2.extensions.cursor, tables_path: Path, batch_size: int) -> None:
+def load_tables(
+    cur: psycopg2.extensions.cursor,
+    tables_path: Path,
+    batch_size: int,
+    page_ids: Optional[Set[str]] = None,
+) -> None:
     def row_iter() -> Iterable[Tuple[object, ...]]:
         for item in read_jsonl(tables_path):
+            if page_ids is not None and str(item.get("page_id")) not in page_ids:
+                continue
             yield (
                 item.get("table_id"),
                 item.get("page_id"),
@@ -175,11 +245,18 @@ def load_tables(cur: psycopg2.extensions.cursor, tables_path: Path, batch_size:
         )
 
 
-def load_edges(cur: psycopg2.extensions.cursor, edges_path: Path, batch_size: int) -> None:
+def load_edges(
+    cur: psycopg2.extensions.cursor,
+    edges_path: Path,
+    batch_size: int,
+    from_urls: Optional[Set[str]] = None,
+) -> None:
     def row_iter() -> Iterable[Tuple[object, ...]]:
         with edges_path.open("r", encoding="utf-8") as handle:
             reader = csv.DictReader(handle)
             for row in reader:
+                if from_urls is not None and row.get("from_url") not in from_urls:
+                    continue
                 yield (row.get("from_url"), row.get("to_url"))
 
     for batch in batch_iter(row_iter(), batch_size):
@@ -190,12 +267,309 @@ def load_edges(cur: psycopg2.extensions.cursor, edges_path: Path, batch_size: in
         )
 
 
+# Размер блока, которым copy_expert читает CopyStream
+COPY_READ_SIZE = 1 << 20
+
+
+def copy_value(value: object) -> str:
+    """Значение в текстовом формате COPY"""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def json_value(value: object) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+class CopyStream:
+    """Файлоподобный объект для copy_expert: строки COPY формируются по мере чтения"""
+
+    def __init__(self, rows: Iterable[Tuple[object, ...]]) -> None:
+        self._rows = iter(rows)
+        self._buffer = bytearray()
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer += ("\t".join(copy_value(value) for value in row) + "\n").encode("utf-8")
+            self.count += 1
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def page_copy_rows(pages_path: Path) -> Iterator[Tuple[object, ...]]:
+    with pages_path.open("r", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            # breadcrumbs_json/toc_json уже JSON: проверку и нормализацию делает jsonb
+            yield (
+                row.get("page_id"),
+                row.get("url"),
+                row.get("title"),
+                row.get("parent_url"),
+                row.get("breadcrumbs_json") or "null",
+                row.get("toc_json") or "null",
+                row.get("fetched_at") or None,
+                int(row.get("http_status")) if row.get("http_status") else None,
+                row.get("content_hash"),
+            )
+
+
+def chunk_copy_rows(chunks_path: Path) -> Iterator[Tuple[object, ...]]:
+    for item in read_jsonl(chunks_path):
+        yield (
+            item.get("chunk_id"),
+            item.get("page_id"),
+            item.get("chunk_index"),
+            item.get("source_order"),
+            json_value(item.get("section_path") or []),
+            item.get("text"),
+        )
+
+
+def table_copy_rows(tables_path: Path) -> Iterator[Tuple[object, ...]]:
+    for item in read_jsonl(tables_path):
+        yield (
+            item.get("table_id"),
+            item.get("page_id"),
+            item.get("table_index"),
+            item.get("source_order"),
+            json_value(item.get("section_path") or []),
+            item.get("caption"),
+            json_value(item.get("columns") or []),
+            json_value(item.get("rows") or []),
+            item.get("raw_html"),
+        )
+
+
+def edge_copy_rows(edges_path: Path) -> Iterator[Tuple[object, ...]]:
+    with edges_path.open("r", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            yield (row.get("from_url"), row.get("to_url"))
+
+
+# таблица -> (колонки, первичный ключ или None, генератор строк)
+COPY_SPECS: Dict[str, Tuple[Tuple[str, ...], Optional[str], Callable[[Path], Iterator[Tuple[object, ...]]]]] = {
+    "pages": (
+        ("page_id", "url", "title", "parent_url", "breadcrumbs", "toc", "fetched_at", "http_status", "content_hash"),
+        "page_id",
+        page_copy_rows,
+    ),
+    "text_chunks": (
+        ("chunk_id", "page_id", "chunk_index", "source_order", "section_path", "text"),
+        "chunk_id",
+        chunk_copy_rows,
+    ),
+    "tables": (
+        ("table_id", "page_id", "table_index", "source_order", "section_path", "caption", "columns", "rows", "raw_html"),
+        "table_id",
+        table_copy_rows,
+    ),
+    "edges": (("from_url", "to_url"), None, edge_copy_rows),
+}
+
+
+def copy_table(database_url: str, table: str, path: str, direct: bool) -> Tuple[str, int, float]:
+    """COPY одного файла в отдельном соединении; возвращает (таблица, строк, секунд)"""
+    columns, key, row_factory = COPY_SPECS[table]
+    column_list = ", ".join(columns)
+    stream = CopyStream(row_factory(Path(path)))
+    start = time.perf_counter()
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                if direct or key is None:
+                    cur.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", stream, size=COPY_READ_SIZE)
+                else:
+                    # В непустую таблицу — через временную, чтобы сохранить ON CONFLICT DO NOTHING
+                    cur.execute(f"CREATE TEMP TABLE stage_{table} (LIKE {table}) ON COMMIT DROP")
+                    cur.copy_expert(f"COPY stage_{table} ({column_list}) FROM STDIN", stream, size=COPY_READ_SIZE)
+                    cur.execute(
+                        f"INSERT INTO {table} ({column_list}) "
+                        f"SELECT {column_list} FROM stage_{table} ON CONFLICT ({key}) DO NOTHING"
+                    )
+    finally:
+        conn.close()
+    return table, stream.count, time.perf_counter() - start
+
+
+def report(table: str, rows: int, seconds: float) -> None:
+    rate = rows / seconds if seconds > 0 else 0.0
+    print(f"{table}: {rows} строк за {seconds:.1f} с ({rate:.0f} строк/с)")
+
+
+def build_indexes(database_url: str) -> None:
+    print("Построение индексов...")
+    start = time.perf_counter()
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(INDEXES_SQL)
+        # ANALYZE вне транзакции с CREATE INDEX, чтобы планировщик сразу видел новые объемы
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE pages, text_chunks, tables, edges")
+    finally:
+        conn.close()
+    print(f"Индексы и статистика: {time.perf_counter() - start:.1f} с")
+
+
+def load_copy(database_url: str, paths: Dict[str, Path], direct: bool, workers: int) -> None:
+    """Загрузка через COPY: pages первой, остальные таблицы параллельно в отдельных процессах"""
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                for index_name in SECONDARY_INDEXES:
+                    cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+    finally:
+        conn.close()
+
+    # Индексы строятся и после упавшей или прерванной загрузки: без них API читает таблицы целиком
+    try:
+        if paths["pages"].exists():
+            print("Загрузка pages.csv (COPY)...")
+            report(*copy_table(database_url, "pages", str(paths["pages"]), direct))
+
+        pending = [table for table in ("text_chunks", "tables", "edges") if paths[table].exists()]
+        if pending:
+            print(f"Загрузка {', '.join(pending)} (COPY, процессов: {min(workers, len(pending))})...")
+            with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+                futures = [
+                    pool.submit(copy_table, database_url, table, str(paths[table]), direct) for table in pending
+                ]
+                for future in futures:
+                    report(*future.result())
+    finally:
+        build_indexes(database_url)
+
+
+def read_page_hashes(pages_path: Path) -> Dict[str, Tuple[str, str]]:
+    """page_id -> (url, content_hash) из pages.csv"""
+    pages: Dict[str, Tuple[str, str]] = {}
+    with pages_path.open("r", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            if row.get("page_id"):
+                pages[row["page_id"]] = (row.get("url") or "", row.get("content_hash") or "")
+    return pages
+
+
+def load_incremental(
+    conn: psycopg2.extensions.connection, paths: Dict[str, Path], batch_size: int
+) -> Dict[str, object]:
+    """Применяет к БД только разницу с pages.csv по content_hash; возвращает changeset"""
+    incoming = read_page_hashes(paths["pages"])
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT page_id, url, content_hash FROM pages")
+            stored = {page_id: (url or "", content_hash or "") for page_id, url, content_hash in cur.fetchall()}
+
+            added = sorted(set(incoming) - set(stored))
+            removed = sorted(set(stored) - set(incoming))
+            # Страница без content_hash считается измененной: сравнить не с чем
+            changed = sorted(
+                page_id
+                for page_id in set(incoming) & set(stored)
+                if not incoming[page_id][1] or incoming[page_id][1] != stored[page_id][1]
+            )
+            changeset: Dict[str, object] = {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "pages": {"added": added, "changed": changed, "removed": removed},
+                "chunks": {"upserted": [], "removed": []},
+                "tables": {"upserted": [], "removed": []},
+            }
+            print(f"Страниц: новых {len(added)}, измененных {len(changed)}, удаленных {len(removed)}")
+            if not (added or changed or removed):
+                # Даже пустые DELETE сдвинули бы версию данных через триггеры
+                return changeset
+
+            stale = changed + removed
+            upserted = set(added) | set(changed)
+            cur.execute("DELETE FROM text_chunks WHERE page_id = ANY(%s) RETURNING chunk_id", (stale,))
+            deleted_chunks = {row[0] for row in cur.fetchall()}
+            cur.execute("DELETE FROM tables WHERE page_id = ANY(%s) RETURNING table_id", (stale,))
+            deleted_tables = {row[0] for row in cur.fetchall()}
+            urls = {stored[page_id][0] for page_id in stale} | {incoming[page_id][0] for page_id in upserted}
+            cur.execute("DELETE FROM edges WHERE from_url = ANY(%s)", (sorted(url for url in urls if url),))
+            cur.execute("DELETE FROM pages WHERE page_id = ANY(%s)", (removed,))
+
+            load_pages(cur, paths["pages"], batch_size, page_ids=upserted, upsert=True)
+            if paths["text_chunks"].exists():
+                load_chunks(cur, paths["text_chunks"], batch_size, page_ids=upserted)
+            if paths["tables"].exists():
+                load_tables(cur, paths["tables"], batch_size, page_ids=upserted)
+            if paths["edges"].exists():
+                load_edges(
+                    cur, paths["edges"], batch_size, from_urls={incoming[page_id][0] for page_id in upserted}
+                )
+
+            cur.execute("SELECT chunk_id FROM text_chunks WHERE page_id = ANY(%s)", (sorted(upserted),))
+            upserted_chunks = {row[0] for row in cur.fetchall()}
+            cur.execute("SELECT table_id FROM tables WHERE page_id = ANY(%s)", (sorted(upserted),))
+            upserted_tables = {row[0] for row in cur.fetchall()}
+
+    changeset["chunks"] = {
+        "upserted": sorted(upserted_chunks),
+        "removed": sorted(deleted_chunks - upserted_chunks),
+    }
+    changeset["tables"] = {
+        "upserted": sorted(upserted_tables),
+        "removed": sorted(deleted_tables - upserted_tables),
+    }
+    return changeset
+
+
+def write_changeset(path: Path, changeset: Dict[str, object]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as handle:
+        json.dump(changeset, handle, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def changeset_is_empty(changeset: Dict[str, object]) -> bool:
+    return not any(values for values in changeset["pages"].values())
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Загрузка данных UPVS в Postgres")
     parser.add_argument("--truncate", action="store_true", default=False)
     parser.add_argument("--data-dir", default="data/raw")
     parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--mode",
+        choices=["insert", "copy"],
+        default="insert",
+        help="insert — execute_values в одной транзакции; copy — COPY FROM STDIN, параллельно по таблицам",
+    )
+    parser.add_argument("--workers", type=int, default=3, help="процессов COPY для text_chunks/tables/edges")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="загрузить только новые/измененные (по content_hash) страницы и удалить исчезнувшие",
+    )
+    parser.add_argument(
+        "--changeset",
+        default=str(Path(os.getenv("DATA_DERIVED_DIR", "data/derived")) / "changeset.json"),
+        help="куда записать changeset в режиме --incremental",
+    )
     args = parser.parse_args()
+    if args.incremental and (args.truncate or args.mode != "insert"):
+        parser.error("--incremental несовместим с --truncate и --mode copy")
 
     data_dir = Path(args.data_dir)
     pages_path = data_dir / "pages.csv"
@@ -208,23 +582,50 @@ def main() -> None:
     try:
         with conn:
             with conn.cursor() as cur:
-                cur.execute(CREATE_SQL)
+                # В режиме copy индексы все равно удаляются перед загрузкой и строятся после нее
+                cur.execute(SCHEMA_SQL if args.mode == "copy" else CREATE_SQL)
                 if args.truncate:
                     cur.execute("TRUNCATE edges, tables, text_chunks, pages")
+        if args.incremental:
+            if not pages_path.exists():
+                raise FileNotFoundError(pages_path)
+            changeset = load_incremental(
+                conn,
+                {"pages": pages_path, "text_chunks": chunks_path, "tables": tables_path, "edges": edges_path},
+                args.batch_size,
+            )
+            write_changeset(Path(args.changeset), changeset)
+            print(f"Changeset: {args.changeset}")
+            if changeset_is_empty(changeset):
+                print("Изменений нет.")
+                return
+        elif args.mode == "copy":
+            load_copy(
+                database_url,
+                {"pages": pages_path, "text_chunks": chunks_path, "tables": tables_path, "edges": edges_path},
+                direct=args.truncate,
+                workers=args.workers,
+            )
+        else:
+            with conn:
+                with conn.cursor() as cur:
+                    if pages_path.exists():
+                        print("Загрузка pages.csv...")
+                        load_pages(cur, pages_path, args.batch_size)
+                    if chunks_path.exists():
+                        print("Загрузка text_chunks.jsonl...")
+                        load_chunks(cur, chunks_path, args.batch_size)
+                    if tables_path.exists():
+                        print("Загрузка tables.jsonl...")
+                        load_tables(cur, tables_path, args.batch_size)
+                    if edges_path.exists():
+                        print("Загрузка edges.csv...")
+                        load_edges(cur, edges_path, args.batch_size)
+        # Триггеры уже сдвинули версию внутри транзакции; сдвигаем еще раз после
+        # коммита, чтобы API не закэшировал данные, прочитанные до него
         with conn:
             with conn.cursor() as cur:
-                if pages_path.exists():
-                    print("Загрузка pages.csv...")
-                    load_pages(cur, pages_path, args.batch_size)
-                if chunks_path.exists():
-                    print("Загрузка text_chunks.jsonl...")
-                    load_chunks(cur, chunks_path, args.batch_size)
-                if tables_path.exists():
-                    print("Загрузка tables.jsonl...")
-                    load_tables(cur, tables_path, args.batch_size)
-                if edges_path.exists():
-                    print("Загрузка edges.csv...")
-                    load_edges(cur, edges_path, args.batch_size)
+                cur.execute("SELECT nextval('data_version_seq')")
         print("Готово.")
     finally:
         conn.close()
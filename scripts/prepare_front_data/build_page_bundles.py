@@ -1,11 +1,12 @@
 from __future__ import annotations
 
+import argparse
 import csv
 import json
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Generator, List, TypedDict
+from typing import Dict, Generator, List, Optional, Set, TypedDict
 
 
 class PageRow(TypedDict, total=False):
@@ -66,7 +67,20 @@ def load_pages(pages_path: Path) -> Dict[str, PageRow]:
     return pages
 
 
+def load_changeset(path: Path) -> Dict[str, List[str]]:
+    with path.open("r", encoding="utf-8") as handle:
+        return json.load(handle)["pages"]
+
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Сборка бандлов страниц для фронта")
+    parser.add_argument(
+        "--changeset",
+        default=None,
+        help="changeset.json из load_all.py --incremental: пересобрать только затронутые страницы",
+    )
+    args = parser.parse_args()
+
     data_dir = Path(os.getenv("DATA_RAW_DIR", "data/raw"))
     derived_dir = Path(os.getenv("DATA_DERIVED_DIR", "data/derived"))
     pages_path = data_dir / "pages.csv"
@@ -77,10 +91,23 @@ def main() -> None:
         raise FileNotFoundError(pages_path)
 
     pages = load_pages(pages_path)
-    bundles: Dict[str, List[Block]] = {page_id: [] for page_id in pages.keys()}
-    text_chars_total: Dict[str, int] = {page_id: 0 for page_id in pages.keys()}
-    chunks_count: Dict[str, int] = {page_id: 0 for page_id in pages.keys()}
-    tables_count: Dict[str, int] = {page_id: 0 for page_id in pages.keys()}
+    output_dir = derived_dir / "page_bundles"
+    index_path = derived_dir / "pages_index.json"
+
+    # None — собрать все страницы
+    only: Optional[Set[str]] = None
+    removed: List[str] = []
+    if args.changeset and index_path.exists():
+        page_changes = load_changeset(Path(args.changeset))
+        only = set(page_changes["added"]) | set(page_changes["changed"])
+        removed = page_changes["removed"]
+        print(f"Changeset: пересборка {len(only)} страниц, удаление {len(removed)}")
+
+    selected = [page_id for page_id in pages.keys() if only is None or page_id in only]
+    bundles: Dict[str, List[Block]] = {page_id: [] for page_id in selected}
+    text_chars_total: Dict[str, int] = {page_id: 0 for page_id in selected}
+    chunks_count: Dict[str, int] = {page_id: 0 for page_id in selected}
+    tables_count: Dict[str, int] = {page_id: 0 for page_id in selected}
 
     if chunks_path.exists():
         for item in read_jsonl(chunks_path):
@@ -116,8 +143,9 @@ def main() -> None:
             bundles[page_id].append(block)
             tables_count[page_id] += 1
 
-    output_dir = derived_dir / "page_bundles"
     output_dir.mkdir(parents=True, exist_ok=True)
+    for page_id in removed:
+        (output_dir / f"{page_id}.json").unlink(missing_ok=True)
 
     page_index: List[PageIndex] = []
     for page_id, blocks in bundles.items():
@@ -148,9 +176,18 @@ def main() -> None:
             )
         )
 
-    index_path = derived_dir / "pages_index.json"
-    with index_path.open("w", encoding="utf-8") as handle:
-        json.dump([item.__dict__ for item in page_index], handle, ensure_ascii=False)
+    index_items = [item.__dict__ for item in page_index]
+    if only is not None:
+        # Остальные записи берем из прежнего индекса, порядок — как в pages.csv
+        with index_path.open("r", encoding="utf-8") as handle:
+            entries = {item["page_id"]: item for item in json.load(handle)}
+        entries.update((item["page_id"], item) for item in index_items)
+        index_items = [entries[page_id] for page_id in pages.keys() if page_id in entries]
+
+    tmp_path = index_path.with_suffix(".json.tmp")
+    with tmp_path.open("w", encoding="utf-8") as handle:
+        json.dump(index_items, handle, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
 
 
 if __name__ == "__main__":
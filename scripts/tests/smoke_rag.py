@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import json
 import os
+import time
+
 import requests
 
 
@@ -12,6 +15,16 @@ def main() -> None:
     health.raise_for_status()
     print(health.json())
 
+    print("Ожидание /ready...")
+    deadline = time.monotonic() + float(os.getenv("READY_TIMEOUT", "300"))
+    while True:
+        ready = requests.get(f"{api_base}/ready", timeout=10)
+        if ready.status_code == 200 or time.monotonic() > deadline:
+            break
+        time.sleep(2)
+    ready.raise_for_status()
+    print(ready.json())
+
     query = "Что такое метод конечных элементов?"
 
     print("Проверка /search...")
@@ -24,6 +37,17 @@ def main() -> None:
     search_payload = search.json()
     print("Найдено:", len(search_payload.get("hits", [])))
 
+    print("Проверка /search/batch...")
+    batch = requests.post(
+        f"{api_base}/search/batch",
+        json={"queries": [query, "таблица 12"], "top_k": 5},
+        timeout=60,
+        stream=True,
+    )
+    batch.raise_for_status()
+    lines = [json.loads(line) for line in batch.iter_lines() if line]
+    print("Строк NDJSON:", len(lines), "ошибок:", sum(1 for line in lines if "error" in line))
+
     print("Проверка /rag...")
     rag = requests.post(
         f"{api_base}/rag",
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts" / "build_faiss"))
+
+from build_faiss import embedding_cache_dir  # noqa: E402
+from embedding_cache import EmbeddingDiskCache, text_key  # noqa: E402
+
+MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+
+def test_onnx_cache_dir_follows_file_content(tmp_path: Path) -> None:
+    model = tmp_path / "model.int8.onnx"
+    model.write_bytes(b"first export")
+    first = embedding_cache_dir(tmp_path / "cache", "onnx", MODEL, str(model))
+    assert embedding_cache_dir(tmp_path / "cache", "onnx", MODEL, str(model)) == first
+    model.write_bytes(b"second export")
+    assert embedding_cache_dir(tmp_path / "cache", "onnx", MODEL, str(model)) != first
+    assert embedding_cache_dir(tmp_path / "cache", "st", MODEL, str(model)) != first
+
+
+def test_disk_cache_round_trip_and_compact(tmp_path: Path) -> None:
+    cache = EmbeddingDiskCache(tmp_path)
+    vectors = {text: np.random.default_rng(n).random(4).astype("float32") for n, text in enumerate("abc")}
+    for text, vector in vectors.items():
+        cache.put(text_key(text), vector)
+    cache.flush()
+
+    reopened = EmbeddingDiskCache(tmp_path)
+    assert len(reopened) == 3
+    for text, vector in vectors.items():
+        np.testing.assert_allclose(reopened.get(text_key(text)), vector, atol=1e-3)
+    assert reopened.get(text_key("missing")) is None
+
+    reopened = EmbeddingDiskCache(tmp_path)
+    reopened.touch(text_key("a"))
+    assert reopened.compact() == 2
+    assert len(EmbeddingDiskCache(tmp_path)) == 1
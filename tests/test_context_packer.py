@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from typing import Dict
+
+from apps.api.context_packer import (
+    MIN_SOURCE_TOKENS,
+    ApproxTokenCounter,
+    ContextPacker,
+    strip_overlap,
+    trim_table,
+)
+
+
+def _render(number: int, source: Dict[str, object]) -> str:
+    lines = [f"[{number}] {source['text']}"]
+    for table in source["tables"]:
+        lines.append(f"Таблица {table['table_id']}")
+        lines.extend(" | ".join(str(cell) for cell in row) for row in table["rows"])
+    return "\n".join(lines)
+
+
+def _packer(table_max_rows: int = 0) -> ContextPacker:
+    return ContextPacker("approx", "", table_max_rows)
+
+
+def _source(page_id: str, text: str, tables=None) -> Dict[str, object]:
+    return {"page_id": page_id, "text": text, "tables": tables or []}
+
+
+def test_approx_counter_counts_digits_one_by_one() -> None:
+    counter = ApproxTokenCounter()
+    assert counter.count("123") == 3
+    assert counter.count("бетон") == 2
+    assert counter.count("") == 0
+
+
+def test_fits_budget_and_drops_the_rest() -> None:
+    packer = _packer()
+    sources = [_source(f"p{i}", "слово " * 200) for i in range(5)]
+    budget = packer.count(_render(1, sources[0])) * 2 + MIN_SOURCE_TOKENS // 2
+    result = packer.pack("слово", sources, budget, _render)
+    assert result.tokens <= budget
+    assert len(result.blocks) == 2
+    assert result.dropped == 3
+    assert sum(packer.count(block) for block in result.blocks) == result.tokens
+
+
+def test_shrinks_source_that_does_not_fit() -> None:
+    packer = _packer()
+    sources = [_source("p1", "слово " * 50), _source("p2", "другое " * 500), _source("p3", "ещё")]
+    first = packer.count(_render(1, sources[0]))
+    budget = first + 200
+    result = packer.pack("слово", sources, budget, _render)
+    assert result.tokens <= budget
+    assert len(result.blocks) == 2
+    assert str(result.sources[1]["text"]).endswith("…")
+    assert result.dropped == 1
+    # Исходный источник не меняется
+    assert sources[1]["text"] == "другое " * 500
+
+
+def test_small_remainder_is_not_spent_on_truncated_source() -> None:
+    packer = _packer()
+    sources = [_source("p1", "слово " * 50), _source("p2", "другое " * 500)]
+    budget = packer.count(_render(1, sources[0])) + MIN_SOURCE_TOKENS - 1
+    result = packer.pack("слово", sources, budget, _render)
+    assert len(result.blocks) == 1
+    assert result.dropped == 1
+
+
+def test_duplicate_chunk_and_table_are_packed_once() -> None:
+    packer = _packer()
+    table = {"table_id": "t1", "rows": [["a", "1"]]}
+    text = "Текст страницы о фундаментах и подвалах одноэтажных зданий."
+    sources = [_source("p1", text, [table]), _source("p1", text, [table]), _source("p2", "другой текст", [table])]
+    result = packer.pack("фундамент", sources, 10_000, _render)
+    assert result.deduplicated == 1
+    assert len(result.blocks) == 2
+    assert result.sources[1]["tables"] == []
+
+
+def test_strip_overlap_removes_shared_prefix() -> None:
+    shared = "общая часть соседних чанков одной страницы, длиннее порога"
+    assert strip_overlap(shared + " хвост", ["начало " + shared]) == "хвост"
+    assert strip_overlap("короткий", ["другой текст"]) == "короткий"
+    assert strip_overlap("часть", ["целая часть текста"]) is None
+
+
+def test_trim_table_keeps_matching_rows_in_order() -> None:
+    table = {"table_id": "t", "rows": [["бетон", "1"], ["сталь", "2"], ["бетонный", "3"], ["дерево", "4"]]}
+    trimmed = trim_table(table, {"бетон"}, 2)
+    assert trimmed["rows"] == [["бетон", "1"], ["бетонный", "3"]]
+    assert trimmed["rows_total"] == 4
+    assert trim_table(table, {"нет"}, 2)["rows"] == [["бетон", "1"], ["сталь", "2"]]
+    assert trim_table(table, {"бетон"}, 0) is table
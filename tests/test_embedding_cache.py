@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import dataclasses
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pytest
+
+from apps.api.config import get_settings
+from apps.api.embedding_cache import (
+    CachedEmbeddingProvider,
+    SharedEmbeddingCache,
+    SqliteEmbeddingCache,
+    cache_key,
+    embedding_namespace,
+)
+from apps.api.embeddings import EmbeddingProvider
+
+
+class CountingProvider(EmbeddingProvider):
+    def __init__(self) -> None:
+        self.calls: List[List[str]] = []
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        self.calls.append(list(texts))
+        return np.asarray([[float(len(text)), 1.0] for text in texts], dtype="float32")
+
+
+class FailingCache(SharedEmbeddingCache):
+    def get_many(self, keys):
+        raise ConnectionError("down")
+
+    def set_many(self, items):
+        raise ConnectionError("down")
+
+
+def test_namespace_tracks_onnx_file_content(tmp_path: Path) -> None:
+    model = tmp_path / "model.int8.onnx"
+    model.write_bytes(b"first export")
+    settings = dataclasses.replace(get_settings(), embeddings_provider="onnx", embeddings_onnx_path=str(model))
+    before = embedding_namespace(settings)
+    model.write_bytes(b"second export")
+    assert embedding_namespace(settings) != before
+    st = dataclasses.replace(settings, embeddings_provider="st")
+    assert embedding_namespace(st) != before
+
+
+def test_cache_key_normalizes_query() -> None:
+    assert cache_key("ns", "  Что  ТАКОЕ МКЭ ") == cache_key("ns", "что такое мкэ")
+    assert cache_key("ns", "мкэ") != cache_key("other", "мкэ")
+
+
+def test_local_cache_hits_and_deduplicates() -> None:
+    inner = CountingProvider()
+    provider = CachedEmbeddingProvider(inner, "ns", max_size=10, ttl=0)
+    first = provider.embed(["a", "bb", "a"])
+    second = provider.embed(["bb"])
+    assert inner.calls == [["a", "bb"]]
+    assert first.shape == (3, 2)
+    np.testing.assert_array_equal(second[0], first[1])
+    assert provider.stats()["hits"] == 1
+
+
+def test_shared_cache_errors_are_counted() -> None:
+    inner = CountingProvider()
+    provider = CachedEmbeddingProvider(inner, "ns", max_size=10, ttl=0, shared=FailingCache())
+    provider.embed(["a"])
+    assert provider.stats()["shared_errors"] == 2
+
+
+def test_sqlite_prunes_to_max_rows(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = SqliteEmbeddingCache(str(tmp_path / "cache.sqlite"), ttl=0, max_rows=2)
+    monkeypatch.setattr(SqliteEmbeddingCache, "PRUNE_EVERY", 1)
+    for n in range(4):
+        cache.set_many({f"k{n}": np.full(2, n, dtype="float32")})
+        time.sleep(0.01)
+    assert sorted(cache.get_many(["k0", "k1", "k2", "k3"])) == ["k2", "k3"]
+
+
+def test_shared_cache_is_abstract() -> None:
+    with pytest.raises(TypeError):
+        SharedEmbeddingCache()
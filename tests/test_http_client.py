@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import time
+
+import httpx
+import pytest
+
+from apps.api.config import get_settings
+from apps.api.http_client import NOT_SENT_ERRORS, CircuitBreaker, CircuitOpenError, HttpClient
+
+RESET = 0.05
+
+
+def _open(breaker: CircuitBreaker, failures: int = 2) -> None:
+    for _ in range(failures):
+        assert breaker.before_request() is False
+        breaker.record_failure()
+
+
+def test_opens_after_threshold_and_rejects() -> None:
+    breaker = CircuitBreaker("svc", failure_threshold=2, reset_timeout=RESET)
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state()["state"] == "closed"
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state() == {"state": "open", "consecutive_failures": 2}
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_half_open_allows_single_trial() -> None:
+    breaker = CircuitBreaker("svc", failure_threshold=2, reset_timeout=RESET)
+    _open(breaker)
+    time.sleep(RESET * 1.5)
+    assert breaker.state()["state"] == "half_open"
+    assert breaker.before_request() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    breaker.record_success()
+    assert breaker.state() == {"state": "closed", "consecutive_failures": 0}
+    assert breaker.before_request() is False
+
+
+def test_failed_trial_reopens() -> None:
+    breaker = CircuitBreaker("svc", failure_threshold=5, reset_timeout=RESET)
+    _open(breaker, failures=5)
+    time.sleep(RESET * 1.5)
+    assert breaker.before_request() is True
+    breaker.record_failure()
+    assert breaker.state()["state"] == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_released_trial_can_be_retried() -> None:
+    breaker = CircuitBreaker("svc", failure_threshold=2, reset_timeout=RESET)
+    _open(breaker)
+    time.sleep(RESET * 1.5)
+    assert breaker.before_request() is True
+    breaker.release_trial()
+    assert breaker.before_request() is True
+
+
+def test_connect_timeout_counts_as_not_sent() -> None:
+    assert isinstance(httpx.ConnectTimeout("timeout"), NOT_SENT_ERRORS)
+    assert isinstance(CircuitOpenError("open"), NOT_SENT_ERRORS)
+
+
+async def _client(handler) -> HttpClient:
+    settings = dataclasses.replace(
+        get_settings(),
+        http_retries=0,
+        breaker_failure_threshold=1,
+        breaker_reset_timeout=RESET,
+    )
+    client = HttpClient(settings)
+    await client.start()
+    await client._client.aclose()
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def test_cancelled_half_open_trial_releases_breaker() -> None:
+    mode = {"value": "fail"}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if mode["value"] == "fail":
+            raise httpx.ConnectTimeout("timeout", request=request)
+        if mode["value"] == "hang":
+            await asyncio.sleep(10)
+        return httpx.Response(200, json={"ok": True})
+
+    async def scenario() -> None:
+        client = await _client(handler)
+        try:
+            with pytest.raises(httpx.ConnectTimeout):
+                await client.request("vllm", "GET", "http://vllm/health")
+            with pytest.raises(CircuitOpenError):
+                await client.request("vllm", "GET", "http://vllm/health")
+            await asyncio.sleep(RESET * 1.5)
+
+            # Пробный запрос отменяется, как при отключении клиента /rag
+            mode["value"] = "hang"
+            trial = asyncio.create_task(client.request("vllm", "GET", "http://vllm/health"))
+            await asyncio.sleep(0.01)
+            trial.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+
+            mode["value"] = "ok"
+            response = await client.request("vllm", "GET", "http://vllm/health")
+            assert response.status_code == 200
+            assert client.stats()["vllm"]["state"] == "closed"
+        finally:
+            await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_non_transport_error_releases_trial() -> None:
+    mode = {"value": "fail"}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if mode["value"] == "fail":
+            raise httpx.ConnectError("refused", request=request)
+        if mode["value"] == "bad":
+            raise httpx.DecodingError("broken", request=request)
+        return httpx.Response(200)
+
+    async def scenario() -> None:
+        client = await _client(handler)
+        try:
+            with pytest.raises(httpx.ConnectError):
+                await client.request("vllm", "GET", "http://vllm/health")
+            await asyncio.sleep(RESET * 1.5)
+            mode["value"] = "bad"
+            with pytest.raises(httpx.DecodingError):
+                await client.request("vllm", "GET", "http://vllm/health")
+            mode["value"] = "ok"
+            assert (await client.request("vllm", "GET", "http://vllm/health")).status_code == 200
+        finally:
+            await client.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, List
+
+import pytest
+
+from apps.api.faiss_store import FaissHit
+from apps.api.hybrid import LEXICAL_SQL, LexicalRetriever, reciprocal_rank_fusion
+
+
+def _hit(chunk_id: str, score: float, url: str = "") -> FaissHit:
+    return FaissHit(
+        chunk_id=chunk_id,
+        page_id=f"page-{chunk_id}",
+        url=url,
+        score=score,
+        section_path=[],
+        source_order=0,
+        text_preview="",
+    )
+
+
+def test_rrf_sums_reciprocal_ranks() -> None:
+    fused = reciprocal_rank_fusion(
+        [_hit("a", 0.9), _hit("b", 0.8)],
+        {"text": [_hit("b", 3.0), _hit("c", 1.0)], "title": [], "caption": [_hit("b", 0.5)]},
+        k=60,
+    )
+    scores: Dict[str, float] = {item.hit.chunk_id: item.score for item in fused}
+    assert [item.hit.chunk_id for item in fused] == ["b", "a", "c"]
+    assert scores["a"] == pytest.approx(1 / 61)
+    assert scores["b"] == pytest.approx(1 / 62 + 1 / 61 + 1 / 61)
+    assert scores["c"] == pytest.approx(1 / 62)
+
+
+def test_rrf_keeps_vector_hit_and_best_lexical_score() -> None:
+    fused = reciprocal_rank_fusion(
+        [_hit("a", 0.7, url="faiss")],
+        {"text": [_hit("a", 0.2, url="fts")], "title": [_hit("a", 0.6, url="fts")], "caption": []},
+    )
+    assert len(fused) == 1
+    assert fused[0].hit.url == "faiss"
+    assert fused[0].vector_score == 0.7
+    assert fused[0].lexical_score == 0.6
+
+
+def test_rrf_ties_are_ordered_by_chunk_id() -> None:
+    fused = reciprocal_rank_fusion([], {"text": [_hit("b", 1.0)], "title": [_hit("a", 1.0)], "caption": []})
+    assert [item.hit.chunk_id for item in fused] == ["a", "b"]
+    assert all(item.vector_score is None for item in fused)
+
+
+class FakeAdb:
+    def __init__(self, rows: List[Dict[str, object]]) -> None:
+        self.rows = rows
+        self.calls = []
+
+    async def fetch_all(self, sql: str, params: tuple) -> List[Dict[str, object]]:
+        self.calls.append((sql, params))
+        return self.rows
+
+
+def _row(n: int, source: str, chunk_id: str, rank: float) -> Dict[str, object]:
+    return {
+        "n": n,
+        "source": source,
+        "rank": rank,
+        "chunk_id": chunk_id,
+        "page_id": "p",
+        "section_path": None,
+        "source_order": None,
+        "text_preview": None,
+        "url": None,
+    }
+
+
+def test_lexical_rows_are_split_per_query_and_source() -> None:
+    adb = FakeAdb(
+        [
+            _row(1, "caption", "c1", 0.9),
+            _row(1, "caption", "c1", 0.4),
+            _row(1, "text", "c2", 0.5),
+            _row(2, "title", "c3", 0.7),
+        ]
+    )
+    results = asyncio.run(LexicalRetriever(adb).search_many(["первый", "второй"], 5))
+    assert adb.calls == [(LEXICAL_SQL, (["первый", "второй"], 5, 5, 5))]
+    assert [hit.chunk_id for hit in results[0]["caption"]] == ["c1"]
+    assert results[0]["caption"][0].score == 0.9
+    assert [hit.chunk_id for hit in results[0]["text"]] == ["c2"]
+    assert results[0]["title"] == []
+    assert [hit.chunk_id for hit in results[1]["title"]] == ["c3"]
+
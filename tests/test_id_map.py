@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from apps.api.id_map import IdMap, JsonlIdMap, MmapIdMap, open_id_map
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts" / "build_faiss"))
+
+from build_faiss import ChunkMeta, IdMapWriter, stable_id  # noqa: E402
+
+
+def _meta(n: int) -> ChunkMeta:
+    chunk_id = f"chunk-{n}"
+    return ChunkMeta(
+        chunk_id=chunk_id,
+        page_id=f"page-{n // 2}",
+        url=f"https://example.org/{n // 2}",
+        section_path=["Раздел", f"Подраздел {n}"],
+        source_order=n * 10,
+        text_preview=f"Текст чанка {n} — с юникодом",
+        id=stable_id(chunk_id),
+        text_hash=f"hash-{n}",
+    )
+
+
+@pytest.fixture
+def written(tmp_path: Path):
+    metas = [_meta(n) for n in range(5)]
+    writer = IdMapWriter(tmp_path / "id_map.bin", tmp_path / "id_map.jsonl")
+    for meta in metas:
+        writer.add(meta)
+    writer.close()
+    return tmp_path, metas
+
+
+def _expected(meta: ChunkMeta) -> dict:
+    return {
+        "chunk_id": meta.chunk_id,
+        "page_id": meta.page_id,
+        "url": meta.url,
+        "section_path": meta.section_path,
+        "source_order": meta.source_order,
+        "text_preview": meta.text_preview,
+    }
+
+
+def test_mmap_round_trip(written) -> None:
+    directory, metas = written
+    id_map = MmapIdMap(str(directory / "id_map.bin"))
+    try:
+        assert len(id_map) == len(metas)
+        for row, meta in enumerate(metas):
+            assert id_map.record(row) == _expected(meta)
+        labels = np.array([metas[3].id, -1, 12345, metas[0].id], dtype="int64")
+        assert id_map.rows_for_labels(labels).tolist() == [3, -1, -1, 0]
+    finally:
+        id_map.close()
+
+
+def test_jsonl_matches_mmap(written) -> None:
+    directory, metas = written
+    jsonl = JsonlIdMap(str(directory / "id_map.jsonl"))
+    labels = np.array([m.id for m in reversed(metas)], dtype="int64")
+    assert jsonl.rows_for_labels(labels).tolist() == [4, 3, 2, 1, 0]
+    for row, meta in enumerate(metas):
+        record = jsonl.record(row)
+        assert {key: record[key] for key in _expected(meta)} == _expected(meta)
+
+
+def test_open_id_map_falls_back_to_jsonl(written) -> None:
+    directory, _ = written
+    id_map = open_id_map(str(directory / "missing.bin"), str(directory / "id_map.jsonl"))
+    assert isinstance(id_map, JsonlIdMap)
+
+
+def test_close_with_live_view(written) -> None:
+    directory, metas = written
+    id_map = MmapIdMap(str(directory / "id_map.bin"))
+    view = id_map._numbers["source_order"]
+    id_map.close()
+    # Представление остается рабочим, mmap освобождается вместе с ним
+    assert view.tolist() == [meta.source_order for meta in metas]
+
+
+def test_id_map_is_abstract() -> None:
+    with pytest.raises(TypeError):
+        IdMap()
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import dataclasses
+import threading
+from typing import List
+
+import numpy as np
+import pytest
+
+from apps.api.config import get_settings
+from apps.api.embeddings import BatchingEmbeddingProvider, EmbeddingProvider, MicroBatcher
+from apps.api.faiss_store import FaissStore
+
+
+def _submit_concurrently(batcher: MicroBatcher, items: List[object]) -> List[object]:
+    futures = [batcher.submit(item) for item in items]
+    try:
+        return [future.result(timeout=5) for future in futures]
+    finally:
+        batcher.close()
+
+
+def test_results_are_split_back_in_order() -> None:
+    batches: List[List[int]] = []
+
+    def square(items: List[int]) -> List[int]:
+        batches.append(list(items))
+        return [item * item for item in items]
+
+    batcher = MicroBatcher(square, window=0.05, max_batch=4, name="test")
+    assert _submit_concurrently(batcher, list(range(10))) == [n * n for n in range(10)]
+    assert all(len(batch) <= 4 for batch in batches)
+    assert [item for batch in batches for item in batch] == list(range(10))
+
+
+def test_short_result_fails_every_future() -> None:
+    batcher = MicroBatcher(lambda items: items[:-1], window=0.05, max_batch=8, name="short")
+    futures = [batcher.submit(n) for n in range(3)]
+    try:
+        for future in futures:
+            with pytest.raises(RuntimeError, match="short"):
+                future.result(timeout=5)
+    finally:
+        batcher.close()
+
+
+def test_exception_is_propagated_to_batch() -> None:
+    def fail(items: List[int]) -> List[int]:
+        raise ValueError("model error")
+
+    batcher = MicroBatcher(fail, window=0.0, max_batch=8, name="fail")
+    future = batcher.submit(1)
+    try:
+        with pytest.raises(ValueError, match="model error"):
+            future.result(timeout=5)
+    finally:
+        batcher.close()
+
+
+def test_concurrent_callers_share_one_batch() -> None:
+    batches: List[int] = []
+    batcher = MicroBatcher(lambda items: (batches.append(len(items)), items)[1], 0.2, 16, "shared")
+    results: List[int] = [0] * 8
+    start = threading.Barrier(8)
+
+    def call(n: int) -> None:
+        start.wait()
+        results[n] = batcher.submit(n).result(timeout=5)
+
+    threads = [threading.Thread(target=call, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    assert results == list(range(8))
+    assert len(batches) < 8
+
+
+class RowProvider(EmbeddingProvider):
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray([[float(len(text))] for text in texts], dtype="float32")
+
+
+def test_batching_provider_keeps_row_order() -> None:
+    provider = BatchingEmbeddingProvider(RowProvider(), window=0.01, max_batch=2)
+    vectors = provider.embed(["a", "bbb", "cc"])
+    assert vectors[:, 0].tolist() == [1.0, 3.0, 2.0]
+
+
+def test_search_batch_trims_each_request_to_its_top_k() -> None:
+    store = FaissStore(dataclasses.replace(get_settings(), search_batch_window_ms=0))
+    calls = []
+
+    def search_many(queries: List[str], top_k: int) -> List[List[int]]:
+        calls.append((list(queries), top_k))
+        return [list(range(top_k)) for _ in queries]
+
+    store.search_many = search_many
+    assert store._search_batch([("a", 2), ("b", 5)]) == [[0, 1], [0, 1, 2, 3, 4]]
+    assert calls == [(["a", "b"], 5)]
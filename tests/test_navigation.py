@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import json
+from typing import Dict, List, Optional
+
+from apps.api.navigation import MAX_TREE_DEPTH, build_tree, subtree
+
+
+def _page(page_id: str, title: Optional[str], parent: Optional[str] = None) -> Dict[str, object]:
+    return {"page_id": page_id, "url": f"/{page_id}", "title": title, "parent_url": f"/{parent}" if parent else None}
+
+
+def _titles(nodes: List[Dict[str, object]]) -> List[str]:
+    return [node["title"] for node in nodes]
+
+
+def test_build_tree_sorts_children_and_ignores_self_parent() -> None:
+    pages = [
+        _page("root", "Корень"),
+        _page("b", "Б", "root"),
+        _page("a", "А", "root"),
+        _page("self", "Сам себе родитель", "self"),
+        _page("orphan", "Сирота", "missing"),
+    ]
+    roots = build_tree(pages)
+    assert _titles(roots) == ["Корень", "Сам себе родитель", "Сирота"]
+    assert _titles(roots[0]["children"]) == ["А", "Б"]
+
+
+def test_subtree_limits_depth() -> None:
+    pages = [_page("root", "R"), _page("a", "A", "root"), _page("a1", "A1", "a")]
+    root = build_tree(pages)[0]
+    shallow = subtree(root, 1)
+    assert shallow["has_children"] is True
+    assert shallow["children"][0]["title"] == "A"
+    assert shallow["children"][0]["has_children"] is True
+    assert shallow["children"][0]["children"] == []
+    full = subtree(root, None)
+    assert full["children"][0]["children"][0]["title"] == "A1"
+    assert "children" in root and root["children"][0]["children"]
+
+
+def _chain(length: int) -> List[Dict[str, object]]:
+    return [_page(str(n), f"Страница {n}", str(n - 1) if n else None) for n in range(length)]
+
+
+def test_deep_chain_is_walked_without_recursion() -> None:
+    roots = build_tree(_chain(5000))
+    json.dumps({"tree": roots})
+    assert len(roots) == -(-5000 // MAX_TREE_DEPTH)
+    node = subtree(roots[0], None)
+    depth = 0
+    while node["children"]:
+        node = node["children"][0]
+        depth += 1
+    assert depth == MAX_TREE_DEPTH - 1
+
+
+def test_subtree_handles_deep_nodes() -> None:
+    root: Dict[str, object] = {"page_id": "0", "children": []}
+    node = root
+    for n in range(1, 5000):
+        child: Dict[str, object] = {"page_id": str(n), "children": []}
+        node["children"].append(child)
+        node = child
+    copy = subtree(root, None)
+    assert copy["page_id"] == "0" and copy["has_children"] is True
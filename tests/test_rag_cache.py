@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import time
+
+import numpy as np
+
+from apps.api.rag_cache import MAX_VARIANTS_PER_KEY, RagAnswerCache
+
+
+def _unit(*values: float) -> np.ndarray:
+    vector = np.asarray(values, dtype="float32")
+    return vector / np.linalg.norm(vector)
+
+
+def test_key_ignores_source_order_and_rounds_temperature() -> None:
+    first = RagAnswerCache.make_key(["b", "a"], "qwen", 0.2000001, 800)
+    assert first == RagAnswerCache.make_key(["a", "b"], "qwen", 0.2, 800)
+    assert first != RagAnswerCache.make_key(["a", "b"], "qwen", 0.3, 800)
+    assert first != RagAnswerCache.make_key(["a", "b"], "qwen", 0.2, 400)
+    assert first != RagAnswerCache.make_key(["a", "c"], "qwen", 0.2, 800)
+
+
+def test_exact_hit_uses_normalized_query() -> None:
+    cache = RagAnswerCache(max_size=10, ttl=0, similarity_threshold=1.0)
+    key = RagAnswerCache.make_key(["a"], "m", 0.2, 800)
+    assert cache.get(key, "Что такое МКЭ?", None, "v1") is None
+    cache.put(key, "Что такое МКЭ?", None, "v1", "ответ")
+    assert cache.get(key, "  что такое  мкэ? ", None, "v1") == "ответ"
+    assert cache.get(key, "другой вопрос", None, "v1") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_semantic_hit_respects_threshold() -> None:
+    cache = RagAnswerCache(max_size=10, ttl=0, similarity_threshold=0.9)
+    key = RagAnswerCache.make_key(["a"], "m", 0.2, 800)
+    cache.put(key, "вопрос", _unit(1.0, 0.0), "v1", "ответ")
+    assert cache.get(key, "похожий вопрос", _unit(1.0, 0.1), "v1") == "ответ"
+    assert cache.get(key, "далекий вопрос", _unit(0.0, 1.0), "v1") is None
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_version_change_clears_cache() -> None:
+    cache = RagAnswerCache(max_size=10, ttl=0, similarity_threshold=1.0)
+    key = RagAnswerCache.make_key(["a"], "m", 0.2, 800)
+    cache.put(key, "вопрос", None, "v1", "ответ")
+    assert cache.get(key, "вопрос", None, "v2") is None
+    assert cache.stats()["invalidations"] == 1
+    assert cache.stats()["size"] == 0
+    cache.put(key, "вопрос", None, "v2", "новый ответ")
+    assert cache.get(key, "вопрос", None, "v2") == "новый ответ"
+
+
+def test_ttl_expires_entries() -> None:
+    cache = RagAnswerCache(max_size=10, ttl=0.05, similarity_threshold=1.0)
+    key = RagAnswerCache.make_key(["a"], "m", 0.2, 800)
+    cache.put(key, "вопрос", None, "v1", "ответ")
+    time.sleep(0.08)
+    assert cache.get(key, "вопрос", None, "v1") is None
+
+
+def test_lru_and_variant_limits() -> None:
+    cache = RagAnswerCache(max_size=2, ttl=0, similarity_threshold=1.0)
+    keys = [RagAnswerCache.make_key([name], "m", 0.2, 800) for name in "abc"]
+    cache.put(keys[0], "q", None, "v1", "a")
+    cache.put(keys[1], "q", None, "v1", "b")
+    assert cache.get(keys[0], "q", None, "v1") == "a"
+    cache.put(keys[2], "q", None, "v1", "c")
+    assert cache.get(keys[1], "q", None, "v1") is None
+    assert cache.get(keys[0], "q", None, "v1") == "a"
+
+    for n in range(MAX_VARIANTS_PER_KEY + 1):
+        cache.put(keys[2], f"вопрос {n}", None, "v1", str(n))
+    assert cache.get(keys[2], "вопрос 0", None, "v1") is None
+    assert cache.get(keys[2], f"вопрос {MAX_VARIANTS_PER_KEY}", None, "v1") == str(MAX_VARIANTS_PER_KEY)
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import dataclasses
+from typing import List, Tuple
+
+import numpy as np
+
+from apps.api.config import get_settings
+from apps.api.reranker import CrossEncoderModel, Reranker
+
+
+class FakeCrossEncoder(CrossEncoderModel):
+    def __init__(self, scores: dict) -> None:
+        self.scores = scores
+        self.batches: List[int] = []
+
+    def score(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        self.batches.append(len(pairs))
+        return np.asarray([self.scores[text] for _, text in pairs], dtype="float32")
+
+
+def _reranker(monkeypatch, provider: str, **overrides) -> Reranker:
+    monkeypatch.setenv("RERANKER_PROVIDER", provider)
+    settings = dataclasses.replace(get_settings(), **overrides)
+    return Reranker(settings)
+
+
+def test_disabled_by_default(monkeypatch) -> None:
+    monkeypatch.delenv("RERANKER_PROVIDER", raising=False)
+    reranker = Reranker(get_settings())
+    assert not reranker.enabled
+    assert reranker.candidates == 0
+    result = reranker.rerank("запрос", ["a", "b", "c"], top_k=2)
+    assert result.status == "disabled"
+    assert result.order == [0, 1]
+
+
+def test_not_ready_keeps_search_order(monkeypatch) -> None:
+    reranker = _reranker(monkeypatch, "st")
+    assert reranker.enabled
+    result = reranker.rerank("запрос", ["a", "b"], top_k=5)
+    assert result.status == "not_ready"
+    assert result.order == [0, 1]
+
+
+def test_orders_by_score_in_batches(monkeypatch) -> None:
+    reranker = _reranker(monkeypatch, "st", reranker_batch_size=2, reranker_budget_ms=0)
+    model = FakeCrossEncoder({"a": 0.1, "b": 0.9, "c": 0.5, "d": 0.5, "e": 0.7})
+    reranker._model = model
+    result = reranker.rerank("запрос", ["a", "b", "c", "d", "e"], top_k=4)
+    assert result.applied
+    # Равные оценки c и d сохраняют порядок поиска
+    assert result.order == [1, 4, 2, 3]
+    assert result.scores[1] == np.float32(0.9)
+    assert model.batches == [2, 2, 1]